@@ -1,41 +1,169 @@
-from typing import Dict, List
+import os
+from bisect import bisect_right
+from collections.abc import Iterable, Iterator
+from functools import lru_cache
+from itertools import accumulate
+from typing import Any
 
+from application.app import app
+from application.telemetry import Span, count, span
 from chonkie import SentenceChunker
 
-from application.app import app
+from activities.claim_check import get_claim_check_store
 
+DEFAULT_CHUNKING_SETTINGS = {
+	"tokenizer": "gpt2",
+	"chunk_size": 512,
+	"chunk_overlap": 128,
+	"min_sentences_per_chunk": 1,
+}
 
-@app.function_name(name="chunking")
-@app.activity_trigger(input_name="document")
-def chunking(document: Dict) -> List[Dict]:
-	chunker = SentenceChunker(
-		tokenizer="gpt2",
-		chunk_size=512,
-		chunk_overlap=128,
-		min_sentences_per_chunk=1,
+
+@lru_cache(maxsize=8)
+def _get_chunker(tokenizer: str, chunk_size: int, chunk_overlap: int, min_sentences_per_chunk: int) -> SentenceChunker:
+	return SentenceChunker(
+		tokenizer=tokenizer,
+		chunk_size=chunk_size,
+		chunk_overlap=chunk_overlap,
+		min_sentences_per_chunk=min_sentences_per_chunk,
+	)
+
+
+def get_chunker(settings: dict = None) -> SentenceChunker:
+	settings = {**DEFAULT_CHUNKING_SETTINGS, **(settings or {})}
+	unknown_settings = set(settings) - set(DEFAULT_CHUNKING_SETTINGS)
+	if unknown_settings:
+		raise ValueError(f"Unknown chunking settings: {', '.join(sorted(unknown_settings))}")
+	return _get_chunker(
+		str(settings["tokenizer"]),
+		int(settings["chunk_size"]),
+		int(settings["chunk_overlap"]),
+		int(settings["min_sentences_per_chunk"]),
 	)
-	only_text_pages = [page for page in document["pages"]]
-	all_text = "".join(only_text_pages)
-	chunks = chunker.chunk(all_text)
-	chunks_with_page_numbers: List[Dict] = []
-	for chunk in chunks:
+
+
+@app.function_name(name="chunking")
+@app.activity_trigger(input_name="params")
+def chunking(params: dict) -> Any:
+	with span("chunking", params.get("scheduled_at")) as current:
+		chunks = _chunk_document(params, current)
+		current.set(chunks=len(chunks), tokens=sum(chunk["token_count"] for chunk in chunks))
+		count("indexing.chunks", len(chunks))
+		return get_claim_check_store().put(chunks)
+
+
+def _chunk_document(params: dict, current: Span) -> list[dict]:
+	document = get_claim_check_store().get(params["document"])
+	current.set(filename=document["filename"])
+	chunker = get_chunker(params.get("settings"))
+	page_index = PageIndex([])
+	window_chars = int(os.getenv("CHUNKING_WINDOW_CHARS", "200000"))
+	# The document and the chunk list are held whole; only pages that were chunked are released early
+	chunks_with_page_numbers: list[dict] = []
+	for chunk in iter_chunks(_consume_pages(document), chunker, window_chars, page_index):
 		chunks_with_page_numbers.append({
 			"filename": document["filename"],
 			"url": document["url"],
-			"text": chunk.text,
-			"start_page": get_page_number(chunk.start_index, only_text_pages),
-			"end_page": get_page_number(chunk.end_index, only_text_pages),
-			"start_index": chunk.start_index,
-			"end_index": chunk.end_index,
-			"token_count": chunk.token_count,
+			"text": chunk["text"],
+			"start_page": page_index.page_number(chunk["start_index"]),
+			"end_page": page_index.page_number(chunk["end_index"]),
+			"page_spans": page_index.page_spans(chunk["start_index"], chunk["end_index"]),
+			"start_index": chunk["start_index"],
+			"end_index": chunk["end_index"],
+			"token_count": chunk["token_count"],
 		})
+	current.set(pages=len(page_index.page_ends))
 	return chunks_with_page_numbers
 
 
-def get_page_number(position: int, pages: List[str]) -> int:
-	position -= 1
-	for page_number, page_content in enumerate(pages):
-		if position < len(page_content):
-			return page_number
-		position -= len(page_content)
-	raise ValueError("Position out of range")
+def _consume_pages(document: dict) -> Iterator[str]:
+	# Hand the pages out one by one and drop the document's references to them, so pages that have
+	# been chunked can be garbage collected
+	pages = document.pop("pages")
+	pages.reverse()
+	while pages:
+		yield pages.pop()
+
+
+def iter_chunks(
+	pages: Iterable[str], chunker: SentenceChunker, window_chars: int, page_index: "PageIndex"
+) -> Iterator[dict]:
+	"""
+	Chunks a document as a sliding window over its pages, so the text handed to the chunker at once, and the
+	chunker's working set, is bounded by `window_chars` rather than by the document size. It does not bound the
+	activity's memory: the caller still loads the whole document and collects every chunk. Pages are appended to
+	`page_index` as they are read.
+
+	Whenever the window is full it is chunked and every chunk except the last is emitted; the window then
+	restarts at the last chunk's start, so that chunk is re-chunked together with the following pages and the
+	chunker's overlap carries across window boundaries. Documents smaller than one window are chunked exactly as
+	a single text. Offsets in the emitted chunks are relative to the whole document.
+	"""
+	window = ""
+	window_offset = 0
+	for page in pages:
+		page_index.append(len(page))
+		window += page
+		if len(window) < window_chars:
+			continue
+		chunks = chunker.chunk(window)
+		if len(chunks) < 2:
+			continue
+		for chunk in chunks[:-1]:
+			yield _chunk_record(chunk, window_offset)
+		restart = chunks[-1].start_index
+		window = window[restart:]
+		window_offset += restart
+	if window:
+		for chunk in chunker.chunk(window):
+			yield _chunk_record(chunk, window_offset)
+
+
+def _chunk_record(chunk, window_offset: int) -> dict:
+	return {
+		"text": chunk.text,
+		"start_index": window_offset + chunk.start_index,
+		"end_index": window_offset + chunk.end_index,
+		"token_count": chunk.token_count,
+	}
+
+
+class PageIndex:
+	"""
+	Maps character offsets in the concatenated page text back to pages, using the cumulative page lengths
+	and a binary search instead of walking the page list for every lookup.
+	"""
+
+	def __init__(self, pages: list[str]):
+		self.page_ends = list(accumulate(len(page) for page in pages))
+
+	def append(self, page_length: int):
+		self.page_ends.append((self.page_ends[-1] if self.page_ends else 0) + page_length)
+
+	def page_number(self, position: int) -> int:
+		"""
+		Page of the character *before* `position`, matching the original linear lookup. For an exclusive end
+		index this is the page of the chunk's last character; for a start index that falls on the first
+		character of page n (n > 0) it is page n - 1.
+		"""
+		page_number = bisect_right(self.page_ends, position - 1)
+		if page_number == len(self.page_ends):
+			raise ValueError("Position out of range")
+		return page_number
+
+	def page_spans(self, start: int, end: int) -> list[tuple[int, int, int]]:
+		"""Exact (page, start, end) character spans, relative to each page, covered by the range [start, end)."""
+		spans: list[tuple[int, int, int]] = []
+		page_number = bisect_right(self.page_ends, start)
+		while page_number < len(self.page_ends) and start < end:
+			page_start = self.page_ends[page_number - 1] if page_number else 0
+			span_end = min(end, self.page_ends[page_number])
+			if span_end > start:
+				spans.append((page_number, start - page_start, span_end - page_start))
+			start = span_end
+			page_number += 1
+		return spans
+
+
+def get_page_number(position: int, pages: list[str]) -> int:
+	return PageIndex(pages).page_number(position)
@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import struct
+import time
+import uuid
+import zlib
+from array import array
+from collections.abc import Callable
+from functools import lru_cache
+from typing import Any
+
+from application.clients import get_blob_service_client
+from azure.core.exceptions import ResourceExistsError
+from azure.storage.blob import ContainerClient
+
+from activities.vectors import as_vector, to_base64
+
+CLAIM_CHECK_KEY = "claim_check"
+_MAGIC = b"CCK1"
+
+
+def is_claim_check(value: Any) -> bool:
+    return isinstance(value, dict) and CLAIM_CHECK_KEY in value
+
+
+def item_count(value: Any) -> int:
+    """Number of items in a list payload, whether it is inline or behind a claim check."""
+    if is_claim_check(value):
+        return value[CLAIM_CHECK_KEY]["items"]
+    return len(value)
+
+
+def _has_embeddings(payload: Any) -> bool:
+    return isinstance(payload, list) and bool(payload) and all(
+        isinstance(item, dict) and "embedding" in item for item in payload
+    )
+
+
+def _map_embeddings(payload: Any, convert: Callable[[Any], Any]) -> Any:
+    if not _has_embeddings(payload):
+        return payload
+    return [{**item, "embedding": convert(item["embedding"])} for item in payload]
+
+
+def encode(payload: Any) -> bytes:
+    """
+    Encodes a payload as compressed JSON. Chunk lists carrying an "embedding" vector have their vectors stored
+    separately as a float32 matrix instead of JSON numbers.
+    """
+    dimensions = 0
+    vectors = array("f")
+    if _has_embeddings(payload):
+        dimensions = len(as_vector(payload[0]["embedding"]))
+        stripped = []
+        for item in payload:
+            vector = as_vector(item["embedding"])
+            if len(vector) != dimensions:
+                raise ValueError("All embeddings in a claim-checked payload must have the same dimensions")
+            vectors.extend(vector)
+            stripped.append({key: value for key, value in item.items() if key != "embedding"})
+        payload = stripped
+    header = zlib.compress(json.dumps({"payload": payload, "dimensions": dimensions}).encode("utf-8"), 6)
+    return _MAGIC + struct.pack("<I", len(header)) + header + vectors.tobytes()
+
+
+def decode(data: bytes) -> Any:
+    if data[:4] != _MAGIC:
+        raise ValueError("Not a claim-check payload")
+    (header_length,) = struct.unpack_from("<I", data, 4)
+    header = json.loads(zlib.decompress(data[8 : 8 + header_length]))
+    payload, dimensions = header["payload"], header["dimensions"]
+    if dimensions:
+        vectors = array("f")
+        vectors.frombytes(data[8 + header_length :])
+        for i, item in enumerate(payload):
+            item["embedding"] = vectors[i * dimensions : (i + 1) * dimensions]
+    return payload
+
+
+class ClaimCheckStore:
+    """
+    Keeps large activity inputs and outputs out of the orchestration history. Payloads above `min_bytes` are written
+    to blob storage and replaced by a small reference, which the consuming activity resolves with `get`.
+    Old payloads are deleted by the lifecycle management rule in infra/app/storage.bicep.
+
+    Inline payloads carry embeddings as base64-encoded float32 so that they stay JSON-serializable; `get` always
+    returns them as float32 arrays.
+    """
+
+    def __init__(self, container_client: ContainerClient | None, min_bytes: int = 64 * 1024):
+        self.container_client = container_client
+        self.min_bytes = min_bytes
+        self._container_checked = False
+
+    def put(self, payload: Any) -> Any:
+        if self.container_client is None:
+            return _map_embeddings(payload, to_base64)
+        start = time.perf_counter()
+        data = encode(payload)
+        if len(data) < self.min_bytes:
+            return _map_embeddings(payload, to_base64)
+        self._ensure_container()
+        blob_name = f"{uuid.uuid4()}.bin"
+        self.container_client.upload_blob(blob_name, data, overwrite=True)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        logging.info(f"Claim check {blob_name}: {len(data)} bytes encoded and stored in {elapsed_ms:.0f} ms")
+        return {
+            CLAIM_CHECK_KEY: {
+                "blob": blob_name,
+                "bytes": len(data),
+                "items": len(payload) if isinstance(payload, list) else 1,
+            }
+        }
+
+    def get(self, value: Any) -> Any:
+        if not is_claim_check(value):
+            return _map_embeddings(value, as_vector)
+        start = time.perf_counter()
+        blob_name = value[CLAIM_CHECK_KEY]["blob"]
+        data = bytearray()
+        for chunk in self.container_client.download_blob(blob_name).chunks():
+            data.extend(chunk)
+        payload = decode(bytes(data))
+        logging.info(f"Claim check {blob_name}: loaded in {(time.perf_counter() - start) * 1000:.0f} ms")
+        return payload
+
+    def _ensure_container(self):
+        if self._container_checked:
+            return
+        try:
+            self.container_client.create_container()
+        except ResourceExistsError:
+            pass
+        self._container_checked = True
+
+
+@lru_cache(maxsize=1)
+def get_claim_check_store() -> ClaimCheckStore:
+    if os.getenv("CLAIM_CHECK_ENABLED", "true").lower() != "true":
+        return ClaimCheckStore(None)
+    account_name = os.getenv("SOURCE_STORAGE_ACCOUNT_NAME")
+    if not account_name:
+        raise ValueError("SOURCE_STORAGE_ACCOUNT_NAME is not set")
+    return ClaimCheckStore(
+        get_blob_service_client(account_name).get_container_client(
+            os.getenv("CLAIM_CHECK_CONTAINER_NAME", "claim-check")
+        ),
+        int(os.getenv("CLAIM_CHECK_MIN_BYTES", str(64 * 1024))),
+    )
+
+
+def put_chunk_sets(chunk_sets: list[list[dict]]) -> list[Any]:
+    store = get_claim_check_store()
+    return [store.put(chunks) for chunks in chunk_sets]
+
+
+def get_chunk_sets(chunk_sets: list[Any]) -> list[list[dict]]:
+    store = get_claim_check_store()
+    return [store.get(chunks) for chunks in chunk_sets]
@@ -1,55 +1,246 @@
+import asyncio
+import base64
+import hashlib
+import logging
 import os
-from functools import lru_cache
-from typing import Dict
+import re
+import tempfile
+import time
+from datetime import UTC, datetime, timedelta
+from typing import BinaryIO
 from urllib.parse import unquote
 
-from azure.ai.documentintelligence import DocumentIntelligenceClient
+from application.app import app
+from application.clients import get_async_blob_service_client, get_async_document_client
+from application.limits import THROTTLING_STATUS_CODES, get_limiter
+from application.telemetry import Span, span
 from azure.ai.documentintelligence.models import AnalyzeDocumentRequest, AnalyzeResult
-from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient
+from azure.core.exceptions import HttpResponseError
+from azure.storage.blob import BlobSasPermissions, UserDelegationKey, generate_blob_sas
+from azure.storage.blob.aio import BlobClient
 
-from application.app import app
+from activities.claim_check import get_claim_check_store
+from activities.extractors import get_extractor
+from activities.layout_cache import get_layout_cache
 
-credential = DefaultAzureCredential()
+LAYOUT_MODEL_ID = "prebuilt-layout"
+# Downloads are kept in memory up to this size and spill to a temporary file beyond it
+SPOOL_MAX_BYTES = int(os.getenv("CRACKING_SPOOL_MAX_BYTES", str(16 * 1024 * 1024)))
+# Error codes Document Intelligence uses for a rejected request parameter, such as a page range past the last page
+_INVALID_PARAMETER_CODES = {"InvalidArgument", "InvalidParameter"}
+
+@app.function_name(name="document_cracking")
+@app.activity_trigger(input_name="blob_reference")
+async def document_cracking(blob_reference: dict[str, str]):
+    """
+    Extracts the pages of a blob. Simple formats are extracted in-process; everything else is analyzed by Document
+    Intelligence, either from a streamed download (CRACKING_SOURCE_MODE=stream) or from a short-lived SAS URL that the
+    service fetches itself (CRACKING_SOURCE_MODE=url). PDFs of at least CRACKING_SPLIT_MIN_BYTES are always analyzed
+    from a URL, in page ranges in parallel, without downloading them.
+    Analysis is polled cooperatively, so a worker does not hold a thread while Document Intelligence is busy.
+    """
+    blob_reference = dict(blob_reference)
+    scheduled_at = blob_reference.pop("scheduled_at", None)
+    with span(
+        "document_cracking",
+        scheduled_at,
+        blob_name=blob_reference.get("blob_name"),
+        blob_size=blob_reference.get("size"),
+    ) as current:
+        return await _crack_document(blob_reference, current)
 
 
-@lru_cache(maxsize=1)
-def _get_document_client(endpoint: str) -> DocumentIntelligenceClient:
-    if not endpoint:
-        raise ValueError("DI_ENDPOINT is not set")
-    return DocumentIntelligenceClient(endpoint, credential)
+async def _crack_document(blob_reference: dict[str, str], current: Span):
+    source_mode = os.getenv("CRACKING_SOURCE_MODE", "stream").lower()
+    if source_mode not in ("stream", "url"):
+        raise ValueError(f"Unknown CRACKING_SOURCE_MODE '{source_mode}'")
+    blob_client = get_async_blob_service_client(blob_reference.get("account_name")).get_blob_client(
+        blob_reference.get("container_name"),
+        blob_reference.get("blob_name"),
+    )
+    # Large PDFs are analyzed from a URL in page ranges in either mode, and never downloaded just to try pypdf
+    large_pdf = _is_large_pdf(blob_reference)
+    analyze_by_url = source_mode == "url" or large_pdf
+    document_file, downloaded_md5 = None, None
+    try:
+        extractor = None
+        if os.getenv("LOCAL_EXTRACTION_ENABLED", "true").lower() == "true" and not large_pdf:
+            extractor = get_extractor(blob_reference.get("blob_name", ""), blob_reference.get("content_type"))
+        if extractor is not None:
+            start = time.perf_counter()
+            document_file, downloaded_md5 = await _download(blob_client)
+            pages = await asyncio.to_thread(extractor, document_file)
+            if pages is not None:
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                logging.info(
+                    f"Extracted {blob_reference.get('blob_name')} with {extractor.__name__} in {elapsed_ms:.0f} ms"
+                )
+                current.set(extractor=extractor.__name__, pages=len(pages))
+                return await asyncio.to_thread(_cracked_document, blob_client.url, blob_reference, pages)
+            logging.info(
+                f"{extractor.__name__} declined {blob_reference.get('blob_name')}, falling back to layout analysis"
+            )
 
+        layout_cache = get_layout_cache()
+        # Listed blobs usually carry their MD5; retries and re-runs with new chunking settings then skip the
+        # download too
+        content_md5 = blob_reference.get("content_md5")
+        pages = await asyncio.to_thread(layout_cache.get, LAYOUT_MODEL_ID, content_md5)
+        if pages is None and (not analyze_by_url or document_file is not None):
+            if document_file is None:
+                document_file, downloaded_md5 = await _download(blob_client)
+            # Results are stored under the hash of the bytes actually analyzed, in case the blob changed since listing
+            if downloaded_md5 != content_md5:
+                content_md5 = downloaded_md5
+                pages = await asyncio.to_thread(layout_cache.get, LAYOUT_MODEL_ID, content_md5)
+        if pages is None:
+            if analyze_by_url:
+                pages = await _analyze_url(blob_client, blob_reference)
+            else:
+                document_file.seek(0)
+                pages = [text for _, text in await _analyze_layout(document_file)]
+            await asyncio.to_thread(layout_cache.put, LAYOUT_MODEL_ID, content_md5, pages)
+            current.set(
+                extractor=LAYOUT_MODEL_ID,
+                layout_cache_hit=False,
+                source_mode="url" if analyze_by_url else "stream",
+                pages=len(pages),
+            )
+        else:
+            logging.info(f"Layout cache hit for {blob_reference.get('blob_name')}")
+            current.set(extractor=LAYOUT_MODEL_ID, layout_cache_hit=True, pages=len(pages))
+    finally:
+        if document_file is not None:
+            document_file.close()
 
-@lru_cache(maxsize=4)
-def _get_blob_service_client(account_name: str) -> BlobServiceClient:
-    if not account_name:
-        raise ValueError("Blob reference missing account_name")
-    return BlobServiceClient(
-        account_url=f"https://{account_name}.blob.core.windows.net/",
-        credential=credential,
+    return await asyncio.to_thread(_cracked_document, blob_client.url, blob_reference, pages)
+
+
+def _is_large_pdf(blob_reference: dict[str, str]) -> bool:
+    """Whether the blob is a PDF of at least CRACKING_SPLIT_MIN_BYTES, which is analyzed in page ranges."""
+    split_min_bytes = int(os.getenv("CRACKING_SPLIT_MIN_BYTES", str(32 * 1024 * 1024)))
+    is_pdf = (
+        blob_reference.get("blob_name", "").lower().endswith(".pdf")
+        or blob_reference.get("content_type") == "application/pdf"
     )
+    return is_pdf and (blob_reference.get("size") or 0) >= split_min_bytes
 
-@app.function_name(name="document_cracking")
-@app.activity_trigger(input_name="blob_reference")
-def document_cracking(blob_reference: Dict[str, str]):
-    endpoint = os.getenv('DI_ENDPOINT')
-    client = _get_document_client(endpoint)
 
-    blob_client = _get_blob_service_client(blob_reference.get("account_name")).get_blob_client(
-        blob_reference.get("container_name"),
-        blob_reference.get("blob_name"),
+def _cracked_document(url: str, blob_reference: dict[str, str], pages: list[str]):
+    return get_claim_check_store().put(
+        {
+            "pages": pages,
+            "url": url,
+            "filename": unquote(blob_reference.get("blob_name", "").split("/")[-1]),
+            "blob_reference": blob_reference,
+        }
     )
-    document_bytes = blob_client.download_blob().readall()
 
-    poller = client.begin_analyze_document(
-        "prebuilt-layout",
-        AnalyzeDocumentRequest(bytes_source=document_bytes)
+
+async def _download(blob_client: BlobClient) -> tuple[BinaryIO, str]:
+    """Streams the blob into a spooled temporary file and returns it with the base64 MD5 of its content."""
+    document_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    md5 = hashlib.md5()
+    downloader = await blob_client.download_blob(max_concurrency=4)
+    async for chunk in downloader.chunks():
+        md5.update(chunk)
+        document_file.write(chunk)
+    document_file.seek(0)
+    return document_file, base64.b64encode(md5.digest()).decode("ascii")
+
+
+async def _analyze_layout(source: BinaryIO | str, page_range: str | None = None) -> list[tuple[int, str]]:
+    """Analyzes a document given as a file object or a URL and returns (page number, text) per page."""
+    client = get_async_document_client(os.getenv("DI_ENDPOINT"))
+    limiter = get_limiter("document_cracking")
+    kwargs = {"pages": page_range} if page_range else {}
+    if isinstance(source, str):
+        body = AnalyzeDocumentRequest(url_source=source)
+    else:
+        # The file is streamed as the request body instead of being base64-encoded into a JSON request
+        body = source
+        kwargs["content_type"] = "application/octet-stream"
+    try:
+        async with limiter.async_slot():
+            poller = await client.begin_analyze_document(LAYOUT_MODEL_ID, body, **kwargs)
+            result: AnalyzeResult = await poller.result()
+    except HttpResponseError as error:
+        if error.status_code in THROTTLING_STATUS_CODES:
+            limiter.throttled()
+        raise
+    return [(page.page_number, "".join([line["content"] for line in page.lines])) for page in result.pages]
+
+
+async def _analyze_url(blob_client: BlobClient, blob_reference: dict[str, str]) -> list[str]:
+    url = f"{blob_client.url}?{await _read_sas(blob_client)}"
+    range_size = int(os.getenv("CRACKING_PAGE_RANGE_SIZE", "100"))
+    if not range_size or not _is_large_pdf(blob_reference):
+        return [text for _, text in await _analyze_layout(url)]
+
+    # The page count is not known up front, so ranges are analyzed in waves until one comes back short
+    parallel = int(os.getenv("CRACKING_PAGE_RANGE_PARALLEL", "4"))
+    numbered_pages: list[tuple[int, str]] = []
+    first_page = 1
+    while True:
+        starts = [first_page + i * range_size for i in range(parallel)]
+        results = await asyncio.gather(*(_analyze_page_range(url, start, start + range_size - 1) for start in starts))
+        for result in results:
+            numbered_pages.extend(result)
+        if any(len(result) < range_size for result in results):
+            break
+        first_page += parallel * range_size
+    logging.info(f"Analyzed {len(numbered_pages)} pages of {blob_reference.get('blob_name')} in ranges of {range_size}")
+    numbered_pages.sort(key=lambda numbered_page: numbered_page[0])
+    return [text for _, text in numbered_pages]
+
+
+async def _analyze_page_range(url: str, first_page: int, last_page: int) -> list[tuple[int, str]]:
+    try:
+        return await _analyze_layout(url, f"{first_page}-{last_page}")
+    except HttpResponseError as error:
+        # A range that starts past the last page is rejected as an invalid pages parameter
+        if first_page > 1 and _is_invalid_page_range(error):
+            return []
+        raise
+
+
+def _is_invalid_page_range(error: HttpResponseError) -> bool:
+    """Whether the service rejected the `pages` parameter, rather than the document or anything else."""
+    if error.status_code != 400 or error.error is None:
+        return False
+    nodes = [
+        {"code": node.code, "message": node.message, "target": node.target}
+        for node in [error.error, *error.error.details]
+    ]
+    innererror = error.error.innererror
+    while innererror:
+        nodes.append(innererror)
+        innererror = innererror.get("innererror")
+    return any(
+        node.get("code") in _INVALID_PARAMETER_CODES
+        and (node.get("target") == "pages" or re.search(r"\bpages?\b", node.get("message") or "", re.IGNORECASE))
+        for node in nodes
+    )
+
+
+_delegation_keys: dict[str, tuple[UserDelegationKey, datetime]] = {}
+
+
+async def _read_sas(blob_client: BlobClient) -> str:
+    """A read-only SAS valid for one hour, signed with a cached user delegation key of the function's identity."""
+    now = datetime.now(UTC)
+    key, key_expiry = _delegation_keys.get(blob_client.account_name, (None, now))
+    if key is None or key_expiry - now < timedelta(hours=2):
+        key_expiry = now + timedelta(days=1)
+        key = await get_async_blob_service_client(blob_client.account_name).get_user_delegation_key(
+            now - timedelta(minutes=5), key_expiry
+        )
+        _delegation_keys[blob_client.account_name] = (key, key_expiry)
+    return generate_blob_sas(
+        account_name=blob_client.account_name,
+        container_name=blob_client.container_name,
+        blob_name=blob_client.blob_name,
+        user_delegation_key=key,
+        permission=BlobSasPermissions(read=True),
+        expiry=now + timedelta(hours=1),
     )
-    result: AnalyzeResult = poller.result()
-
-    return {
-        "pages": ["".join([line['content'] for line in page.lines]) for page in result.pages],
-        "url": blob_client.url,
-        "filename": unquote(blob_reference.get("blob_name", "").split("/")[-1]),
-        "blob_reference": blob_reference,
-    }
\ No newline at end of file
@@ -0,0 +1,363 @@
+"""
+Near-duplicate detection for chunks, with MinHash signatures and a locality-sensitive hashing (LSH) index.
+
+Every chunk gets a MinHash signature over its word shingles. The signature is cut into bands, and each band is a key
+in a persistent index in blob storage, shared by all workers and all runs for an index. Two chunks that share a band
+are candidates, and a candidate counts as a duplicate when the share of equal signature values, an estimate of the
+Jaccard similarity of the two texts, reaches DEDUP_THRESHOLD.
+
+Chunks are only entered into the index once their document is in the search index: deduplicate_chunks returns the
+entries to claim, and the orchestrators pass them to claim_chunks after the upload. Removing a blob releases its
+entries again with release_chunks.
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+from array import array
+from collections.abc import Iterable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from application.app import app
+from application.clients import get_blob_service_client
+from application.telemetry import count, span
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.storage.blob import ContainerClient
+
+from activities.claim_check import get_claim_check_store
+from activities.embedding_cache import cache_key, normalize_text
+from activities.vector_settings import get_vector_settings
+
+DEDUP_MODES = ("off", "link", "skip")
+# Mersenne prime for the universal hash family that stands in for random permutations
+_PRIME = (1 << 61) - 1
+_MASK = (1 << 32) - 1
+# Attempts to update a bucket blob that other workers keep changing
+_MAX_BUCKET_ATTEMPTS = 20
+
+
+@lru_cache(maxsize=4)
+def _permutations(num_perm: int) -> tuple[tuple[int, int], ...]:
+    # Fixed seed: signatures must be comparable across workers and runs
+    random_source = random.Random(20240601)
+    return tuple((random_source.randrange(1, _PRIME), random_source.randrange(0, _PRIME)) for _ in range(num_perm))
+
+
+def shingles(text: str, size: int = 3) -> list[int]:
+    words = normalize_text(text).lower().split(" ")
+    grams = [" ".join(words[i : i + size]) for i in range(max(1, len(words) - size + 1))]
+    return [
+        int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "little") for gram in set(grams)
+    ]
+
+
+def minhash(text: str, num_perm: int = 64) -> array:
+    hashes = shingles(text)
+    return array("I", (min((a * value + b) % _PRIME for value in hashes) & _MASK for a, b in _permutations(num_perm)))
+
+
+def similarity(signature: Sequence[int], other: Sequence[int]) -> float:
+    """Estimated Jaccard similarity of the shingle sets behind two signatures of the same length."""
+    return sum(1 for value, other_value in zip(signature, other) if value == other_value) / len(signature)
+
+
+def _band_hash(rows: array) -> str:
+    return hashlib.blake2b(rows.tobytes(), digest_size=16).hexdigest()
+
+
+class DedupIndex:
+    """
+    LSH index of chunk signatures in a storage container. The band keys of each band are spread over `buckets`
+    bucket blobs, `{index}/bands/{band}/{bucket}.json`, each a JSON object of band hash to the documents with a
+    chunk under that key and the chunk's position. A record blob per document, `{index}/documents/{hash}.json`,
+    holds the signatures and embedding cache keys of its claimed chunks. A lookup reads every bucket it touches once
+    and then the records of the candidate documents, so a document costs at most `bands * buckets` bucket reads
+    however many chunks it has. Buckets are updated with optimistic concurrency on their ETag.
+    """
+
+    def __init__(
+        self,
+        container_client: ContainerClient,
+        num_perm: int = 64,
+        bands: int = 8,
+        threshold: float = 0.9,
+        buckets: int = 256,
+        max_workers: int = 16,
+    ):
+        if num_perm % bands:
+            raise ValueError(f"DEDUP_NUM_PERM ({num_perm}) must be a multiple of DEDUP_BANDS ({bands})")
+        self.container_client = container_client
+        self.num_perm = num_perm
+        self.bands = bands
+        self.threshold = threshold
+        self.buckets = buckets
+        self.max_workers = max_workers
+        self._container_checked = False
+
+    @staticmethod
+    def document_hash(source: str) -> str:
+        return hashlib.sha256(source.encode("utf-8")).hexdigest()[:32]
+
+    def band_keys(self, index_name: str, signature: array) -> list[tuple[str, str]]:
+        """The band keys of a signature, each the name of its bucket blob and the band hash within the bucket."""
+        rows = self.num_perm // self.bands
+        keys = []
+        for band in range(self.bands):
+            band_hash = _band_hash(signature[band * rows : (band + 1) * rows])
+            keys.append((f"{index_name}/bands/{band}/{int(band_hash[:8], 16) % self.buckets}.json", band_hash))
+        return keys
+
+    def _read(self, name: str) -> tuple[dict, str | None]:
+        """The JSON content of a blob and its ETag, or an empty object and None when it does not exist."""
+        try:
+            downloader = self.container_client.download_blob(name)
+        except ResourceNotFoundError:
+            return {}, None
+        return json.loads(downloader.readall()), downloader.properties.etag
+
+    def _map(self, function, items) -> list:
+        items = list(items)
+        if len(items) <= 1:
+            return [function(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as executor:
+            return list(executor.map(function, items))
+
+    def lookup_many(self, index_name: str, keys: Iterable[tuple[str, str]]) -> dict[tuple[str, str], list[dict]]:
+        """The entries of every document under each key, with their `signature`, `cache_key` and `document`."""
+        keys = set(keys)
+        bucket_names = sorted({bucket_name for bucket_name, _ in keys})
+        buckets = dict(zip(bucket_names, (bucket for bucket, _ in self._map(self._read, bucket_names))))
+        references = {
+            (bucket_name, band_hash): buckets[bucket_name][band_hash]
+            for bucket_name, band_hash in keys
+            if band_hash in buckets[bucket_name]
+        }
+        documents = sorted({document for positions in references.values() for document in positions})
+        records = self._map(lambda document: self._read(self._record_name(index_name, document))[0], documents)
+        chunks_by_document = {document: record.get("chunks", []) for document, record in zip(documents, records)}
+        entries = {}
+        for key, positions in references.items():
+            for document, position in positions.items():
+                chunks = chunks_by_document[document]
+                # A bucket can briefly point past the end of a record that a new version of the document replaced
+                if position < len(chunks):
+                    signature, cache_key = chunks[position]
+                    entries.setdefault(key, []).append(
+                        {"signature": signature, "cache_key": cache_key, "document": document}
+                    )
+        return entries
+
+    def _record_name(self, index_name: str, document: str) -> str:
+        return f"{index_name}/documents/{document}.json"
+
+    def _references(self, index_name: str, chunks: list[list[str]]) -> dict[tuple[str, str], int]:
+        """The band keys of a document's chunks, each with the position of the first chunk under it."""
+        references = {}
+        for position, (signature, _) in enumerate(chunks):
+            for key in self.band_keys(index_name, array("I", bytes.fromhex(signature))):
+                references.setdefault(key, position)
+        return references
+
+    def _update_bucket(self, bucket_name: str, document: str, positions: dict[str, int | None]):
+        """Sets the position of the document under each band hash in the bucket, or removes it for None."""
+        for _ in range(_MAX_BUCKET_ATTEMPTS):
+            bucket, etag = self._read(bucket_name)
+            for band_hash, position in positions.items():
+                documents = bucket.setdefault(band_hash, {})
+                if position is None:
+                    documents.pop(document, None)
+                else:
+                    documents[document] = position
+                if not documents:
+                    del bucket[band_hash]
+            try:
+                if etag is None:
+                    self.container_client.upload_blob(bucket_name, json.dumps(bucket), overwrite=False)
+                else:
+                    self.container_client.upload_blob(
+                        bucket_name,
+                        json.dumps(bucket),
+                        overwrite=True,
+                        etag=etag,
+                        match_condition=MatchConditions.IfNotModified,
+                    )
+                return
+            except (ResourceExistsError, ResourceModifiedError):
+                # Another worker changed the bucket since it was read
+                continue
+        raise RuntimeError(f"Dedup bucket {bucket_name} kept changing, gave up after {_MAX_BUCKET_ATTEMPTS} attempts")
+
+    def _update_buckets(self, document: str, changes: dict[tuple[str, str], int | None]) -> int:
+        by_bucket: dict[str, dict[str, int | None]] = {}
+        for (bucket_name, band_hash), position in changes.items():
+            by_bucket.setdefault(bucket_name, {})[band_hash] = position
+        self._map(lambda item: self._update_bucket(item[0], document, item[1]), sorted(by_bucket.items()))
+        return len(by_bucket)
+
+    def claim(self, index_name: str, source: str, entries: list[dict]) -> int:
+        """
+        Makes `entries`, the signatures and cache keys of the chunks that were kept, the entries of the document in
+        the index, replacing those of its previous version. Returns the number of bucket blobs written.
+        """
+        document = self.document_hash(source)
+        record_name = self._record_name(index_name, document)
+        chunks = [[entry["signature"], entry["cache_key"]] for entry in entries]
+        previous = self._references(index_name, self._read(record_name)[0].get("chunks", []))
+        references = self._references(index_name, chunks)
+        self._ensure_container()
+        # The record comes first, so that the buckets never point at chunks it does not hold yet
+        self.container_client.upload_blob(record_name, json.dumps({"source": source, "chunks": chunks}), overwrite=True)
+        # Keys whose chunk position is unchanged are already in place
+        changes = {key: position for key, position in references.items() if previous.get(key) != position}
+        changes.update({key: None for key in previous.keys() - references.keys()})
+        return self._update_buckets(document, changes)
+
+    def release(self, index_name: str, source: str) -> int:
+        """Removes the entries of a document that was removed. Returns the number of bucket blobs written."""
+        document = self.document_hash(source)
+        record_name = self._record_name(index_name, document)
+        previous = self._references(index_name, self._read(record_name)[0].get("chunks", []))
+        written = self._update_buckets(document, dict.fromkeys(previous))
+        try:
+            self.container_client.delete_blob(record_name)
+        except ResourceNotFoundError:
+            pass
+        return written
+
+    def _ensure_container(self):
+        if self._container_checked:
+            return
+        try:
+            self.container_client.create_container()
+        except ResourceExistsError:
+            pass
+        self._container_checked = True
+
+
+@lru_cache(maxsize=1)
+def get_dedup_index() -> DedupIndex:
+    account_name = os.getenv("SOURCE_STORAGE_ACCOUNT_NAME")
+    if not account_name:
+        raise ValueError("SOURCE_STORAGE_ACCOUNT_NAME is not set")
+    return DedupIndex(
+        get_blob_service_client(account_name).get_container_client(os.getenv("DEDUP_CONTAINER_NAME", "dedup-index")),
+        num_perm=int(os.getenv("DEDUP_NUM_PERM", "64")),
+        bands=int(os.getenv("DEDUP_BANDS", "8")),
+        threshold=float(os.getenv("DEDUP_THRESHOLD", "0.9")),
+        buckets=int(os.getenv("DEDUP_BUCKETS", "256")),
+    )
+
+
+def deduplicate(
+    chunks: list[dict], index_name: str, source: str, mode: str, dedup_index: DedupIndex
+) -> tuple[list[dict], dict, list[dict]]:
+    """
+    Finds the chunks that are near-duplicates of chunks already in the index, or of earlier chunks of the same
+    document. In `link` mode they are kept but point to the embedding of the chunk they duplicate
+    (`embedding_key`), so they are not embedded again. In `skip` mode they are dropped before embedding and upload;
+    chunks of the same blob in the index are not used as originals then, as they are replaced by this version.
+    The tokens saved are counted here in `skip` mode only; in `link` mode the embedding activity counts them for the
+    duplicates whose original vector it actually reused. Returns the remaining chunks, the statistics of the call
+    and the entries to claim once the chunks are uploaded.
+    """
+    if mode not in DEDUP_MODES[1:]:
+        raise ValueError(f"Unknown DEDUP_MODE '{mode}'")
+    settings = get_vector_settings()
+    document = dedup_index.document_hash(source)
+    signatures = [minhash(chunk["text"], dedup_index.num_perm) for chunk in chunks]
+    chunk_band_keys = [dedup_index.band_keys(index_name, signature) for signature in signatures]
+    stored = dedup_index.lookup_many(index_name, {key for keys in chunk_band_keys for key in keys})
+
+    local: dict[tuple[str, str], dict] = {}
+    claims: list[dict] = []
+    kept: list[dict] = []
+    stats = {"chunks": len(chunks), "duplicates": 0, "tokens_saved": 0, "bytes_saved": 0}
+    for chunk, signature, keys in zip(chunks, signatures, chunk_band_keys):
+        original = None
+        for key in keys:
+            candidates = ([local[key]] if key in local else []) + [
+                candidate for candidate in stored.get(key, []) if mode != "skip" or candidate["document"] != document
+            ]
+            original = next(
+                (
+                    candidate
+                    for candidate in candidates
+                    if similarity(signature, array("I", bytes.fromhex(candidate["signature"]))) >= dedup_index.threshold
+                ),
+                None,
+            )
+            if original is not None:
+                break
+        if original is None:
+            entry = {
+                "signature": signature.tobytes().hex(),
+                "cache_key": cache_key(settings.model_name, settings.dimensions, chunk["text"]),
+            }
+            for key in keys:
+                local.setdefault(key, entry)
+            claims.append(entry)
+            kept.append(chunk)
+            continue
+        stats["duplicates"] += 1
+        if mode == "link":
+            kept.append({**chunk, "embedding_key": original["cache_key"]})
+        else:
+            stats["tokens_saved"] += chunk.get("token_count") or 0
+            # The float32 vector and the text are what the chunk would have added to the index
+            stats["bytes_saved"] += 4 * settings.dimensions + len(chunk["text"].encode("utf-8"))
+
+    return kept, stats, claims
+
+
+def _source(blob_reference: dict) -> str:
+    return f"{blob_reference['container_name']}/{blob_reference['blob_name']}"
+
+
+@app.function_name(name="deduplicate_chunks")
+@app.activity_trigger(input_name="params")
+def deduplicate_chunks(params: dict) -> dict:
+    blob_reference = params["blob_reference"]
+    with span(
+        "deduplicate_chunks", params.get("scheduled_at"), blob_name=blob_reference["blob_name"], mode=params["mode"]
+    ) as current:
+        store = get_claim_check_store()
+        chunks, stats, claims = deduplicate(
+            store.get(params["chunks"]),
+            params["index_name"],
+            _source(blob_reference),
+            params["mode"],
+            get_dedup_index(),
+        )
+        current.set(**stats)
+        count("indexing.dedup.duplicates", stats["duplicates"])
+        count("indexing.dedup.tokens_saved", stats["tokens_saved"])
+        logging.info(
+            f"{stats['duplicates']} of {stats['chunks']} chunks of {blob_reference['blob_name']} are near-duplicates"
+        )
+        return {"chunks": store.put(chunks), "stats": stats, "claims": store.put(claims)}
+
+
+@app.function_name(name="claim_chunks")
+@app.activity_trigger(input_name="params")
+def claim_chunks(params: dict) -> int:
+    """Enters the chunks kept by deduplicate_chunks into the dedup index, after their document was uploaded."""
+    blob_reference = params["blob_reference"]
+    with span("claim_chunks", params.get("scheduled_at"), blob_name=blob_reference["blob_name"]) as current:
+        claims = get_claim_check_store().get(params["claims"])
+        buckets = get_dedup_index().claim(params["index_name"], _source(blob_reference), claims)
+        current.set(chunks=len(claims), buckets_written=buckets)
+        return buckets
+
+
+@app.function_name(name="release_chunks")
+@app.activity_trigger(input_name="params")
+def release_chunks(params: dict) -> int:
+    """Removes the entries of a deleted blob from the dedup index, so its chunks no longer count as originals."""
+    blob_reference = params["blob_reference"]
+    with span("release_chunks", params.get("scheduled_at"), blob_name=blob_reference["blob_name"]) as current:
+        buckets = get_dedup_index().release(params["index_name"], _source(blob_reference))
+        current.set(buckets_written=buckets)
+        return buckets
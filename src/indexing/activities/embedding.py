@@ -1,22 +1,86 @@
-from application.app import app
+import asyncio
+import logging
 import os
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
-from openai import AzureOpenAI
-from typing import List, Dict
+
+from application.app import app
+from application.clients import get_openai_client
+from application.limits import get_limiter
+from application.telemetry import Span, count, span
+
+from activities.claim_check import get_chunk_sets, put_chunk_sets
+from activities.embedding_batcher import EmbeddingBatcher
+from activities.embedding_cache import cache_key, get_embedding_cache
+from activities.vector_settings import get_vector_settings
+
 
 @app.function_name(name="embedding")
-@app.activity_trigger(input_name="chunks")
-def embedding(chunks: List[Dict]) -> List[Dict]:
-    endpoint = os.getenv('AZURE_OPENAI_ENDPOINT')
-    token_provider = get_bearer_token_provider(
-        DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default"
-    )
-    client = AzureOpenAI(
-        api_version="2024-02-15-preview",
-        azure_endpoint=endpoint,
-        azure_ad_token_provider=token_provider,
+@app.activity_trigger(input_name="documents")
+async def embedding(documents: dict) -> dict:
+    with span("embedding", documents.get("scheduled_at"), documents=len(documents["chunk_sets"])) as current:
+        return await _embed(documents, current)
+
+
+async def _embed(documents: dict, current: Span) -> dict:
+    # Each entry of chunk_sets holds the chunks of one document, inline or behind a claim check
+    chunk_sets = await asyncio.to_thread(get_chunk_sets, documents["chunk_sets"])
+    chunks = [chunk for chunk_set in chunk_sets for chunk in chunk_set]
+    cache = get_embedding_cache()
+    settings = get_vector_settings()
+    # The dimensions are part of the key, so changing them never reuses vectors of the old size
+    keys = [cache_key(settings.model_name, settings.dimensions, chunk["text"]) for chunk in chunks]
+    # Near-duplicates found by deduplicate_chunks in link mode reuse the vector of their original when it is cached
+    linked_keys = {
+        position: chunk.pop("embedding_key") for position, chunk in enumerate(chunks) if chunk.get("embedding_key")
+    }
+    cached = await asyncio.to_thread(cache.get_many, set(keys) | set(linked_keys.values()))
+    linked, linked_tokens = 0, 0
+    for position, linked_key in linked_keys.items():
+        if linked_key in cached and keys[position] not in cached:
+            keys[position] = linked_key
+            linked += 1
+            linked_tokens += chunks[position].get("token_count") or 0
+    # Identical texts within the call are only sent once
+    missing_chunks = {key: chunk for key, chunk in zip(keys, chunks) if key not in cached}
+    missing_keys = list(missing_chunks)
+
+    if missing_keys:
+        batcher = EmbeddingBatcher(
+            get_openai_client(os.getenv("AZURE_OPENAI_ENDPOINT")),
+            model=settings.deployment,
+            max_batch_tokens=int(os.getenv("EMBEDDING_MAX_BATCH_TOKENS", "100000")),
+            max_batch_items=int(os.getenv("EMBEDDING_MAX_BATCH_ITEMS", "512")),
+            limiter=get_limiter("embedding"),
+            dimensions=settings.request_dimensions,
+        )
+        vectors = await batcher.embed(
+            [missing_chunks[key]["text"] for key in missing_keys],
+            [missing_chunks[key].get("token_count") or 1 for key in missing_keys],
+        )
+        if vectors and len(vectors[0]) != settings.dimensions:
+            raise ValueError(
+                f"Deployment '{settings.deployment}' returned {len(vectors[0])} dimensions, "
+                f"the index expects {settings.dimensions}"
+            )
+        computed = dict(zip(missing_keys, vectors))
+        await asyncio.to_thread(cache.put_many, computed)
+        cached.update(computed)
+
+    for key, chunk in zip(keys, chunks):
+        chunk["embedding"] = cached[key]
+    stats = {
+        "hits": len(chunks) - len(missing_keys),
+        "misses": len(missing_keys),
+        "linked": linked,
+        "linked_tokens": linked_tokens,
+    }
+    logging.info(f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses")
+    embedded_tokens = sum(missing_chunks[key].get("token_count") or 0 for key in missing_keys)
+    current.set(
+        chunks=len(chunks),
+        cache_hits=stats["hits"],
+        cache_misses=stats["misses"],
+        linked=linked,
+        tokens=embedded_tokens,
     )
-    embeddings = client.embeddings.create(input = [chunk["text"] for chunk in chunks], model="embedding")
-    for i, chunk in enumerate(chunks):
-        chunk["embedding"] = embeddings.data[i].embedding 
-    return chunks
\ No newline at end of file
+    count("indexing.tokens", embedded_tokens)
+    return {"chunk_sets": await asyncio.to_thread(put_chunk_sets, chunk_sets), "cache": stats}
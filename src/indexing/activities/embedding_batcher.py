@@ -0,0 +1,126 @@
+import asyncio
+import email.utils
+import logging
+import random
+import time
+from collections.abc import Sequence
+
+from application.limits import THROTTLING_STATUS_CODES, AdaptiveLimiter
+from application.telemetry import count
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI, RateLimitError
+
+from activities.vectors import Vector, from_base64
+
+
+def _retry_after_seconds(error: APIStatusError) -> float | None:
+    headers = error.response.headers if error.response is not None else {}
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+        return max(0.0, retry_at.timestamp() - time.time()) if retry_at else None
+
+
+class EmbeddingBatcher:
+    """
+    Packs texts into embedding requests bounded by token and item count, sends the requests concurrently and
+    returns the vectors in input order. Throttled or failed requests are retried per batch, honouring Retry-After.
+    Vectors are requested base64-encoded and decoded straight into float32 arrays.
+
+    Requests go through `limiter`, which bounds concurrent requests and tokens per second and backs off when the
+    service throttles; without one, a fixed limit of `max_concurrency` requests applies.
+
+    Works with any OpenAI-compatible client; the tests point one at benchmarks.fakes.FakeEmbeddingServer through
+    `base_url`.
+    """
+
+    def __init__(
+        self,
+        client: AsyncOpenAI,
+        model: str,
+        max_batch_tokens: int = 100_000,
+        max_batch_items: int = 512,
+        max_concurrency: int = 4,
+        max_attempts: int = 6,
+        base_backoff_seconds: float = 1.0,
+        max_backoff_seconds: float = 60.0,
+        limiter: AdaptiveLimiter | None = None,
+        dimensions: int | None = None,
+    ):
+        self.client = client
+        self.model = model
+        # Shortened vectors for models that support it; None keeps the model's own size
+        self.dimensions = dimensions
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_items = max_batch_items
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.base_backoff_seconds = base_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.limiter = limiter or AdaptiveLimiter("embedding", max_concurrency, max_limit=max_concurrency)
+
+    def pack(self, token_counts: Sequence[int]) -> list[list[int]]:
+        """Greedily groups input positions into batches; an input larger than the token budget gets its own batch."""
+        batches: list[list[int]] = []
+        current: list[int] = []
+        current_tokens = 0
+        for position, token_count in enumerate(token_counts):
+            if current and (
+                current_tokens + token_count > self.max_batch_tokens or len(current) >= self.max_batch_items
+            ):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(position)
+            current_tokens += token_count
+        if current:
+            batches.append(current)
+        return batches
+
+    async def embed(self, texts: Sequence[str], token_counts: Sequence[int] | None = None) -> list[Vector]:
+        if token_counts is None:
+            token_counts = [max(1, len(text) // 4) for text in texts]
+        batches = self.pack(token_counts)
+        results: list[Vector | None] = [None] * len(texts)
+
+        async def run(batch: list[int]):
+            vectors = await self._create_with_retry(
+                [texts[position] for position in batch], sum(token_counts[position] for position in batch)
+            )
+            for position, vector in zip(batch, vectors):
+                results[position] = vector
+
+        await asyncio.gather(*(run(batch) for batch in batches))
+        logging.info(f"Embedded {len(texts)} texts in {len(batches)} requests")
+        return results
+
+    async def _create_with_retry(self, batch_texts: list[str], batch_tokens: int) -> list[Vector]:
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                async with self.limiter.async_slot(batch_tokens):
+                    response = await self.client.embeddings.create(
+                        input=batch_texts, model=self.model, encoding_format="base64",
+                        **({"dimensions": self.dimensions} if self.dimensions else {}),
+                    )
+                return [from_base64(item.embedding) for item in sorted(response.data, key=lambda item: item.index)]
+            except (RateLimitError, APIStatusError, APIConnectionError) as error:
+                if isinstance(error, RateLimitError) or getattr(error, "status_code", None) in THROTTLING_STATUS_CODES:
+                    self.limiter.throttled()
+                retryable = isinstance(error, (RateLimitError, APIConnectionError)) or error.status_code >= 500
+                if not retryable or attempt == self.max_attempts:
+                    raise
+                delay = _retry_after_seconds(error) if isinstance(error, APIStatusError) else None
+                if delay is None:
+                    delay = min(self.max_backoff_seconds, self.base_backoff_seconds * 2 ** (attempt - 1))
+                    delay *= random.uniform(0.5, 1.0)
+                logging.warning(f"Embedding request failed ({error}), retrying in {delay:.1f}s (attempt {attempt})")
+                count("indexing.retries", stage="embedding")
+                await asyncio.sleep(delay)
+        raise RuntimeError("unreachable")
@@ -0,0 +1,277 @@
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime, timedelta
+from functools import lru_cache
+
+from application.app import app
+from application.clients import get_blob_service_client
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import ContainerClient
+
+from activities.vectors import Vector, from_bytes, to_bytes
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+def cache_key(model: str, dimensions: int, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{dimensions}\0{normalize_text(text)}".encode()).hexdigest()
+
+
+class EmbeddingCache(ABC):
+    """
+    Content-addressed store of embedding vectors. Keys are produced by `cache_key`, vectors are float32 arrays.
+    """
+
+    def __init__(self, max_bytes: int | None, max_age_seconds: float | None):
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+
+    @abstractmethod
+    def get_many(self, keys: Iterable[str]) -> dict[str, Vector]:
+        pass
+
+    @abstractmethod
+    def put_many(self, vectors: dict[str, Vector]):
+        pass
+
+    @abstractmethod
+    def evict(self) -> int:
+        """Removes entries older than max_age_seconds, then the least recently used ones above max_bytes."""
+
+
+class NullEmbeddingCache(EmbeddingCache):
+    def __init__(self):
+        super().__init__(None, None)
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Vector]:
+        return {}
+
+    def put_many(self, vectors: dict[str, Vector]):
+        pass
+
+    def evict(self) -> int:
+        return 0
+
+
+class SqliteEmbeddingCache(EmbeddingCache):
+    """
+    Local cache backend, intended for development and tests.
+    """
+
+    def __init__(self, path: str, max_bytes: int | None = None, max_age_seconds: float | None = None):
+        super().__init__(max_bytes, max_age_seconds)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._connection.commit()
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Vector]:
+        keys = list(keys)
+        found: dict[str, Vector] = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = from_bytes(vector)
+            self._connection.executemany(
+                "UPDATE embeddings SET accessed = ? WHERE key = ?", [(time.time(), key) for key in found]
+            )
+            self._connection.commit()
+        return found
+
+    def put_many(self, vectors: dict[str, Vector]):
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, created, accessed) VALUES (?, ?, ?, ?)",
+                [(key, to_bytes(vector), now, now) for key, vector in vectors.items()],
+            )
+            self._connection.commit()
+
+    def evict(self) -> int:
+        removed = 0
+        with self._lock:
+            if self.max_age_seconds is not None:
+                removed += self._connection.execute(
+                    "DELETE FROM embeddings WHERE created < ?", (time.time() - self.max_age_seconds,)
+                ).rowcount
+            if self.max_bytes is not None:
+                total_bytes = self._connection.execute(
+                    "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+                ).fetchone()[0]
+                victims: list[str] = []
+                for key, size in self._connection.execute(
+                    "SELECT key, LENGTH(vector) FROM embeddings ORDER BY accessed"
+                ):
+                    if total_bytes <= self.max_bytes:
+                        break
+                    victims.append(key)
+                    total_bytes -= size
+                self._connection.executemany("DELETE FROM embeddings WHERE key = ?", [(key,) for key in victims])
+                removed += len(victims)
+            self._connection.commit()
+        return removed
+
+
+class BlobEmbeddingCache(EmbeddingCache):
+    """
+    Production cache backend, storing one float32 blob per key in a storage container.
+    A hit rewrites the blob's metadata when it was last modified more than touch_interval_seconds ago, which moves its
+    Last-Modified time forward. Eviction by size then drops the blobs with the oldest Last-Modified first, which is
+    least recently used to within touch_interval_seconds. Eviction by age uses the creation time.
+    """
+
+    def __init__(
+        self,
+        container_client: ContainerClient,
+        max_bytes: int | None = None,
+        max_age_seconds: float | None = None,
+        max_workers: int = 16,
+        touch_interval_seconds: float | None = 86_400,
+    ):
+        super().__init__(max_bytes, max_age_seconds)
+        self.container_client = container_client
+        self.max_workers = max_workers
+        self.touch_interval_seconds = touch_interval_seconds
+        self._container_checked = False
+
+    @staticmethod
+    def _blob_name(key: str) -> str:
+        return f"{key[:2]}/{key}"
+
+    def _get(self, key: str) -> Vector | None:
+        try:
+            downloader = self.container_client.download_blob(self._blob_name(key))
+            vector = from_bytes(downloader.readall())
+        except ResourceNotFoundError:
+            return None
+        self._touch(key, downloader.properties.last_modified)
+        return vector
+
+    def _touch(self, key: str, last_modified: datetime):
+        """Records an access, at most once per touch interval so that hot entries do not cost a write per hit."""
+        if self.touch_interval_seconds is None:
+            return
+        now = datetime.now(UTC)
+        if now - last_modified < timedelta(seconds=self.touch_interval_seconds):
+            return
+        try:
+            self.container_client.get_blob_client(self._blob_name(key)).set_blob_metadata({"accessed": now.isoformat()})
+        except ResourceNotFoundError:
+            # Evicted since the download
+            pass
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Vector]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            vectors = executor.map(self._get, keys)
+        return {key: vector for key, vector in zip(keys, vectors) if vector is not None}
+
+    def put_many(self, vectors: dict[str, Vector]):
+        if not vectors:
+            return
+        self._ensure_container()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(
+                executor.map(
+                    lambda item: self.container_client.upload_blob(
+                        self._blob_name(item[0]), to_bytes(item[1]), overwrite=True
+                    ),
+                    vectors.items(),
+                )
+            )
+
+    def evict(self) -> int:
+        victims: list[str] = []
+        # Last-Modified is the last recorded access (see _touch)
+        blobs = sorted(self.container_client.list_blobs(), key=lambda blob: blob.last_modified)
+        if self.max_age_seconds is not None:
+            cutoff = datetime.now(UTC) - timedelta(seconds=self.max_age_seconds)
+            victims.extend(blob.name for blob in blobs if blob.creation_time < cutoff)
+            blobs = [blob for blob in blobs if blob.creation_time >= cutoff]
+        if self.max_bytes is not None:
+            total_bytes = sum(blob.size for blob in blobs)
+            for blob in blobs:
+                if total_bytes <= self.max_bytes:
+                    break
+                victims.append(blob.name)
+                total_bytes -= blob.size
+        removed = 0
+        for i in range(0, len(victims), 256):
+            batch = victims[i : i + 256]
+            # One missing or failing blob must not abort the batch, let alone the rest of the pass
+            responses = self.container_client.delete_blobs(*batch, raise_on_any_failure=False)
+            for name, response in zip(batch, responses):
+                if 200 <= response.status_code < 300:
+                    removed += 1
+                elif response.status_code != 404:
+                    # A 404 is a blob that is already gone, for example deleted by an overlapping pass
+                    logging.warning(
+                        f"Could not evict {name} from the embedding cache: {response.status_code} {response.reason}"
+                    )
+        return removed
+
+    def _ensure_container(self):
+        if self._container_checked:
+            return
+        try:
+            self.container_client.create_container()
+        except ResourceExistsError:
+            pass
+        self._container_checked = True
+
+
+@lru_cache(maxsize=1)
+def get_embedding_cache() -> EmbeddingCache:
+    backend = os.getenv("EMBEDDING_CACHE_BACKEND", "blob").lower()
+    max_bytes = os.getenv("EMBEDDING_CACHE_MAX_BYTES")
+    max_age_days = os.getenv("EMBEDDING_CACHE_MAX_AGE_DAYS", "30")
+    touch_interval_hours = os.getenv("EMBEDDING_CACHE_TOUCH_INTERVAL_HOURS", "24")
+    max_bytes = int(max_bytes) if max_bytes else None
+    max_age_seconds = float(max_age_days) * 86_400 if max_age_days else None
+
+    if backend == "none":
+        return NullEmbeddingCache()
+    if backend == "sqlite":
+        return SqliteEmbeddingCache(
+            os.getenv("EMBEDDING_CACHE_PATH", "embedding-cache.sqlite"), max_bytes, max_age_seconds
+        )
+    if backend == "blob":
+        account_name = os.getenv("SOURCE_STORAGE_ACCOUNT_NAME")
+        if not account_name:
+            raise ValueError("SOURCE_STORAGE_ACCOUNT_NAME is not set")
+        return BlobEmbeddingCache(
+            get_blob_service_client(account_name).get_container_client(
+                os.getenv("EMBEDDING_CACHE_CONTAINER_NAME", "embedding-cache")
+            ),
+            max_bytes,
+            max_age_seconds,
+            touch_interval_seconds=float(touch_interval_hours) * 3600 if touch_interval_hours else None,
+        )
+    raise ValueError(f"Unknown EMBEDDING_CACHE_BACKEND '{backend}'")
+
+
+@app.function_name(name="evict_embedding_cache")
+@app.timer_trigger(arg_name="timer", schedule="0 0 3 * * *", run_on_startup=False)
+def evict_embedding_cache(timer) -> None:
+    removed = get_embedding_cache().evict()
+    logging.info(f"Evicted {removed} entries from the embedding cache")
@@ -0,0 +1,122 @@
+"""
+In-process text extraction for formats that do not need Document Intelligence.
+
+Extractors are registered by content type and file extension. They read the document from a binary file object and
+return it as a list of page texts, the same `pages` structure produced by layout analysis. An extractor returns None
+when it cannot handle a particular document well, in which case `document_cracking` falls back to Document
+Intelligence.
+"""
+import json
+import os
+import re
+from collections.abc import Callable
+from html.parser import HTMLParser
+from typing import BinaryIO
+
+try:
+    import pypdf
+except ImportError:  # Optional; without it every PDF goes to Document Intelligence
+    pypdf = None
+
+Extractor = Callable[[BinaryIO], list[str] | None]
+
+_extractors_by_content_type: dict[str, Extractor] = {}
+_extractors_by_extension: dict[str, Extractor] = {}
+
+# PDFs with less text than this per page are treated as scanned
+MIN_PDF_CHARACTERS_PER_PAGE = 32
+
+
+def register_extractor(extractor: Extractor, content_types: list[str] = (), extensions: list[str] = ()):
+    for content_type in content_types:
+        _extractors_by_content_type[content_type.lower()] = extractor
+    for extension in extensions:
+        _extractors_by_extension[extension.lower()] = extractor
+
+
+def get_extractor(blob_name: str, content_type: str | None) -> Extractor | None:
+    """The extension decides first, as blobs are often uploaded with a generic content type."""
+    extension = os.path.splitext(blob_name)[1].lower()
+    if extension in _extractors_by_extension:
+        return _extractors_by_extension[extension]
+    if content_type:
+        return _extractors_by_content_type.get(content_type.split(";")[0].strip().lower())
+    return None
+
+
+def _decode(document_bytes: bytes) -> str:
+    if document_bytes.startswith(b"\xef\xbb\xbf"):
+        return document_bytes[3:].decode("utf-8", errors="replace")
+    if document_bytes.startswith((b"\xff\xfe", b"\xfe\xff")):
+        return document_bytes.decode("utf-16", errors="replace")
+    return document_bytes.decode("utf-8", errors="replace")
+
+
+def extract_text(document: BinaryIO) -> list[str] | None:
+    return [_decode(document.read())]
+
+
+class _HtmlTextParser(HTMLParser):
+    _BLOCK_TAGS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "section", "article", "pre"}
+    _SKIPPED_TAGS = {"script", "style", "head", "noscript", "template"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: list[str] = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag in self._BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self._SKIPPED_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+        elif tag in self._BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.parts.append(data)
+
+
+def extract_html(document: BinaryIO) -> list[str] | None:
+    parser = _HtmlTextParser()
+    parser.feed(_decode(document.read()))
+    parser.close()
+    text = re.sub(r"[ \t]+", " ", "".join(parser.parts))
+    return [re.sub(r"\n\s*\n+", "\n\n", text).strip()]
+
+
+def extract_json(document: BinaryIO) -> list[str] | None:
+    text = _decode(document.read())
+    try:
+        # Re-indented so that chunk boundaries fall between values rather than inside one long line
+        return [json.dumps(json.loads(text), indent=1, ensure_ascii=False)]
+    except ValueError:
+        return [text]
+
+
+def extract_pdf(document: BinaryIO) -> list[str] | None:
+    """Extracts the text layer of digitally generated PDFs; scanned or encrypted ones are left to layout analysis."""
+    try:
+        reader = pypdf.PdfReader(document)
+        if reader.is_encrypted:
+            return None
+        pages = [page.extract_text() or "" for page in reader.pages]
+    except Exception:
+        return None
+    if not pages or sum(len(page.strip()) for page in pages) < MIN_PDF_CHARACTERS_PER_PAGE * len(pages):
+        return None
+    return pages
+
+
+register_extractor(
+    extract_text, ["text/plain", "text/markdown", "text/csv"], [".txt", ".md", ".markdown", ".csv", ".log"]
+)
+register_extractor(extract_html, ["text/html", "application/xhtml+xml"], [".html", ".htm", ".xhtml"])
+register_extractor(extract_json, ["application/json"], [".json"])
+if pypdf is not None:
+    register_extractor(extract_pdf, ["application/pdf"], [".pdf"])
@@ -0,0 +1,67 @@
+import base64
+import json
+import logging
+import os
+import zlib
+from functools import lru_cache
+
+from application.clients import get_blob_service_client
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import ContainerClient
+
+
+class LayoutCache:
+    """
+    Persistent cache of extracted document pages, keyed by the content MD5 of the source blob and the analysis model.
+    Pages are stored as zlib-compressed JSON, one blob per document, so a document is only analyzed again when its
+    content or the model changes.
+    """
+
+    def __init__(self, container_client: ContainerClient | None):
+        self.container_client = container_client
+        self._container_checked = False
+
+    @staticmethod
+    def key(model_id: str, content_md5: str) -> str:
+        # content_md5 is base64, as reported by blob storage; hex keeps the blob name URL-safe
+        return f"{model_id}/{base64.b64decode(content_md5).hex()}.json.z"
+
+    def get(self, model_id: str, content_md5: str | None) -> list[str] | None:
+        if self.container_client is None or not content_md5:
+            return None
+        try:
+            data = self.container_client.download_blob(self.key(model_id, content_md5)).readall()
+        except ResourceNotFoundError:
+            return None
+        return json.loads(zlib.decompress(data))["pages"]
+
+    def put(self, model_id: str, content_md5: str | None, pages: list[str]):
+        if self.container_client is None or not content_md5:
+            return
+        self._ensure_container()
+        data = zlib.compress(json.dumps({"pages": pages}).encode("utf-8"), 6)
+        self.container_client.upload_blob(self.key(model_id, content_md5), data, overwrite=True)
+        logging.info(f"Cached layout of {len(pages)} pages in {len(data)} bytes")
+
+    def _ensure_container(self):
+        if self._container_checked:
+            return
+        try:
+            self.container_client.create_container()
+        except ResourceExistsError:
+            pass
+        self._container_checked = True
+
+
+@lru_cache(maxsize=1)
+def get_layout_cache() -> LayoutCache:
+    if os.getenv("LAYOUT_CACHE_ENABLED", "true").lower() != "true":
+        return LayoutCache(None)
+    account_name = os.getenv("SOURCE_STORAGE_ACCOUNT_NAME")
+    if not account_name:
+        raise ValueError("SOURCE_STORAGE_ACCOUNT_NAME is not set")
+    return LayoutCache(
+        get_blob_service_client(account_name).get_container_client(
+            os.getenv("LAYOUT_CACHE_CONTAINER_NAME", "layout-cache")
+        )
+    )
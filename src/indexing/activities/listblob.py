@@ -1,76 +1,173 @@
 # list_blobs_chunk_activity.py
 
+import asyncio
+import base64
 import os
-from functools import lru_cache
-from typing import Dict, List
-
-from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient
 
 from application.app import app
+from application.clients import get_async_blob_service_client
+from application.telemetry import span
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobProperties
+from azure.storage.blob.aio import BlobPrefix, ContainerClient
 
-credential = DefaultAzureCredential()
+# The most results the service returns per listing request
+MAX_PAGE_SIZE = 5000
 
 
-@lru_cache(maxsize=4)
-def _get_blob_service_client(account_name: str) -> BlobServiceClient:
-    if not account_name:
-        raise ValueError("SOURCE_STORAGE_ACCOUNT_NAME is not set")
-    return BlobServiceClient(
-        account_url=f"https://{account_name}.blob.core.windows.net/",
-        credential=credential,
-    )
+class BlobLister:
+    """
+    Lists a container under several prefixes at once.
+
+    The listing position is kept in a JSON-serializable state: the offset into the prefix list and a frontier of
+    open cursors, each a prefix with its continuation token. Up to `max_parallel` cursors are paged concurrently per
+    round. Cursors above `max_depth` are listed hierarchically with `delimiter`, so the virtual directories of a large
+    prefix become cursors of their own and are listed in parallel. Deeper cursors, and new cursors while the frontier
+    already holds `max_frontier` of them, are listed flat so that the state stays small.
+    """
+
+    def __init__(
+        self,
+        container_client: ContainerClient,
+        prefix_list: list[str],
+        max_parallel: int = 8,
+        max_depth: int = 2,
+        delimiter: str = "/",
+        max_frontier: int | None = None,
+    ):
+        self.container_client = container_client
+        self.prefix_list = prefix_list or [""]
+        self.max_parallel = max_parallel
+        self.max_depth = max_depth if delimiter else 0
+        self.delimiter = delimiter
+        self.max_frontier = max_frontier or max_parallel * 4
+
+    @staticmethod
+    def initial_state() -> dict:
+        return {"prefix_list_offset": 0, "cursors": []}
+
+    def is_done(self, state: dict) -> bool:
+        return not state["cursors"] and state["prefix_list_offset"] >= len(self.prefix_list)
+
+    def _fill_frontier(self, state: dict):
+        while len(state["cursors"]) < self.max_parallel and state["prefix_list_offset"] < len(self.prefix_list):
+            state["cursors"].append(
+                self._cursor(self.prefix_list[state["prefix_list_offset"]], 0, len(state["cursors"]))
+            )
+            state["prefix_list_offset"] += 1
+
+    def _cursor(self, prefix: str, depth: int, frontier_size: int) -> dict:
+        # Whether a cursor is listed hierarchically is fixed at creation, as the two kinds of continuation token differ
+        delimited = depth < self.max_depth and frontier_size < self.max_frontier
+        return {"prefix": prefix, "token": None, "depth": depth, "delimited": delimited}
+
+    async def _list_page(self, cursor: dict, page_size: int) -> tuple[list, list[str], str | None]:
+        """Returns the blobs and sub-prefixes of the cursor's next page, and the continuation token after it."""
+        if cursor["delimited"]:
+            items = self.container_client.walk_blobs(
+                name_starts_with=cursor["prefix"], delimiter=self.delimiter, results_per_page=page_size
+            )
+        else:
+            items = self.container_client.list_blobs(name_starts_with=cursor["prefix"], results_per_page=page_size)
+        pages = items.by_page(continuation_token=cursor["token"])
+        blobs, prefixes = [], []
+        async for page in pages:
+            async for item in page:
+                if isinstance(item, BlobPrefix):
+                    prefixes.append(item.name)
+                else:
+                    blobs.append(item)
+            return blobs, prefixes, pages.continuation_token
+        return blobs, prefixes, None
+
+    async def next_chunk(self, state: dict, page_size: int) -> list:
+        """
+        Advances up to `max_parallel` cursors by one page of `page_size` results each and returns the listed blobs.
+        Rounds that only discover sub-prefixes are repeated, so an empty result means the listing is done.
+        """
+        page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+        blobs = []
+        while not blobs and not self.is_done(state):
+            self._fill_frontier(state)
+            cursors = state["cursors"][: self.max_parallel]
+            pages = await asyncio.gather(*(self._list_page(cursor, page_size) for cursor in cursors))
+            remaining = state["cursors"][self.max_parallel :]
+            for cursor, (page_blobs, prefixes, token) in zip(cursors, pages):
+                blobs.extend(page_blobs)
+                if token:
+                    remaining.append({**cursor, "token": token})
+                for prefix in prefixes:
+                    remaining.append(self._cursor(prefix, cursor["depth"] + 1, len(remaining)))
+            state["cursors"] = remaining
+        return blobs
+
+
+def _blob_identifier(account_name: str, container_name: str, blob: BlobProperties) -> dict:
+    content_settings = blob.content_settings
+    content_md5 = content_settings.content_md5 if content_settings else None
+    return {
+        "account_name": account_name,
+        "container_name": container_name,
+        "blob_name": blob.name,
+        "etag": blob.etag,
+        "content_md5": base64.b64encode(content_md5).decode("ascii") if content_md5 else None,
+        "last_modified": blob.last_modified.isoformat() if blob.last_modified else None,
+        "size": blob.size,
+        "content_type": content_settings.content_type if content_settings else None,
+    }
+
 
 @app.function_name(name="list_blobs_chunk")
 @app.activity_trigger(input_name="params")
-def list_blobs_chunk(params: dict):
+async def list_blobs_chunk(params: dict):
     container_name = params.get("container_name")
-    continuation_token = params.get("continuation_token")
-    prefix_list_offset = params.get("prefix_list_offset", 0)
-    chunk_size = params.get("chunk_size", 1000)
-    prefix_list = params.get("prefix_list")
+    # Results per listing request; independent of how many documents the orchestrator processes at once
+    page_size = params.get("page_size") or int(os.getenv("LIST_PAGE_SIZE", "1000"))
     if not container_name:
         raise ValueError("container_name is required")
-    if not prefix_list:
-        prefix_list = [""]
-    
-    if len(prefix_list) <= prefix_list_offset:
-        return {
-            "blobs": [],
-            "continuation_token": None,
-            "prefix_list_offset": prefix_list_offset
-        }
 
     # Use connection string from Application Settings (local.settings.json for local dev)
     source_account_name = os.getenv("SOURCE_STORAGE_ACCOUNT_NAME")
-    source_blob_service_client = _get_blob_service_client(source_account_name)
-    container_client = source_blob_service_client.get_container_client(container_name)
-
-    # List blobs in a segment (page) using a continuation token
-    blob_identifiers: List[Dict[str, str]] = []
-    result_segment = container_client.list_blobs(
-        name_starts_with=prefix_list[prefix_list_offset],
-        results_per_page=chunk_size
+    if not source_account_name:
+        raise ValueError("SOURCE_STORAGE_ACCOUNT_NAME is not set")
+    source_blob_service_client = get_async_blob_service_client(source_account_name)
+    lister = BlobLister(
+        source_blob_service_client.get_container_client(container_name),
+        params.get("prefix_list"),
+        max_parallel=int(os.getenv("LIST_MAX_PARALLEL_PREFIXES", "8")),
+        max_depth=int(os.getenv("LIST_FANOUT_DEPTH", "2")),
+        delimiter=os.getenv("LIST_DELIMITER", "/"),
     )
+    listing_state = params.get("listing_state") or lister.initial_state()
 
-    new_continuation_token = None
-    pages = result_segment.by_page(continuation_token=continuation_token)
-    for page in pages:
-        for blob in page:
-            blob_identifiers.append(
-                {
-                    "account_name": source_account_name,
-                    "container_name": container_name,
-                    "blob_name": blob.name,
-                }
-            )
-        new_continuation_token = pages.continuation_token
-        if not new_continuation_token:
-            prefix_list_offset += 1
-        break
+    with span("list_blobs_chunk", params.get("scheduled_at"), container_name=container_name) as current:
+        blobs = await lister.next_chunk(listing_state, page_size)
+        current.set(blobs=len(blobs), open_cursors=len(listing_state["cursors"]))
+    blob_identifiers: list[dict[str, str]] = [
+        _blob_identifier(source_account_name, container_name, blob) for blob in blobs
+    ]
+    # Large documents first, so that small ones fill the gaps while they are processed
+    blob_identifiers.sort(key=lambda blob_identifier: blob_identifier["size"] or 0, reverse=True)
 
     return {
         "blobs": blob_identifiers,
-        "continuation_token": new_continuation_token,
-        "prefix_list_offset": prefix_list_offset
+        "listing_state": listing_state,
+        "done": lister.is_done(listing_state),
     }
+
+
+@app.function_name(name="get_blob_reference")
+@app.activity_trigger(input_name="params")
+async def get_blob_reference(params: dict) -> dict | None:
+    """Returns the reference of a single blob, as list_blobs_chunk would list it, or None if it no longer exists."""
+    source_account_name = os.getenv("SOURCE_STORAGE_ACCOUNT_NAME")
+    if not source_account_name:
+        raise ValueError("SOURCE_STORAGE_ACCOUNT_NAME is not set")
+    blob_client = get_async_blob_service_client(source_account_name).get_blob_client(
+        params["container_name"], params["blob_name"]
+    )
+    try:
+        properties = await blob_client.get_blob_properties()
+    except ResourceNotFoundError:
+        return None
+    return _blob_identifier(source_account_name, params["container_name"], properties)
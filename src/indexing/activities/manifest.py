@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from application.app import app
+from application.clients import get_blob_service_client
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import ContainerClient
+
+
+class ManifestStore:
+    """
+    Persistent record of which blobs have been indexed, keyed by the blob's ETag, content MD5 and last-modified
+    time, together with the chunk IDs that were uploaded for it. One manifest blob is kept per source blob and index.
+    """
+
+    def __init__(self, container_client: ContainerClient, max_workers: int = 16):
+        self.container_client = container_client
+        self.max_workers = max_workers
+        self._container_checked = False
+
+    @staticmethod
+    def entry_name(index_name: str, blob_reference: dict) -> str:
+        return f"{index_name}/{blob_reference['container_name']}/{blob_reference['blob_name']}.json"
+
+    def get(self, index_name: str, blob_reference: dict) -> dict | None:
+        blob_client = self.container_client.get_blob_client(self.entry_name(index_name, blob_reference))
+        try:
+            return json.loads(blob_client.download_blob().readall())
+        except ResourceNotFoundError:
+            return None
+
+    def get_many(self, index_name: str, blob_references: Iterable[dict]) -> list[dict | None]:
+        """The entries of the blobs in the same order, read with up to `max_workers` concurrent requests."""
+        blob_references = list(blob_references)
+        if len(blob_references) <= 1:
+            return [self.get(index_name, blob_reference) for blob_reference in blob_references]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(blob_references))) as executor:
+            return list(executor.map(lambda blob_reference: self.get(index_name, blob_reference), blob_references))
+
+    def put(self, index_name: str, blob_reference: dict, chunk_ids: list[str]):
+        self._ensure_container()
+        entry = {
+            "etag": blob_reference.get("etag"),
+            "content_md5": blob_reference.get("content_md5"),
+            "last_modified": blob_reference.get("last_modified"),
+            "chunk_ids": chunk_ids,
+        }
+        self.container_client.upload_blob(
+            self.entry_name(index_name, blob_reference), json.dumps(entry), overwrite=True
+        )
+
+    def delete(self, index_name: str, blob_reference: dict):
+        try:
+            self.container_client.delete_blob(self.entry_name(index_name, blob_reference))
+        except ResourceNotFoundError:
+            pass
+
+    def _ensure_container(self):
+        if self._container_checked:
+            return
+        try:
+            self.container_client.create_container()
+        except ResourceExistsError:
+            pass
+        self._container_checked = True
+
+
+def is_unchanged(blob_reference: dict, entry: dict | None) -> bool:
+    if entry is None:
+        return False
+    if blob_reference.get("content_md5") and entry.get("content_md5"):
+        return blob_reference["content_md5"] == entry["content_md5"]
+    if not blob_reference.get("etag"):
+        return False
+    return (
+        blob_reference["etag"] == entry.get("etag")
+        and blob_reference.get("last_modified") == entry.get("last_modified")
+    )
+
+
+@lru_cache(maxsize=4)
+def _get_manifest_store(account_name: str, container_name: str) -> ManifestStore:
+    if not account_name:
+        raise ValueError("SOURCE_STORAGE_ACCOUNT_NAME is not set")
+    return ManifestStore(get_blob_service_client(account_name).get_container_client(container_name))
+
+
+def get_manifest_store() -> ManifestStore:
+    return _get_manifest_store(
+        os.getenv("SOURCE_STORAGE_ACCOUNT_NAME"),
+        os.getenv("MANIFEST_CONTAINER_NAME", "index-manifest"),
+    )
+
+
+@app.function_name(name="filter_changed_blobs")
+@app.activity_trigger(input_name="params")
+def filter_changed_blobs(params: dict):
+    index_name = params["index_name"]
+    force = params.get("force", False)
+    store = get_manifest_store()
+
+    changed_blobs: list[dict] = []
+    entries = store.get_many(index_name, params["blobs"])
+    for blob_reference, entry in zip(params["blobs"], entries):
+        if not force and is_unchanged(blob_reference, entry):
+            continue
+        changed_blobs.append({
+            **blob_reference,
+            "previous_chunk_ids": entry.get("chunk_ids", []) if entry else [],
+        })
+
+    skipped = len(params["blobs"]) - len(changed_blobs)
+    logging.info(f"{len(changed_blobs)} changed blobs, {skipped} unchanged blobs skipped")
+    return {"blobs": changed_blobs, "skipped": skipped}
+
+
+@app.function_name(name="write_manifest")
+@app.activity_trigger(input_name="params")
+def write_manifest(params: dict):
+    get_manifest_store().put(params["index_name"], params["blob_reference"], params["chunk_ids"])
+
+
+@app.function_name(name="read_manifest")
+@app.activity_trigger(input_name="params")
+def read_manifest(params: dict) -> dict | None:
+    return get_manifest_store().get(params["index_name"], params["blob_reference"])
+
+
+@app.function_name(name="delete_manifest")
+@app.activity_trigger(input_name="params")
+def delete_manifest(params: dict):
+    get_manifest_store().delete(params["index_name"], params["blob_reference"])
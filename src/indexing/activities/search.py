@@ -1,14 +1,30 @@
-import base64
+import asyncio
+import hashlib
+import json
 import logging
 import os
+import random
 import re
-from typing import List, Union
+from urllib.parse import urlsplit
 
+from application.app import app
+from application.clients import get_async_credential, get_search_client, get_search_index_client
+from application.limits import THROTTLING_STATUS_CODES, AdaptiveLimiter, get_limiter
+from application.telemetry import count, span
+from azure.core.credentials import AzureKeyCredential
+from azure.core.credentials_async import AsyncTokenCredential
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.indexes.aio import SearchIndexClient
 from azure.search.documents.indexes.models import (
     AzureOpenAIVectorizer,
     AzureOpenAIVectorizerParameters,
+    BinaryQuantizationCompression,
     HnswAlgorithmConfiguration,
     HnswParameters,
+    RescoringOptions,
+    ScalarQuantizationCompression,
+    ScalarQuantizationParameters,
     SearchableField,
     SearchField,
     SearchFieldDataType,
@@ -21,16 +37,13 @@ from azure.search.documents.indexes.models import (
     VectorSearch,
     VectorSearchProfile,
 )
-from azure.search.documents.aio import SearchClient
-from azure.core.credentials import AzureKeyCredential
-from azure.core.credentials_async import AsyncTokenCredential
-from azure.search.documents.indexes.aio import SearchIndexClient
-from application.app import app
-from azure.identity import DefaultAzureCredential
-from urllib.parse import urlsplit
-from typing import List, Dict
 
-class AzureOpenAIEmbeddingConfig():
+from activities.claim_check import get_chunk_sets, get_claim_check_store
+from activities.vector_settings import VectorSettings, get_vector_settings
+from activities.vectors import as_vector
+
+
+class AzureOpenAIEmbeddingConfig:
     """
     Class for using Azure OpenAI embeddings
     To learn more please visit https://learn.microsoft.com/azure/ai-services/openai/concepts/understand-embeddings
@@ -38,7 +51,7 @@ class AzureOpenAIEmbeddingConfig():
 
     def __init__(
         self,
-        open_ai_deployment: Union[str, None],
+        open_ai_deployment: str | None,
         open_ai_model_name: str,
         open_ai_dimensions: int,
         open_ai_endpoint: str
@@ -50,14 +63,43 @@ class AzureOpenAIEmbeddingConfig():
 
 
 
+class UploadOptions:
+    """
+    Limits for bulk uploads to the search index
+    """
+
+    def __init__(
+        self,
+        max_batch_bytes: int = 12 * 1024 * 1024,
+        max_batch_size: int = 1000,
+        max_concurrency: int = 4,
+        max_attempts: int = 5,
+        limiter: AdaptiveLimiter | None = None,
+    ):
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        # Pass a shared limiter so that throttling seen by one activity slows down the others as well
+        self.limiter = limiter or AdaptiveLimiter("search", max_concurrency, max_limit=max_concurrency)
+
+
+# Statuses returned per document or per request that are worth retrying
+RETRIABLE_STATUS_CODES = {409, 422, 429, 500, 503}
+# Upper bound for a float32 value serialized as JSON, including the separator
+BYTES_PER_VECTOR_VALUE = 24
+
 logger = logging.getLogger("scripts")
+# Indexes known to exist, as (endpoint, index name), so each worker checks an index at most once
+_existing_indexes = set()
+
 class SearchInfo:
     """
     Class representing a connection to a search service
     To learn more, please visit https://learn.microsoft.com/azure/search/search-what-is-azure-search
     """
 
-    def __init__(self, endpoint: str, credential: Union[AsyncTokenCredential, AzureKeyCredential], index_name: str):
+    def __init__(self, endpoint: str, credential: AsyncTokenCredential | AzureKeyCredential, index_name: str):
         self.endpoint = endpoint
         self.credential = credential
         self.index_name = index_name
@@ -68,6 +110,14 @@ class SearchInfo:
     def create_search_index_client(self) -> SearchIndexClient:
         return SearchIndexClient(endpoint=self.endpoint, credential=self.credential)
 
+    def get_search_client(self) -> SearchClient:
+        """Returns the process-wide client for this index. It is shared between activities and must not be closed."""
+        return get_search_client(self.endpoint, self.index_name)
+
+    def get_search_index_client(self) -> SearchIndexClient:
+        """The process-wide index client of the service. It is shared between activities and must not be closed."""
+        return get_search_index_client(self.endpoint)
+
 
 
 class SearchManager:
@@ -80,169 +130,363 @@ class SearchManager:
         self,
         search_info: SearchInfo,
         embeddings: AzureOpenAIEmbeddingConfig,
+        upload_options: UploadOptions | None = None,
+        vector_settings: VectorSettings | None = None,
     ):
         self.search_info = search_info
         self.embeddings = embeddings
+        self.upload_options = upload_options or UploadOptions()
+        self.vector_settings = vector_settings or VectorSettings(
+            model_name=embeddings.open_ai_model_name, dimensions=embeddings.open_ai_dimensions)
+
+    def _vector_compressions(self) -> list:
+        settings = self.vector_settings
+        if settings.compression == "none":
+            return []
+        rescoring_options = RescoringOptions(
+            enable_rescoring=settings.rescore,
+            default_oversampling=settings.oversampling if settings.rescore else None,
+            rescore_storage_method="preserveOriginals" if settings.keep_originals else "discardOriginals",
+        )
+        if settings.compression == "scalar":
+            return [ScalarQuantizationCompression(
+                compression_name=settings.compression_name,
+                parameters=ScalarQuantizationParameters(quantized_data_type="int8"),
+                rescoring_options=rescoring_options,
+            )]
+        return [
+            BinaryQuantizationCompression(
+                compression_name=settings.compression_name, rescoring_options=rescoring_options
+            )
+        ]
+
+    def _check_vector_field(self, index: SearchIndex):
+        """An existing index cannot change its vector size, so a mismatch with the embedding settings is an error."""
+        field = next((field for field in index.fields if field.name == "embedding"), None)
+        if field is not None and field.vector_search_dimensions != self.vector_settings.dimensions:
+            raise ValueError(
+                f"Search index {index.name} has {field.vector_search_dimensions}-dimension vectors but the embedding "
+                f"settings produce {self.vector_settings.dimensions}; recreate the index or use another index name"
+            )
 
     async def create_index(self):
+        if (self.search_info.endpoint, self.search_info.index_name) in _existing_indexes:
+            return
         logger.info("Checking whether search index %s exists...", self.search_info.index_name)
 
-        async with self.search_info.create_search_index_client() as search_index_client:
-
-            if self.search_info.index_name not in [name async for name in search_index_client.list_index_names()]:
-                logger.info("Creating new search index %s", self.search_info.index_name)
-                fields = [
-                    SearchField(
-                        name="id",
-                        type="Edm.String",
-                        key=True,
-                        sortable=True,
-                        filterable=True,
-                        facetable=True,
-                        analyzer_name="keyword",
-                    ),
-                    SearchableField(
-                        name="content",
-                        type="Edm.String",
-                    ),
-                    SearchField(
-                        name="embedding",
-                        type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
-                        hidden=False,
-                        searchable=True,
-                        filterable=False,
-                        sortable=False,
-                        facetable=False,
-                        vector_search_dimensions=self.embeddings.open_ai_dimensions,
-                        vector_search_profile_name="embedding_config",
-                    ),
-                    SimpleField(
-                        name="sourcepages",
-                        type="Edm.String",
-                        filterable=True,
-                        facetable=True,
-                    ),
-                    SimpleField(
-                        name="sourcefile",
-                        type="Edm.String",
-                        filterable=True,
-                        facetable=True,
-                    ),
-                    SimpleField(
-                        name="storageUrl",
-                        type="Edm.String",
-                        filterable=True,
-                        facetable=False,
+        search_index_client = self.search_info.get_search_index_client()
+        if self.search_info.index_name not in [name async for name in search_index_client.list_index_names()]:
+            logger.info("Creating new search index %s", self.search_info.index_name)
+            fields = [
+                SearchField(
+                    name="id",
+                    type="Edm.String",
+                    key=True,
+                    sortable=True,
+                    filterable=True,
+                    facetable=True,
+                    analyzer_name="keyword",
+                ),
+                SearchableField(
+                    name="content",
+                    type="Edm.String",
+                ),
+                SearchField(
+                    name="embedding",
+                    type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
+                    # Vectors that are not stored cannot be returned in results
+                    hidden=not self.vector_settings.stored,
+                    stored=self.vector_settings.stored,
+                    searchable=True,
+                    filterable=False,
+                    sortable=False,
+                    facetable=False,
+                    vector_search_dimensions=self.vector_settings.dimensions,
+                    vector_search_profile_name="embedding_config",
+                ),
+                SimpleField(
+                    name="sourcepages",
+                    type="Edm.String",
+                    filterable=True,
+                    facetable=True,
+                ),
+                SimpleField(
+                    name="sourcefile",
+                    type="Edm.String",
+                    filterable=True,
+                    facetable=True,
+                ),
+                SimpleField(
+                    name="storageUrl",
+                    type="Edm.String",
+                    filterable=True,
+                    facetable=False,
+                ),
+            ]
+
+            vectorizers = []
+            vectorizers.append(
+                AzureOpenAIVectorizer(
+                    vectorizer_name=f"{self.search_info.index_name}-vectorizer",
+                    parameters=AzureOpenAIVectorizerParameters(
+                        resource_url=self.embeddings.open_ai_endpoint,
+                        deployment_name=self.embeddings.open_ai_deployment,
+                        model_name=self.embeddings.open_ai_model_name,
                     ),
-                ]
-
-                vectorizers = []
-                vectorizers.append(
-                    AzureOpenAIVectorizer(
-                        vectorizer_name=f"{self.search_info.index_name}-vectorizer",
-                        parameters=AzureOpenAIVectorizerParameters(
-                            resource_url=self.embeddings.open_ai_endpoint,
-                            deployment_name=self.embeddings.open_ai_deployment,
-                            model_name=self.embeddings.open_ai_model_name,
-                        ),
-                    )
                 )
+            )
 
-                index = SearchIndex(
-                    name=self.search_info.index_name,
-                    fields=fields,
-                    semantic_search=SemanticSearch(
-                        configurations=[
-                            SemanticConfiguration(
-                                name="default",
-                                prioritized_fields=SemanticPrioritizedFields(
-                                    title_field=None, content_fields=[SemanticField(field_name="content")]
-                                ),
-                            )
-                        ]
-                    ),
-                    vector_search=VectorSearch(
-                        algorithms=[
-                            HnswAlgorithmConfiguration(
-                                name="hnsw_config",
-                                parameters=HnswParameters(metric="cosine"),
-                            )
-                        ],
-                        profiles=[
-                            VectorSearchProfile(
-                                name="embedding_config",
-                                algorithm_configuration_name="hnsw_config",
-                                vectorizer_name=f"{self.search_info.index_name}-vectorizer",
+            index = SearchIndex(
+                name=self.search_info.index_name,
+                fields=fields,
+                semantic_search=SemanticSearch(
+                    configurations=[
+                        SemanticConfiguration(
+                            name="default",
+                            prioritized_fields=SemanticPrioritizedFields(
+                                title_field=None, content_fields=[SemanticField(field_name="content")]
                             ),
-                        ],
-                        vectorizers=vectorizers,
-                    ),
-                )
+                        )
+                    ]
+                ),
+                vector_search=VectorSearch(
+                    algorithms=[
+                        HnswAlgorithmConfiguration(
+                            name="hnsw_config",
+                            parameters=HnswParameters(metric="cosine"),
+                        )
+                    ],
+                    profiles=[
+                        VectorSearchProfile(
+                            name="embedding_config",
+                            algorithm_configuration_name="hnsw_config",
+                            vectorizer_name=f"{self.search_info.index_name}-vectorizer",
+                            compression_name=self.vector_settings.compression_name,
+                        ),
+                    ],
+                    vectorizers=vectorizers,
+                    compressions=self._vector_compressions(),
+                ),
+            )
 
-                await search_index_client.create_index(index)
-            else:
-                logger.info("Search index %s already exists", self.search_info.index_name)
+            await search_index_client.create_index(index)
+        else:
+            logger.info("Search index %s already exists", self.search_info.index_name)
+            self._check_vector_field(await search_index_client.get_index(self.search_info.index_name))
+        _existing_indexes.add((self.search_info.endpoint, self.search_info.index_name))
 
     async def update_content(
-        self, chunks_with_embeddings: List[dict],
-    ):
+        self,
+        chunks_with_embeddings: list[dict],
+    ) -> dict:
+        result = await self.update_contents([chunks_with_embeddings])
+        return {**result, "document_ids": result["document_ids"][0]}
+
+    async def update_contents(
+        self,
+        chunk_sets: list[list[dict]],
+    ) -> dict:
+        """
+        Uploads the chunks of one or more documents together, in batches sized by serialized bytes and several
+        batches at a time. Keys that fail with a transient status are retried with backoff; the result lists the
+        document IDs per chunk set and reports which keys were indexed and which were not.
+        """
+
+        def source_pages(section: dict) -> str:
+            if "page_spans" in section:
+                page_numbers = [page_number + 1 for page_number, _, _ in section["page_spans"]]
+            else:
+                page_numbers = range(section["start_page"] + 1, section["end_page"] + 2)
+            return f"{section['filename']}#pages={','.join([f'{i}' for i in page_numbers])}"
+
+        def storage_url_to_id(filename: str, storage_url: str):
+            # Blobs with the same file name in different folders or containers must not share chunk IDs
+            filename_ascii = re.sub("[^0-9a-zA-Z_-]", "_", filename)[:128]
+            url_hash = hashlib.sha256(storage_url.encode("utf-8")).hexdigest()[:32]
+
+            return f"file-{filename_ascii}-{url_hash}"
+
+        document_ids: list[list[str]] = []
+        documents: list[dict] = []
+        for chunks_with_embeddings in chunk_sets:
+            set_documents = []
+            for section_index, section in enumerate(chunks_with_embeddings):
+                storage_url = urlsplit(section["url"])._replace(query=None).geturl()
+                set_documents.append({
+                    "id": f"{storage_url_to_id(section['filename'], storage_url)}-chunk-{section_index}",
+                    "content": section["text"],
+                    "sourcepages": source_pages(section),
+                    "sourcefile": section["filename"],
+                    "storageUrl": storage_url,
+                    # Vectors stay float32 until here and are only expanded to floats for the JSON payload
+                    "embedding": as_vector(section["embedding"]).tolist(),
+                })
+            document_ids.append([document["id"] for document in set_documents])
+            documents.extend(set_documents)
+
+        search_client = self.search_info.get_search_client()
+        batch_results = await asyncio.gather(
+            *(self._upload_batch(search_client, batch) for batch in self._batch_by_size(documents))
+        )
+        failed_keys = [key for batch_failed_keys in batch_results for key in batch_failed_keys]
+        failed_key_set = set(failed_keys)
+        result = {
+            "document_ids": document_ids,
+            "succeeded": len(documents) - len(failed_key_set),
+            "failed": len(failed_key_set),
+            "failed_keys": failed_keys,
+            "bytes": sum(self._document_bytes(document) for document in documents),
+        }
+        logger.info(
+            "Uploaded %d documents to %s, %d failed", result["succeeded"], self.search_info.index_name, result["failed"]
+        )
+        return result
+
+    @staticmethod
+    def _document_bytes(document: dict) -> int:
+        # Vector numbers are estimated rather than serialized twice
+        return len(json.dumps({**document, "embedding": None})) + BYTES_PER_VECTOR_VALUE * len(document["embedding"])
+
+    def _batch_by_size(self, documents: list[dict]) -> list[list[dict]]:
+        batches: list[list[dict]] = []
+        current: list[dict] = []
+        current_bytes = 0
+        for document in documents:
+            document_bytes = self._document_bytes(document)
+            if current and (
+                current_bytes + document_bytes > self.upload_options.max_batch_bytes
+                or len(current) >= self.upload_options.max_batch_size
+            ):
+                batches.append(current)
+                current, current_bytes = [], 0
+            current.append(document)
+            current_bytes += document_bytes
+        if current:
+            batches.append(current)
+        return batches
+
+    async def _upload_batch(self, search_client: SearchClient, batch: list[dict]) -> list[str]:
+        """Uploads one batch and returns the keys that still failed after all retries."""
+        pending = batch
+        rejected_keys: list[str] = []
+        for attempt in range(1, self.upload_options.max_attempts + 1):
+            try:
+                # Requests over the size limit are split by the SDK itself
+                async with self.upload_options.limiter.async_slot():
+                    results = await search_client.upload_documents(pending)
+            except HttpResponseError as error:
+                if error.status_code in THROTTLING_STATUS_CODES:
+                    self.upload_options.limiter.throttled()
+                if error.status_code not in RETRIABLE_STATUS_CODES or attempt == self.upload_options.max_attempts:
+                    raise
+                logger.warning("Upload of %d documents failed with %s, retrying", len(pending), error.status_code)
+            else:
+                retriable_keys = set()
+                for result in results:
+                    if result.succeeded:
+                        continue
+                    if result.status_code in RETRIABLE_STATUS_CODES:
+                        retriable_keys.add(result.key)
+                    else:
+                        logger.error(
+                            "Document %s was rejected: %s %s", result.key, result.status_code, result.error_message
+                        )
+                        rejected_keys.append(result.key)
+                if any(result.status_code in THROTTLING_STATUS_CODES for result in results if not result.succeeded):
+                    self.upload_options.limiter.throttled()
+                pending = [document for document in pending if document["id"] in retriable_keys]
+                if not pending:
+                    return rejected_keys
+                logger.warning("%d documents failed transiently, retrying", len(pending))
+            if attempt < self.upload_options.max_attempts:
+                count("indexing.retries", stage="search")
+                await asyncio.sleep(min(30.0, 2 ** (attempt - 1)) * random.uniform(0.5, 1.0))
+        return rejected_keys + [document["id"] for document in pending]
+
+    async def remove_content(self, document_ids: list[str]):
         MAX_BATCH_SIZE = 1000
-        section_batches = [chunks_with_embeddings[i : i + MAX_BATCH_SIZE] for i in range(0, len(chunks_with_embeddings), MAX_BATCH_SIZE)]
-        
-        def filename_to_id(filename: str):
-            filename_ascii = re.sub("[^0-9a-zA-Z_-]", "_", filename)
-            filename_hash = base64.b16encode(filename.encode("utf-8")).decode("ascii")
-        
-            return f"file-{filename_ascii}-{filename_hash}"
-        async with self.search_info.create_search_client() as search_client:
-            for batch_index, batch in enumerate(section_batches):
-                documents = [
-                    {
-                        "id": f"{filename_to_id(section['filename'])}-chunk-{section_index + batch_index * MAX_BATCH_SIZE}",
-                        "content": section['text'],
-                        "sourcepages": f"{section['filename']}#pages={','.join([f'{i}' for i in range(section['start_page'] + 1, section['end_page'] + 2)])}",
-                        "sourcefile": section['filename'],
-                        "storageUrl": urlsplit(section['url'])._replace(query=None).geturl(),
-                        "embedding": section['embedding'],
-                    }
-                    for section_index, section in enumerate(batch)
-                ]
-
-                await search_client.upload_documents(documents)
-                
-                
+        search_client = self.search_info.get_search_client()
+        for i in range(0, len(document_ids), MAX_BATCH_SIZE):
+            await search_client.delete_documents(
+                [{"id": document_id} for document_id in document_ids[i : i + MAX_BATCH_SIZE]]
+            )
+
+
+def create_search_manager(index_name: str) -> SearchManager:
+    vector_settings = get_vector_settings()
+    return SearchManager(
+        SearchInfo(
+            endpoint=os.getenv("SEARCH_SERVICE_ENDPOINT"), credential=get_async_credential(), index_name=index_name
+        ),
+        AzureOpenAIEmbeddingConfig(
+            open_ai_dimensions=vector_settings.dimensions,
+            open_ai_deployment=vector_settings.deployment,
+            open_ai_model_name=vector_settings.model_name,
+            open_ai_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        ),
+        UploadOptions(
+            max_batch_bytes=int(os.getenv("SEARCH_UPLOAD_MAX_BATCH_BYTES", str(12 * 1024 * 1024))),
+            max_batch_size=int(os.getenv("SEARCH_UPLOAD_MAX_BATCH_SIZE", "1000")),
+            limiter=get_limiter("search"),
+        ),
+        vector_settings,
+    )
+
 
 @app.function_name(name="add_documents")
 @app.activity_trigger(input_name="documents")
-async def add_documents(documents: dict) -> List[str]:
-    searchManager = SearchManager(
-        SearchInfo(
-            endpoint=os.getenv("SEARCH_SERVICE_ENDPOINT"),
-            credential=DefaultAzureCredential(),
-            index_name=documents["index_name"]
-        ), AzureOpenAIEmbeddingConfig(
-            open_ai_dimensions=3072,
-            open_ai_deployment="embedding",
-            open_ai_model_name="text-embedding-3-large",
-            open_ai_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
+async def add_documents(documents: dict) -> dict:
+    with span("add_documents", documents.get("scheduled_at"), index_name=documents["index_name"]) as current:
+        searchManager = create_search_manager(documents["index_name"])
+        if documents.get("ensure_index"):
+            # Used by the event-driven path, which does not run ensure_index_exists; cached after the first call
+            await searchManager.create_index()
+        chunks = await asyncio.to_thread(get_claim_check_store().get, documents["chunks"])
+        result = await searchManager.update_content(chunks)
+        current.set(chunks=len(chunks), bytes_uploaded=result["bytes"], failed=result["failed"])
+        count("indexing.upload.bytes", result["bytes"])
+    if result["failed"]:
+        # Fail the activity so the document is retried rather than recorded as indexed
+        raise RuntimeError(
+            f"{result['failed']} of {len(result['document_ids'])} documents failed to upload: "
+            f"{result['failed_keys'][:10]}"
         )
-    )
-    await searchManager.update_content(documents["chunks"])
-    
+    return result
+
+
+@app.function_name(name="flush_documents")
+@app.activity_trigger(input_name="documents")
+async def flush_documents(documents: dict) -> dict:
+    """Uploads the buffered chunk sets of many documents in shared, full-sized batches."""
+    with span("flush_documents", documents.get("scheduled_at"), index_name=documents["index_name"]) as current:
+        searchManager = create_search_manager(documents["index_name"])
+        chunk_sets = await asyncio.to_thread(get_chunk_sets, documents["chunk_sets"])
+        result = await searchManager.update_contents(chunk_sets)
+        current.set(documents=len(chunk_sets), bytes_uploaded=result["bytes"], failed=result["failed"])
+        count("indexing.upload.bytes", result["bytes"])
+    if result["failed"]:
+        raise RuntimeError(
+            f"{result['failed']} of {result['succeeded'] + result['failed']} documents failed to upload: "
+            f"{result['failed_keys'][:10]}"
+        )
+    return result
+
+
+@app.function_name(name="remove_documents")
+@app.activity_trigger(input_name="documents")
+async def remove_documents(documents: dict):
+    with span(
+        "remove_documents",
+        documents.get("scheduled_at"),
+        index_name=documents["index_name"],
+        chunks=len(documents["document_ids"]),
+    ):
+        searchManager = create_search_manager(documents["index_name"])
+        await searchManager.remove_content(documents["document_ids"])
+
+
 @app.function_name(name="ensure_index_exists")
 @app.activity_trigger(input_name="name")
-async def ensure_index_exists(name: str) -> List[str]:
-    searchManager = SearchManager(
-        SearchInfo(
-            endpoint=os.getenv("SEARCH_SERVICE_ENDPOINT"),
-            credential=DefaultAzureCredential(),
-            index_name=name
-        ), AzureOpenAIEmbeddingConfig(
-            open_ai_dimensions=3072,
-            open_ai_deployment="embedding",
-            open_ai_model_name="text-embedding-3-large",
-            open_ai_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-        )
-    )
+async def ensure_index_exists(name: str) -> list[str]:
+    searchManager = create_search_manager(name)
     await searchManager.create_index()
-    
\ No newline at end of file
@@ -0,0 +1,87 @@
+"""
+Embedding model and vector compression settings, shared by the embedding activity and the index schema.
+
+The embedding activity requests vectors of `dimensions` from the model, and `SearchManager.create_index` declares the
+same number of dimensions on the embedding field, so the two cannot drift apart. Compression only changes how the
+search service stores and searches the vectors; the uploaded documents stay the same.
+"""
+import os
+from functools import lru_cache
+
+COMPRESSION_KINDS = ("none", "scalar", "binary")
+# Models that can return shortened vectors through the `dimensions` request parameter
+MODEL_DIMENSIONS = {"text-embedding-3-large": 3072, "text-embedding-3-small": 1536, "text-embedding-ada-002": 1536}
+
+
+class VectorSettings:
+    """
+    Settings for the `embedding` vector field
+    To learn more, please visit https://learn.microsoft.com/azure/search/vector-search-how-to-configure-compression-storage
+    """
+
+    def __init__(
+        self,
+        model_name: str = "text-embedding-3-large",
+        deployment: str = "embedding",
+        dimensions: int | None = None,
+        compression: str = "none",
+        rescore: bool = True,
+        oversampling: float = 4.0,
+        keep_originals: bool = True,
+        stored: bool = True,
+    ):
+        if compression not in COMPRESSION_KINDS:
+            raise ValueError(
+                f"Unknown VECTOR_COMPRESSION '{compression}', expected one of {', '.join(COMPRESSION_KINDS)}"
+            )
+        native_dimensions = MODEL_DIMENSIONS.get(model_name)
+        if dimensions is None:
+            if native_dimensions is None:
+                raise ValueError(f"EMBEDDING_DIMENSIONS must be set for model '{model_name}'")
+            dimensions = native_dimensions
+        if native_dimensions is not None and dimensions > native_dimensions:
+            raise ValueError(f"{model_name} returns at most {native_dimensions} dimensions, not {dimensions}")
+        if (
+            native_dimensions is not None
+            and dimensions != native_dimensions
+            and not model_name.startswith("text-embedding-3")
+        ):
+            raise ValueError(f"{model_name} cannot return shortened vectors")
+        if rescore and compression == "scalar" and not keep_originals:
+            # Without the originals, only binary vectors can be rescored (against the full-precision query)
+            raise ValueError("Rescoring scalar-quantized vectors needs VECTOR_KEEP_ORIGINALS=true")
+        self.model_name = model_name
+        self.deployment = deployment
+        self.dimensions = dimensions
+        self.native_dimensions = native_dimensions
+        self.compression = compression
+        self.rescore = rescore
+        self.oversampling = oversampling
+        self.keep_originals = keep_originals
+        self.stored = stored
+
+    @property
+    def request_dimensions(self) -> int | None:
+        """The `dimensions` to send with embedding requests, or None to use the model's own size."""
+        if self.model_name.startswith("text-embedding-3") and self.dimensions != self.native_dimensions:
+            return self.dimensions
+        return None
+
+    @property
+    def compression_name(self) -> str | None:
+        return None if self.compression == "none" else f"{self.compression}_compression"
+
+
+@lru_cache(maxsize=1)
+def get_vector_settings() -> VectorSettings:
+    dimensions = os.getenv("EMBEDDING_DIMENSIONS")
+    return VectorSettings(
+        model_name=os.getenv("EMBEDDING_MODEL_NAME", "text-embedding-3-large"),
+        deployment=os.getenv("EMBEDDING_DEPLOYMENT", "embedding"),
+        dimensions=int(dimensions) if dimensions else None,
+        compression=os.getenv("VECTOR_COMPRESSION", "none").lower(),
+        rescore=os.getenv("VECTOR_RESCORE", "true").lower() == "true",
+        oversampling=float(os.getenv("VECTOR_OVERSAMPLING", "4")),
+        keep_originals=os.getenv("VECTOR_KEEP_ORIGINALS", "true").lower() == "true",
+        stored=os.getenv("VECTOR_STORED", "true").lower() == "true",
+    )
@@ -0,0 +1,34 @@
+import base64
+from array import array
+from collections.abc import Sequence
+
+# Embeddings are kept as float32 arrays from the OpenAI response to the search upload. Between activities they travel
+# either as raw bytes (claim checks, cache) or as base64 strings (inline JSON), and only become Python floats when the
+# search documents are serialized.
+Vector = array
+
+
+def from_bytes(data: bytes) -> Vector:
+    return array("f", data)
+
+
+def to_bytes(vector: Vector | Sequence[float]) -> bytes:
+    if not isinstance(vector, array):
+        vector = array("f", vector)
+    return vector.tobytes()
+
+
+def from_base64(data: str) -> Vector:
+    return from_bytes(base64.b64decode(data))
+
+
+def to_base64(vector: Vector | Sequence[float]) -> str:
+    return base64.b64encode(to_bytes(vector)).decode("ascii")
+
+
+def as_vector(value: Vector | Sequence[float] | str) -> Vector:
+    if isinstance(value, array):
+        return value
+    if isinstance(value, str):
+        return from_base64(value)
+    return array("f", value)
@@ -0,0 +1,123 @@
+"""
+Process-wide Azure clients shared by all activities.
+
+Creating a credential or client per invocation costs a token acquisition and a TLS handshake for every document.
+Clients created here live for the lifetime of the worker process and keep their connections alive between
+invocations. Async clients are bound to the worker's event loop, so they must only be requested from async activities.
+"""
+import os
+from functools import lru_cache
+
+import aiohttp
+import httpx
+import requests
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient as AsyncDocumentIntelligenceClient
+from azure.core.pipeline.transport import AioHttpTransport, RequestsTransport
+from azure.identity import DefaultAzureCredential
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+from azure.identity.aio import get_bearer_token_provider
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.indexes.aio import SearchIndexClient
+from azure.storage.blob import BlobServiceClient
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
+
+MAX_CONNECTIONS = int(os.getenv("CLIENT_MAX_CONNECTIONS", "64"))
+KEEPALIVE_SECONDS = float(os.getenv("CLIENT_KEEPALIVE_SECONDS", "120"))
+
+
+@lru_cache(maxsize=1)
+def get_credential() -> DefaultAzureCredential:
+    return DefaultAzureCredential()
+
+
+@lru_cache(maxsize=1)
+def get_async_credential() -> AsyncDefaultAzureCredential:
+    return AsyncDefaultAzureCredential()
+
+
+@lru_cache(maxsize=1)
+def _get_requests_transport() -> RequestsTransport:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=MAX_CONNECTIONS, pool_maxsize=MAX_CONNECTIONS)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return RequestsTransport(session=session, session_owner=False)
+
+
+@lru_cache(maxsize=1)
+def _get_aiohttp_transport() -> AioHttpTransport:
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS, keepalive_timeout=KEEPALIVE_SECONDS),
+    )
+    return AioHttpTransport(session=session, session_owner=False)
+
+
+@lru_cache(maxsize=4)
+def get_blob_service_client(account_name: str) -> BlobServiceClient:
+    if not account_name:
+        raise ValueError("Storage account name is not set")
+    return BlobServiceClient(
+        account_url=f"https://{account_name}.blob.core.windows.net/",
+        credential=get_credential(),
+        transport=_get_requests_transport(),
+    )
+
+
+@lru_cache(maxsize=4)
+def get_async_blob_service_client(account_name: str) -> AsyncBlobServiceClient:
+    if not account_name:
+        raise ValueError("Storage account name is not set")
+    return AsyncBlobServiceClient(
+        account_url=f"https://{account_name}.blob.core.windows.net/",
+        credential=get_async_credential(),
+        transport=_get_aiohttp_transport(),
+    )
+
+
+@lru_cache(maxsize=1)
+def get_async_document_client(endpoint: str) -> AsyncDocumentIntelligenceClient:
+    if not endpoint:
+        raise ValueError("DI_ENDPOINT is not set")
+    return AsyncDocumentIntelligenceClient(endpoint, get_async_credential(), transport=_get_aiohttp_transport())
+
+
+@lru_cache(maxsize=1)
+def get_openai_client(endpoint: str) -> AsyncAzureOpenAI:
+    if not endpoint:
+        raise ValueError("AZURE_OPENAI_ENDPOINT is not set")
+    return AsyncAzureOpenAI(
+        api_version="2024-02-15-preview",
+        azure_endpoint=endpoint,
+        azure_ad_token_provider=get_bearer_token_provider(
+            get_async_credential(), "https://cognitiveservices.azure.com/.default"
+        ),
+        # Retries are handled per batch by the EmbeddingBatcher
+        max_retries=0,
+        http_client=DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_SECONDS,
+            ),
+        ),
+    )
+
+
+@lru_cache(maxsize=16)
+def get_search_client(endpoint: str, index_name: str) -> SearchClient:
+    if not endpoint:
+        raise ValueError("SEARCH_SERVICE_ENDPOINT is not set")
+    return SearchClient(
+        endpoint=endpoint,
+        index_name=index_name,
+        credential=get_async_credential(),
+        transport=_get_aiohttp_transport(),
+    )
+
+
+@lru_cache(maxsize=1)
+def get_search_index_client(endpoint: str) -> SearchIndexClient:
+    if not endpoint:
+        raise ValueError("SEARCH_SERVICE_ENDPOINT is not set")
+    return SearchIndexClient(endpoint=endpoint, credential=get_async_credential(), transport=_get_aiohttp_transport())
@@ -0,0 +1,233 @@
+"""
+Process-wide concurrency and rate budgets for the external services called by activities.
+
+Each stage (Document Intelligence, OpenAI embeddings, Search uploads) gets its own AdaptiveLimiter, so throttling on
+one service does not hold back the others. Limits adapt AIMD-style: every successful call raises the concurrency limit
+a little, every throttled call cuts it by a factor. The budgets apply to one worker process; with several instances
+each instance keeps its own.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from functools import cache
+
+# Statuses services use to signal that the caller should slow down
+THROTTLING_STATUS_CODES = {429, 503}
+
+
+class TokenBucket:
+    """
+    Budget of units (requests or tokens) per second, refilled continuously, with a burst of one second's worth.
+
+    A request larger than the burst is let through once the bucket is full and leaves it in debt, so the requests
+    after it wait until the whole request has been paid for and the average rate stays within the budget.
+    """
+
+    def __init__(self, units_per_second: float):
+        self.max_rate = units_per_second
+        self.rate = units_per_second
+        self.available = units_per_second
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.available = min(self.rate, self.available + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_take(self, units: float) -> float:
+        """Takes the units and returns 0, or returns the number of seconds to wait before trying again."""
+        self._refill(time.monotonic())
+        required = min(units, self.rate)
+        if self.available >= required:
+            self.available -= units
+            return 0.0
+        return (required - self.available) / self.rate
+
+
+class _ThreadWaiter:
+    def __init__(self):
+        self._event = threading.Event()
+
+    def notify(self):
+        self._event.set()
+
+    def wait(self, timeout: float | None):
+        self._event.wait(timeout)
+        self._event.clear()
+
+
+class _TaskWaiter:
+    def __init__(self):
+        # Slots are released from other threads and event loops too
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+
+    def notify(self):
+        self._loop.call_soon_threadsafe(self._event.set)
+
+    async def wait(self, timeout: float | None):
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except TimeoutError:
+            pass
+        self._event.clear()
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit with an optional rate budget, adjusted by additive increase / multiplicative decrease.
+
+    Usable from threads (`slot`) and from coroutines (`async_slot`). Callers report throttling with `throttled()`;
+    successful slots count as successes automatically. Waiting callers are served first come, first served: they
+    queue up and only the first one in the queue takes a slot, woken when a slot is released, so a large request is
+    not overtaken by smaller ones that fit the rate budget sooner.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial_limit: int,
+        min_limit: int = 1,
+        max_limit: int | None = None,
+        units_per_second: float | None = None,
+        decrease_factor: float = 0.5,
+        cooldown_seconds: float = 5.0,
+    ):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit or initial_limit * 4
+        self.limit = float(min(initial_limit, self.max_limit))
+        self.bucket = TokenBucket(units_per_second) if units_per_second else None
+        self.decrease_factor = decrease_factor
+        self.cooldown_seconds = cooldown_seconds
+        self.in_flight = 0
+        self.throttle_count = 0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        self._waiters = deque()
+
+    def _try_acquire(self, units: float, waiter) -> float | None:
+        """
+        Takes a slot for the waiter and returns 0, returns the seconds to wait for the rate budget, or returns None
+        to wait until the waiter is notified.
+        """
+        with self._lock:
+            if waiter not in self._waiters:
+                self._waiters.append(waiter)
+            if self._waiters[0] is not waiter or self.in_flight >= int(self.limit):
+                return None
+            if self.bucket is not None:
+                wait = self.bucket.try_take(units)
+                if wait:
+                    return wait
+            self._waiters.popleft()
+            self.in_flight += 1
+            # The next waiter may fit as well
+            self._notify_first()
+            return 0.0
+
+    def _abandon(self, waiter):
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                self._notify_first()
+
+    def _notify_first(self):
+        if self._waiters:
+            self._waiters[0].notify()
+
+    def _release(self, succeeded: bool):
+        with self._lock:
+            self.in_flight -= 1
+            if succeeded:
+                # Roughly +1 on the limit per limit-many successes
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                if self.bucket is not None:
+                    self.bucket.rate = min(self.bucket.max_rate, self.bucket.rate + self.bucket.max_rate / 100)
+            self._notify_first()
+
+    def throttled(self):
+        """Cuts the limits, at most once per cooldown so that a burst of 429s counts as one signal."""
+        with self._lock:
+            self.throttle_count += 1
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown_seconds:
+                return
+            self._last_decrease = now
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            if self.bucket is not None:
+                self.bucket.rate = max(self.bucket.max_rate / 100, self.bucket.rate * self.decrease_factor)
+        logging.warning(f"{self.name} throttled, concurrency limit lowered to {int(self.limit)}")
+
+    @contextmanager
+    def slot(self, units: float = 1):
+        waiter = _ThreadWaiter()
+        try:
+            while (wait := self._try_acquire(units, waiter)) != 0:
+                waiter.wait(wait)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            self._release(succeeded)
+
+    @asynccontextmanager
+    async def async_slot(self, units: float = 1):
+        waiter = _TaskWaiter()
+        try:
+            while (wait := self._try_acquire(units, waiter)) != 0:
+                await waiter.wait(wait)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            self._release(succeeded)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "limit": int(self.limit),
+                "max_limit": self.max_limit,
+                "units_per_second": self.bucket.rate if self.bucket is not None else None,
+                "throttled": self.throttle_count,
+            }
+
+
+# Stage name -> (environment variable prefix, default concurrency, rate variable, divisor to units per second)
+_STAGES = {
+    "document_cracking": ("CRACKING", 8, "CRACKING_REQUESTS_PER_SECOND", 1),
+    "embedding": ("EMBEDDING", 4, "EMBEDDING_TOKENS_PER_MINUTE", 60),
+    "search": ("SEARCH_UPLOAD", 4, None, 1),
+}
+
+
+@cache
+def get_limiter(stage: str) -> AdaptiveLimiter:
+    if stage not in _STAGES:
+        raise ValueError(f"Unknown stage '{stage}'")
+    prefix, default_concurrency, rate_variable, rate_divisor = _STAGES[stage]
+    initial_limit = int(os.getenv(f"{prefix}_CONCURRENCY", str(default_concurrency)))
+    max_limit = os.getenv(f"{prefix}_MAX_CONCURRENCY")
+    rate = os.getenv(rate_variable) if rate_variable else None
+    return AdaptiveLimiter(
+        stage,
+        initial_limit,
+        max_limit=int(max_limit) if max_limit else None,
+        units_per_second=float(rate) / rate_divisor if rate else None,
+    )
+
+
+def snapshot() -> dict[str, dict]:
+    return {stage: get_limiter(stage).snapshot() for stage in _STAGES}
@@ -0,0 +1,146 @@
+"""
+Tracing and metrics for the indexing activities.
+
+Spans and metrics go through OpenTelemetry when it is installed and an exporter is configured:
+OTEL_EXPORTER_OTLP_ENDPOINT sends them to an OTLP collector, TELEMETRY_CONSOLE=true prints them to stdout. Without
+OpenTelemetry, every span still ends with one structured log line carrying its duration and attributes, which
+Application Insights picks up as custom dimensions.
+"""
+import logging
+import os
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from datetime import UTC, datetime
+from functools import lru_cache
+from typing import Any
+
+try:
+    from opentelemetry import metrics, trace
+except ImportError:  # Optional; spans and metrics are logged instead
+    metrics = None
+    trace = None
+
+SERVICE_NAME = "indexing"
+
+
+@lru_cache(maxsize=1)
+def _configure() -> bool:
+    """Installs the SDK providers once per process. Returns whether OpenTelemetry is in use."""
+    if trace is None:
+        return False
+    otlp_endpoint = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+    console = os.getenv("TELEMETRY_CONSOLE", "false").lower() == "true"
+    if not otlp_endpoint and not console:
+        # A provider may still have been installed by the host, e.g. azure-monitor-opentelemetry
+        return True
+    from opentelemetry.sdk.metrics import MeterProvider
+    from opentelemetry.sdk.metrics.export import ConsoleMetricExporter, PeriodicExportingMetricReader
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+    resource = Resource.create({"service.name": SERVICE_NAME})
+    tracer_provider = TracerProvider(resource=resource)
+    if otlp_endpoint:
+        from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        span_exporter, metric_exporter = OTLPSpanExporter(), OTLPMetricExporter()
+    else:
+        span_exporter, metric_exporter = ConsoleSpanExporter(), ConsoleMetricExporter()
+    tracer_provider.add_span_processor(BatchSpanProcessor(span_exporter))
+    trace.set_tracer_provider(tracer_provider)
+    metrics.set_meter_provider(
+        MeterProvider(resource=resource, metric_readers=[PeriodicExportingMetricReader(metric_exporter)])
+    )
+    return True
+
+
+@lru_cache(maxsize=1)
+def _instruments() -> dict[str, Any] | None:
+    if not _configure():
+        return None
+    meter = metrics.get_meter(SERVICE_NAME)
+    return {
+        "tracer": trace.get_tracer(SERVICE_NAME),
+        "duration": meter.create_histogram("indexing.stage.duration", unit="ms"),
+        "queue_wait": meter.create_histogram("indexing.stage.queue_wait", unit="ms"),
+        "counters": {},
+        "meter": meter,
+    }
+
+
+class Span:
+    """Collects attributes for a stage; forwarded to the OpenTelemetry span when there is one."""
+
+    def __init__(self, name: str, attributes: dict[str, Any], otel_span=None):
+        self.name = name
+        self.attributes = attributes
+        self._otel_span = otel_span
+
+    def set(self, **attributes: Any):
+        for key, value in attributes.items():
+            if value is None:
+                continue
+            self.attributes[key] = value
+            if self._otel_span is not None:
+                self._otel_span.set_attribute(f"indexing.{key}", value)
+
+
+def queue_wait_seconds(scheduled_at: str | None) -> float | None:
+    """Time between the orchestrator scheduling an activity (ISO timestamp in its input) and the activity starting."""
+    if not scheduled_at:
+        return None
+    scheduled = datetime.fromisoformat(scheduled_at)
+    if scheduled.tzinfo is None:
+        scheduled = scheduled.replace(tzinfo=UTC)
+    return max(0.0, (datetime.now(UTC) - scheduled).total_seconds())
+
+
+@contextmanager
+def span(stage: str, scheduled_at: str | None = None, **attributes: Any) -> Iterator[Span]:
+    """
+    Traces one stage of the pipeline and records its duration. Works in sync and async activities alike.
+    Pass the `scheduled_at` timestamp from the activity input to also record how long the activity was queued.
+    """
+    instruments = _instruments()
+    queue_wait = queue_wait_seconds(scheduled_at)
+    start = time.perf_counter()
+    otel_context = instruments["tracer"].start_as_current_span(stage) if instruments else None
+    otel_span = otel_context.__enter__() if otel_context is not None else None
+    current = Span(stage, {}, otel_span)
+    current.set(**attributes, queue_wait_ms=round(queue_wait * 1000) if queue_wait is not None else None)
+    failed = False
+    try:
+        yield current
+    except BaseException as error:
+        failed = True
+        current.set(error=type(error).__name__)
+        if otel_context is not None:
+            otel_context.__exit__(type(error), error, error.__traceback__)
+            otel_context = None
+        raise
+    finally:
+        duration_ms = (time.perf_counter() - start) * 1000
+        if otel_context is not None:
+            otel_context.__exit__(None, None, None)
+        if instruments:
+            instruments["duration"].record(duration_ms, {"stage": stage, "failed": failed})
+            if queue_wait is not None:
+                instruments["queue_wait"].record(queue_wait * 1000, {"stage": stage})
+        logging.info(
+            f"{stage} {'failed' if failed else 'completed'} in {duration_ms:.0f} ms",
+            extra={"custom_dimensions": {"stage": stage, "duration_ms": round(duration_ms), **current.attributes}},
+        )
+
+
+def count(name: str, value: float = 1, **attributes: Any):
+    """Adds to a counter such as indexing.retries, indexing.tokens or indexing.upload.bytes."""
+    instruments = _instruments()
+    if not instruments:
+        return
+    counter = instruments["counters"].get(name)
+    if counter is None:
+        counter = instruments["counters"][name] = instruments["meter"].create_counter(name)
+    counter.add(value, attributes)
@@ -0,0 +1,552 @@
+"""
+In-process stand-ins for Blob Storage, Document Intelligence, Azure OpenAI and AI Search.
+
+Each fake implements only the client surface the activities use, adds a configurable latency per call and can
+throttle a share of calls with the same errors the real SDKs raise. FakeEmbeddingServer serves the embeddings
+endpoint over local HTTP instead, for OpenAI clients pointed at it with `base_url`.
+"""
+import asyncio
+import base64
+import hashlib
+import random
+import socket
+from array import array
+from dataclasses import dataclass, field
+from datetime import UTC, datetime
+from types import SimpleNamespace
+
+import httpx
+from aiohttp import web
+from azure.core.exceptions import (
+    HttpResponseError,
+    ODataV4Format,
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+)
+from azure.storage.blob import PartialBatchErrorException
+from azure.storage.blob.aio import BlobPrefix
+from openai import RateLimitError
+
+# Separates pages in synthetic documents; the fake layout analysis splits on it
+PAGE_BREAK = "\f"
+# Vocabulary of the synthetic corpora
+WORDS = ("index", "search", "vector", "document", "page", "chunk", "embedding", "latency", "azure", "pipeline",
+         "throughput", "storage", "model", "query", "result", "field", "layout", "table", "figure", "section")
+
+
+@dataclass
+class ServiceProfile:
+    """
+    Latency of one call in seconds, with uniform jitter, and the share of calls that are throttled. The first
+    `throttle_first` calls are always throttled, for tests that need a deterministic retry.
+    """
+
+    latency: float = 0.0
+    jitter: float = 0.0
+    throttle_rate: float = 0.0
+    throttle_first: int = 0
+    calls: int = 0
+    throttled: int = 0
+
+    async def call(self, random_source: random.Random) -> bool:
+        """Waits for the call latency; returns False if the call should be throttled."""
+        self.calls += 1
+        call_number = self.calls
+        await asyncio.sleep(max(0.0, self.latency + random_source.uniform(-self.jitter, self.jitter)))
+        if call_number <= self.throttle_first or random_source.random() < self.throttle_rate:
+            self.throttled += 1
+            return False
+        return True
+
+
+def _throttled_error() -> HttpResponseError:
+    error = HttpResponseError(message="Too many requests (fake)")
+    error.status_code = 429
+    return error
+
+
+def bad_request_error(code: str, message: str) -> HttpResponseError:
+    """A 400 response of Document Intelligence, with the specific error in the inner error like the service."""
+    error = HttpResponseError(message=message)
+    error.status_code = 400
+    error.error = ODataV4Format(
+        {"code": "InvalidArgument", "message": "Invalid argument.", "innererror": {"code": code, "message": message}}
+    )
+    return error
+
+
+@dataclass
+class FakeBlob:
+    name: str
+    data: bytes
+    content_type: str
+    last_modified: datetime = field(default_factory=lambda: datetime.now(UTC))
+
+    @property
+    def properties(self):
+        return SimpleNamespace(
+            name=self.name,
+            etag=hashlib.sha1(self.data).hexdigest(),
+            size=len(self.data),
+            last_modified=self.last_modified,
+            content_settings=SimpleNamespace(
+                content_md5=hashlib.md5(self.data).digest(), content_type=self.content_type
+            ),
+        )
+
+
+class _AsyncPages:
+    def __init__(
+        self,
+        items: list,
+        page_size: int,
+        continuation_token: str | None,
+        profile: ServiceProfile,
+        random_source: random.Random,
+    ):
+        self._items = items
+        self._page_size = page_size
+        self._offset = int(continuation_token or 0)
+        self._profile = profile
+        self._random = random_source
+        self.continuation_token = continuation_token
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._offset >= len(self._items) and self._offset > 0:
+            raise StopAsyncIteration
+        await self._profile.call(self._random)
+        page = self._items[self._offset : self._offset + self._page_size]
+        self._offset += self._page_size
+        self.continuation_token = str(self._offset) if self._offset < len(self._items) else None
+        return _aiter(page)
+
+
+async def _aiter(items: list):
+    for item in items:
+        yield item
+
+
+class _AsyncPaged:
+    def __init__(self, items: list, page_size: int, profile: ServiceProfile, random_source: random.Random):
+        self._items = items
+        self._page_size = page_size
+        self._profile = profile
+        self._random = random_source
+
+    def by_page(self, continuation_token: str | None = None) -> _AsyncPages:
+        return _AsyncPages(self._items, self._page_size, continuation_token, self._profile, self._random)
+
+
+class _FakeDownloader:
+    def __init__(self, data: bytes, chunk_size: int = 4 * 1024 * 1024):
+        self._data = data
+        self._chunk_size = chunk_size
+
+    async def chunks(self):
+        for offset in range(0, len(self._data), self._chunk_size):
+            yield self._data[offset : offset + self._chunk_size]
+
+    async def readall(self) -> bytes:
+        return self._data
+
+
+class FakeBlobClient:
+    def __init__(self, store: "FakeBlobStore", container_name: str, blob_name: str):
+        self._store = store
+        self.account_name = "fake"
+        self.container_name = container_name
+        self.blob_name = blob_name
+        self.url = f"https://fake.blob.core.windows.net/{container_name}/{blob_name}"
+
+    def _blob(self) -> FakeBlob:
+        blob = self._store.containers.get(self.container_name, {}).get(self.blob_name)
+        if blob is None:
+            raise ResourceNotFoundError(f"{self.blob_name} not found (fake)")
+        return blob
+
+    async def download_blob(self, **kwargs) -> _FakeDownloader:
+        if not await self._store.profile.call(self._store.random):
+            raise _throttled_error()
+        return _FakeDownloader(self._blob().data)
+
+    async def get_blob_properties(self):
+        await self._store.profile.call(self._store.random)
+        return self._blob().properties
+
+
+class FakeContainerClient:
+    def __init__(self, store: "FakeBlobStore", container_name: str):
+        self._store = store
+        self.container_name = container_name
+
+    def list_blobs(self, name_starts_with: str = "", results_per_page: int = 5000, **kwargs) -> _AsyncPaged:
+        blobs = sorted(
+            (
+                blob
+                for name, blob in self._store.containers.get(self.container_name, {}).items()
+                if name.startswith(name_starts_with or "")
+            ),
+            key=lambda blob: blob.name,
+        )
+        return _AsyncPaged(
+            [blob.properties for blob in blobs], results_per_page, self._store.profile, self._store.random
+        )
+
+    def walk_blobs(
+        self, name_starts_with: str = "", delimiter: str = "/", results_per_page: int = 5000, **kwargs
+    ) -> _AsyncPaged:
+        """Lists the blobs directly under the prefix and a BlobPrefix per virtual directory, in name order."""
+        name_starts_with = name_starts_with or ""
+        items = {}
+        for name, blob in self._store.containers.get(self.container_name, {}).items():
+            if not name.startswith(name_starts_with):
+                continue
+            rest = name[len(name_starts_with) :]
+            if delimiter in rest:
+                prefix = name_starts_with + rest.split(delimiter, 1)[0] + delimiter
+                items.setdefault(prefix, BlobPrefix(None, prefix=prefix))
+            else:
+                items[name] = blob.properties
+        return _AsyncPaged(
+            [items[name] for name in sorted(items)], results_per_page, self._store.profile, self._store.random
+        )
+
+    def get_blob_client(self, blob_name: str) -> FakeBlobClient:
+        return FakeBlobClient(self._store, self.container_name, blob_name)
+
+
+@dataclass
+class MemoryBlob:
+    data: bytes
+    etag: str
+    creation_time: datetime
+    last_modified: datetime
+    metadata: dict = field(default_factory=dict)
+
+
+class _MemoryBlobClient:
+    def __init__(self, container: "MemoryContainerClient", name: str):
+        self._container = container
+        self._name = name
+
+    def download_blob(self, **kwargs):
+        return self._container.download_blob(self._name, **kwargs)
+
+    def set_blob_metadata(self, metadata: dict, **kwargs):
+        blob = self._container._blob(self._name)
+        self._container.metadata_writes += 1
+        blob.metadata = dict(metadata)
+        blob.last_modified = self._container.now
+
+
+class MemoryContainerClient:
+    """
+    Synchronous ContainerClient for the blob-backed caches and indexes, kept in memory without any latency. Blobs
+    carry an ETag, metadata and creation and Last-Modified times taken from `now`, which tests move forward. Uploads
+    honour `overwrite` and an ETag condition, and missing blobs raise the SDK's errors.
+    """
+
+    def __init__(self):
+        self.blobs: dict[str, MemoryBlob] = {}
+        self.now = datetime(2026, 1, 1, tzinfo=UTC)
+        self.uploads = 0
+        self.downloads = 0
+        self.metadata_writes = 0
+        self._versions = 0
+
+    def _blob(self, name: str) -> MemoryBlob:
+        if name not in self.blobs:
+            raise ResourceNotFoundError(f"{name} not found (fake)")
+        return self.blobs[name]
+
+    def _properties(self, name: str) -> SimpleNamespace:
+        blob = self._blob(name)
+        return SimpleNamespace(
+            name=name,
+            size=len(blob.data),
+            etag=blob.etag,
+            creation_time=blob.creation_time,
+            last_modified=blob.last_modified,
+            metadata=blob.metadata,
+        )
+
+    def create_container(self):
+        pass
+
+    def upload_blob(
+        self,
+        name: str,
+        data: bytes | str,
+        overwrite: bool = False,
+        metadata: dict | None = None,
+        etag: str | None = None,
+        **kwargs,
+    ):
+        if not overwrite and name in self.blobs:
+            raise ResourceExistsError(f"{name} already exists (fake)")
+        if etag is not None and (name not in self.blobs or self.blobs[name].etag != etag):
+            raise ResourceModifiedError(f"{name} was modified (fake)")
+        self.uploads += 1
+        self._versions += 1
+        data = data.encode() if isinstance(data, str) else bytes(data)
+        self.blobs[name] = MemoryBlob(data, f'"{self._versions}"', self.now, self.now, dict(metadata or {}))
+
+    def download_blob(self, name: str, **kwargs):
+        properties = self._properties(name)
+        self.downloads += 1
+        data = self.blobs[name].data
+        return SimpleNamespace(readall=lambda: data, chunks=lambda: iter([data]), properties=properties)
+
+    def get_blob_client(self, name: str) -> _MemoryBlobClient:
+        return _MemoryBlobClient(self, name)
+
+    def list_blobs(self, name_starts_with: str | None = None, **kwargs) -> list[SimpleNamespace]:
+        return [self._properties(name) for name in sorted(self.blobs) if name.startswith(name_starts_with or "")]
+
+    def delete_blob(self, name: str, **kwargs):
+        self._blob(name)
+        del self.blobs[name]
+
+    def delete_blobs(self, *names: str, raise_on_any_failure: bool = True, **kwargs) -> list[SimpleNamespace]:
+        """Deletes the blobs like a batch request, with one response per blob: 202 if deleted, 404 if missing."""
+        responses = []
+        for name in names:
+            found = self.blobs.pop(name, None) is not None
+            responses.append(
+                SimpleNamespace(status_code=202 if found else 404, reason="Accepted" if found else "BlobNotFound")
+            )
+        failed = [response for response in responses if response.status_code != 202]
+        if failed and raise_on_any_failure:
+            raise PartialBatchErrorException("There is a partial failure in the batch operation.", None, failed)
+        return responses
+
+
+class FakeBlobStore:
+    """Stands in for the async BlobServiceClient, with flat and hierarchical listing."""
+
+    def __init__(self, profile: ServiceProfile, random_source: random.Random):
+        self.profile = profile
+        self.random = random_source
+        self.containers: dict[str, dict[str, FakeBlob]] = {}
+
+    def add(self, container_name: str, blob: FakeBlob):
+        self.containers.setdefault(container_name, {})[blob.name] = blob
+
+    def get_container_client(self, container_name: str) -> FakeContainerClient:
+        return FakeContainerClient(self, container_name)
+
+    def get_blob_client(self, container_name: str, blob_name: str) -> FakeBlobClient:
+        return FakeBlobClient(self, container_name, blob_name)
+
+
+class _FakePoller:
+    def __init__(self, result, analysis_seconds: float):
+        self._result = result
+        self._analysis_seconds = analysis_seconds
+
+    async def result(self):
+        await asyncio.sleep(self._analysis_seconds)
+        return self._result
+
+
+class FakeDocumentClient:
+    """
+    Stands in for the async DocumentIntelligenceClient. Documents are read from the request body, or from the
+    blob store for URL sources, and split into pages on PAGE_BREAK. The profile latency applies to submitting the
+    request, and the analysis itself takes `latency_per_page` per page.
+    """
+
+    def __init__(
+        self, store: FakeBlobStore, profile: ServiceProfile, random_source: random.Random, latency_per_page: float = 0.0
+    ):
+        self._store = store
+        self._profile = profile
+        self._random = random_source
+        self._latency_per_page = latency_per_page
+
+    async def begin_analyze_document(self, model_id: str, body, pages: str | None = None, **kwargs) -> _FakePoller:
+        if not await self._profile.call(self._random):
+            raise _throttled_error()
+        if hasattr(body, "read"):
+            data = body.read()
+        else:
+            container_name, blob_name = body.url_source.split("?")[0].split(".net/", 1)[1].split("/", 1)
+            data = self._store.containers[container_name][blob_name].data
+        texts = data.decode("utf-8").split(PAGE_BREAK)
+        numbered = list(enumerate(texts, start=1))
+        if pages:
+            first_page, last_page = (int(number) for number in pages.split("-"))
+            if first_page > len(texts):
+                raise bad_request_error(
+                    "InvalidParameter", "The parameter pages is invalid: The page range is out of range (fake)."
+                )
+            numbered = numbered[first_page - 1 : last_page]
+        result = SimpleNamespace(
+            pages=[
+                SimpleNamespace(page_number=number, lines=[{"content": line} for line in text.split("\n")])
+                for number, text in numbered
+            ]
+        )
+        return _FakePoller(result, self._latency_per_page * len(numbered))
+
+
+class _FakeEmbeddings:
+    def __init__(self, client: "FakeOpenAIClient"):
+        self._client = client
+
+    async def create(
+        self,
+        input: list[str],  # noqa: A002 - the keyword of the OpenAI API
+        model: str,
+        encoding_format: str = "float",
+        dimensions: int | None = None,
+        **kwargs,
+    ):
+        client = self._client
+        if not await client.profile.call(client.random):
+            raise RateLimitError(
+                "Rate limit exceeded (fake)",
+                response=httpx.Response(
+                    429,
+                    request=httpx.Request("POST", "https://fake.openai.azure.com/"),
+                    headers={"retry-after-ms": "100"},
+                ),
+                body=None,
+            )
+        await asyncio.sleep(client.latency_per_1k_tokens * sum(len(text) for text in input) / 4000)
+        dimensions = dimensions or client.dimensions
+        return SimpleNamespace(
+            data=[
+                SimpleNamespace(index=index, embedding=fake_embedding(text, dimensions))
+                for index, text in enumerate(input)
+            ]
+        )
+
+
+def fake_embedding(text: str, dimensions: int) -> str:
+    """The base64 float32 vector the fakes return for a text, deterministic so cache and dedup behaviour shows."""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector_random = random.Random(seed)
+    vector = array("f", (vector_random.uniform(-1, 1) for _ in range(dimensions)))
+    return base64.b64encode(vector.tobytes()).decode("ascii")
+
+
+class FakeOpenAIClient:
+    """Stands in for AsyncAzureOpenAI; returns base64 float32 vectors, as the service does for base64 encoding."""
+
+    def __init__(
+        self,
+        profile: ServiceProfile,
+        random_source: random.Random,
+        dimensions: int = 3072,
+        latency_per_1k_tokens: float = 0.0,
+    ):
+        self.profile = profile
+        self.random = random_source
+        self.dimensions = dimensions
+        self.latency_per_1k_tokens = latency_per_1k_tokens
+        self.embeddings = _FakeEmbeddings(self)
+
+
+class FakeEmbeddingServer:
+    """
+    Local OpenAI-compatible HTTP server for the embeddings endpoint, for clients created with `base_url`. Throttled
+    requests, as decided by the profile, are answered with 429 and the Retry-After headers Azure OpenAI sends:
+    `retry_after_ms` as retry-after-ms and `retry_after` as retry-after, each left out when None. The JSON body of
+    every request is kept in `requests`.
+
+        async with FakeEmbeddingServer(ServiceProfile(throttle_first=1)) as server:
+            client = AsyncOpenAI(base_url=server.base_url, api_key="fake", max_retries=0)
+    """
+
+    def __init__(
+        self,
+        profile: ServiceProfile,
+        random_source: random.Random | None = None,
+        dimensions: int = 3072,
+        retry_after_ms: int | None = 100,
+        retry_after: str | None = None,
+    ):
+        self.profile = profile
+        self.random = random_source or random.Random(0)
+        self.dimensions = dimensions
+        self.retry_after_ms = retry_after_ms
+        self.retry_after = retry_after
+        self.requests: list[dict] = []
+        self.base_url = None
+        self._runner = None
+
+    async def _embeddings(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.requests.append(body)
+        if not await self.profile.call(self.random):
+            headers = {}
+            if self.retry_after_ms is not None:
+                headers["retry-after-ms"] = str(self.retry_after_ms)
+            if self.retry_after is not None:
+                headers["retry-after"] = self.retry_after
+            error = {"error": {"code": "429", "message": "Rate limit exceeded (fake)"}}
+            return web.json_response(error, status=429, headers=headers)
+        dimensions = body.get("dimensions") or self.dimensions
+        texts = [body["input"]] if isinstance(body["input"], str) else body["input"]
+        return web.json_response(
+            {
+                "object": "list",
+                "model": body["model"],
+                "data": [
+                    {"object": "embedding", "index": index, "embedding": fake_embedding(text, dimensions)}
+                    for index, text in enumerate(texts)
+                ],
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            }
+        )
+
+    async def __aenter__(self) -> "FakeEmbeddingServer":
+        application = web.Application()
+        application.router.add_post("/embeddings", self._embeddings)
+        self._runner = web.AppRunner(application)
+        await self._runner.setup()
+        # A socket bound to a free port, so the URL is known before the site starts
+        server_socket = socket.socket()
+        server_socket.bind(("127.0.0.1", 0))
+        await web.SockSite(self._runner, server_socket).start()
+        self.base_url = f"http://127.0.0.1:{server_socket.getsockname()[1]}"
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._runner.cleanup()
+        return False
+
+
+class FakeSearchClient:
+    """Stands in for the async SearchClient; throttled uploads fail per document with status 429, like the service."""
+
+    def __init__(self, profile: ServiceProfile, random_source: random.Random):
+        self._profile = profile
+        self._random = random_source
+        self.documents: dict[str, dict] = {}
+
+    async def upload_documents(self, documents: list[dict]):
+        throttled = not await self._profile.call(self._random)
+        results = []
+        for document in documents:
+            if throttled:
+                results.append(
+                    SimpleNamespace(
+                        key=document["id"], succeeded=False, status_code=429, error_message="Throttled (fake)"
+                    )
+                )
+            else:
+                self.documents[document["id"]] = document
+                results.append(SimpleNamespace(key=document["id"], succeeded=True, status_code=201, error_message=None))
+        return results
+
+    async def delete_documents(self, documents: list[dict]):
+        await self._profile.call(self._random)
+        for document in documents:
+            self.documents.pop(document["id"], None)
+        return []
@@ -0,0 +1,302 @@
+"""
+Microbenchmarks of single steps of the indexing pipeline, without any service fakes. Each scenario prints one JSON
+object with sizes and the fastest time of --repeat runs. Run from src/indexing:
+
+    python -m benchmarks.micro claim-check --chunks 1000 --dimensions 3072
+
+Scenarios:
+    claim-check   the chunks of a document with embeddings as inline JSON in orchestration history, against the
+                  claim-check blob and the reference that replaces them
+    vectors       the embeddings of a document as JSON lists of floats, against float32 arrays passed as base64
+    chunker       chunking a document with a new chunker per call (cold), against the cached one (warm); the
+                  default gpt2 tokenizer is downloaded from Hugging Face, so use --tokenizer character offline
+    clients       search uploads to a local HTTPS server through a new SearchClient per activity call, against
+                  the cached client of application/clients.py; needs openssl to create a self-signed certificate
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import ssl
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from array import array
+from collections.abc import Callable
+
+from activities import chunking
+from activities.claim_check import ClaimCheckStore, decode, encode
+from activities.vectors import from_base64, to_base64
+from aiohttp import web
+from application import clients
+from azure.core.credentials import AccessToken
+from azure.search.documents.aio import SearchClient
+
+from benchmarks.fakes import WORDS, MemoryContainerClient
+
+
+def best_of(call: Callable, repeat: int) -> tuple[object, float]:
+    """The result of `call` and its fastest time in milliseconds of `repeat` runs."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = call()
+        timings.append(time.perf_counter() - start)
+    return result, round(min(timings) * 1000, 2)
+
+
+def synthetic_chunks(count: int, dimensions: int, chunk_chars: int, random_source: random.Random) -> list[dict]:
+    """Chunks as the embedding activity returns them, with embeddings as lists of floats like the OpenAI response."""
+    chunks = []
+    for i in range(count):
+        text = ""
+        while len(text) < chunk_chars:
+            text += " ".join(random_source.choice(WORDS) for _ in range(12)) + ". "
+        chunks.append(
+            {
+                "filename": "report.pdf",
+                "url": "https://account.blob.core.windows.net/source/report.pdf",
+                "text": text[:chunk_chars],
+                "start_page": i // 4,
+                "end_page": i // 4,
+                "page_spans": [[i // 4, 0, chunk_chars]],
+                "token_count": chunk_chars // 4,
+                "embedding": [random_source.gauss(0, 0.02) for _ in range(dimensions)],
+            }
+        )
+    return chunks
+
+
+def claim_check_scenario(args) -> dict:
+    chunks = synthetic_chunks(args.chunks, args.dimensions, args.chunk_chars, random.Random(args.seed))
+    inline, dumps_ms = best_of(lambda: json.dumps(chunks), args.repeat)
+    _, loads_ms = best_of(lambda: json.loads(inline), args.repeat)
+    blob, encode_ms = best_of(lambda: encode(chunks), args.repeat)
+    _, decode_ms = best_of(lambda: decode(blob), args.repeat)
+    reference = ClaimCheckStore(MemoryContainerClient(), min_bytes=0).put(chunks)
+    return {
+        "scenario": "claim-check",
+        "chunks": args.chunks,
+        "dimensions": args.dimensions,
+        "inline_json_bytes": len(inline.encode("utf-8")),
+        "inline_dumps_ms": dumps_ms,
+        "inline_loads_ms": loads_ms,
+        "claim_check_blob_bytes": len(blob),
+        "claim_check_encode_ms": encode_ms,
+        "claim_check_decode_ms": decode_ms,
+        "history_reference_bytes": len(json.dumps(reference).encode("utf-8")),
+    }
+
+
+def allocated_bytes(build: Callable) -> int:
+    """Bytes still allocated by the result of `build`, as traced by tracemalloc."""
+    tracemalloc.start()
+    try:
+        result = build()
+        allocated, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return allocated
+
+
+def vectors_scenario(args) -> dict:
+    random_source = random.Random(args.seed)
+    vectors = [[random_source.gauss(0, 0.02) for _ in range(args.dimensions)] for _ in range(args.chunks)]
+    as_json, json_dumps_ms = best_of(lambda: json.dumps(vectors), args.repeat)
+    _, json_loads_ms = best_of(lambda: json.loads(as_json), args.repeat)
+    arrays = [array("f", vector) for vector in vectors]
+    as_base64, base64_encode_ms = best_of(lambda: [to_base64(vector) for vector in arrays], args.repeat)
+    _, base64_decode_ms = best_of(lambda: [from_base64(data) for data in as_base64], args.repeat)
+    return {
+        "scenario": "vectors",
+        "chunks": args.chunks,
+        "dimensions": args.dimensions,
+        "json_bytes": len(as_json),
+        "base64_bytes": sum(len(data) for data in as_base64),
+        "float32_bytes": sum(len(vector) * vector.itemsize for vector in arrays),
+        # Memory held by the decoded vectors of the document
+        "float_lists_memory_bytes": allocated_bytes(lambda: json.loads(as_json)),
+        "float32_arrays_memory_bytes": allocated_bytes(lambda: [from_base64(data) for data in as_base64]),
+        "json_dumps_ms": json_dumps_ms,
+        "json_loads_ms": json_loads_ms,
+        "base64_encode_ms": base64_encode_ms,
+        "base64_decode_ms": base64_decode_ms,
+    }
+
+
+def synthetic_text(characters: int, random_source: random.Random) -> str:
+    text = ""
+    while len(text) < characters:
+        text += " ".join(random_source.choice(WORDS) for _ in range(random_source.randint(6, 20))) + ". "
+    return text[:characters]
+
+
+def chunker_scenario(args) -> dict:
+    random_source = random.Random(args.seed)
+    documents = [synthetic_text(args.chunk_chars * 10, random_source) for _ in range(args.documents)]
+    settings = {"tokenizer": args.tokenizer}
+
+    def per_document_ms(cold: bool) -> list[float]:
+        timings = []
+        for document in documents:
+            if cold:
+                chunking._get_chunker.cache_clear()
+            start = time.perf_counter()
+            chunking.get_chunker(settings).chunk(document)
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    cold = per_document_ms(cold=True)
+    chunking.get_chunker(settings)
+    warm = per_document_ms(cold=False)
+    return {
+        "scenario": "chunker",
+        "tokenizer": args.tokenizer,
+        "documents": args.documents,
+        "document_chars": args.chunk_chars * 10,
+        "cold_p50_ms": round(statistics.median(cold), 2),
+        "cold_max_ms": round(max(cold), 2),
+        "warm_p50_ms": round(statistics.median(warm), 2),
+        "warm_max_ms": round(max(warm), 2),
+    }
+
+
+def _self_signed_certificate(directory: str) -> tuple[str, str]:
+    certificate, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out", certificate,
+            "-days", "1", "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1",
+        ],  # fmt: skip
+        check=True,
+        capture_output=True,
+    )
+    return certificate, key
+
+
+class _StaticTokenCredential:
+    """Async token credential with a fixed token, so no token is acquired while the requests are timed."""
+
+    async def get_token(self, *scopes, **kwargs) -> AccessToken:
+        return AccessToken("token", int(time.time()) + 3600)
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+async def _upload_latencies(args, certificate: str, key: str) -> dict:
+    async def handle(request: web.Request) -> web.Response:
+        documents = (await request.json())["value"]
+        results = [{"key": document["id"], "status": True, "statusCode": 201} for document in documents]
+        return web.json_response({"value": results})
+
+    application = web.Application()
+    application.router.add_post("/indexes('{index}')/docs/search.index", handle)
+    runner = web.AppRunner(application)
+    await runner.setup()
+    server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_context.load_cert_chain(certificate, key)
+    # A socket bound to a free port, so the URL is known before the site starts
+    server_socket = socket.socket()
+    server_socket.bind(("127.0.0.1", 0))
+    await web.SockSite(runner, server_socket, ssl_context=server_context).start()
+    endpoint = f"https://127.0.0.1:{server_socket.getsockname()[1]}"
+    credential = _StaticTokenCredential()
+    documents = [{"id": str(i), "text": "x" * 1000} for i in range(10)]
+
+    async def timed_upload(search_client: SearchClient) -> float:
+        start = time.perf_counter()
+        # The certificate is self-signed; the TLS handshake still happens without verifying it
+        await search_client.upload_documents(documents, connection_verify=False)
+        return (time.perf_counter() - start) * 1000
+
+    original_credential = clients.get_async_credential
+    clients.get_async_credential = lambda: credential
+    try:
+        new_client = []
+        for _ in range(args.requests):
+            # A client created per activity call has its own transport, so it opens a new connection every time
+            start = time.perf_counter()
+            async with SearchClient(endpoint, "benchmark", credential) as search_client:
+                await timed_upload(search_client)
+            new_client.append((time.perf_counter() - start) * 1000)
+        # The process-wide client of application/clients.py, as the search activities get it
+        await timed_upload(clients.get_search_client(endpoint, "benchmark"))
+        cached_client = [
+            await timed_upload(clients.get_search_client(endpoint, "benchmark")) for _ in range(args.requests)
+        ]
+    finally:
+        clients.get_async_credential = original_credential
+        clients.get_search_client.cache_clear()
+        await clients._get_aiohttp_transport().session.close()
+        clients._get_aiohttp_transport.cache_clear()
+        await runner.cleanup()
+    return {"new_client": new_client, "cached_client": cached_client}
+
+
+def clients_scenario(args) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        certificate, key = _self_signed_certificate(directory)
+        latencies = asyncio.run(_upload_latencies(args, certificate, key))
+    return {
+        "scenario": "clients",
+        "requests": args.requests,
+        **{
+            f"{name}_{statistic}_ms": round(function(values), 3)
+            for name, values in latencies.items()
+            for statistic, function in (("p50", statistics.median), ("max", max))
+        },
+    }
+
+
+SCENARIOS = {
+    "claim-check": claim_check_scenario,
+    "vectors": vectors_scenario,
+    "chunker": chunker_scenario,
+    "clients": clients_scenario,
+}
+
+
+def parse_args(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)}; default: all")
+    parser.add_argument("--chunks", type=int, default=1000)
+    parser.add_argument("--chunk-chars", type=int, default=2000)
+    parser.add_argument("--dimensions", type=int, default=3072)
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--tokenizer", default="gpt2")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results as a JSON list to this file")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    return args
+
+
+def main(argv: list[str] = None):
+    args = parse_args(argv)
+    results = []
+    for name in args.scenarios or SCENARIOS:
+        results.append(SCENARIOS[name](args))
+        print(json.dumps(results[-1]))
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Page lookups of the chunking activity: the PageIndex prefix sums with bisect against the linear walk over the page
+list that get_page_number did before. Chunks are laid over a synthetic document, and the start and end page of every
+chunk are looked up with both. Needs nothing beyond the standard library. Run from src/indexing:
+
+    python -m benchmarks.pages --pages 5000 --chunk-chars 2000
+"""
+import argparse
+import json
+import random
+import time
+
+from activities.chunking import PageIndex
+
+
+def linear_page_number(position: int, pages: list[str]) -> int:
+    """The lookup that chunking used before PageIndex, kept as the reference."""
+    position -= 1
+    for page_number, page_content in enumerate(pages):
+        if position < len(page_content):
+            return page_number
+        position -= len(page_content)
+    raise ValueError("Position out of range")
+
+
+def synthetic_pages(count: int, random_source: random.Random) -> list[str]:
+    return ["x" * random_source.randint(500, 4000) for _ in range(count)]
+
+
+def chunk_bounds(total_chars: int, chunk_chars: int, overlap_chars: int) -> list[tuple[int, int]]:
+    step = chunk_chars - overlap_chars
+    return [(start, min(start + chunk_chars, total_chars)) for start in range(0, total_chars, step)]
+
+
+def best_of(lookups, repeat: int) -> tuple[list, float]:
+    """The result of `lookups` and its fastest time of `repeat` runs, which is the least disturbed by other load."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = lookups()
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+def run(args) -> dict:
+    pages = synthetic_pages(args.pages, random.Random(args.seed))
+    bounds = chunk_bounds(sum(len(page) for page in pages), args.chunk_chars, args.overlap_chars)
+
+    def linear_lookups():
+        return [(linear_page_number(first, pages), linear_page_number(end, pages)) for first, end in bounds]
+
+    def indexed_lookups():
+        page_index = PageIndex(pages)
+        return [(page_index.page_number(first), page_index.page_number(end)) for first, end in bounds]
+
+    linear, linear_seconds = best_of(linear_lookups, args.repeat)
+    indexed, indexed_seconds = best_of(indexed_lookups, args.repeat)
+
+    if indexed != linear:
+        raise AssertionError("PageIndex and the linear lookup disagree")
+    return {
+        "pages": args.pages,
+        "chunks": len(bounds),
+        "lookups": 2 * len(bounds),
+        "linear_ms": round(linear_seconds * 1000, 2),
+        "page_index_ms": round(indexed_seconds * 1000, 2),
+        "speedup": round(linear_seconds / indexed_seconds, 1),
+    }
+
+
+def parse_args(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description="Compares PageIndex with the linear page lookup")
+    parser.add_argument("--pages", type=int, default=5000)
+    parser.add_argument("--chunk-chars", type=int, default=2000)
+    parser.add_argument("--overlap-chars", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="Report the fastest of this many runs of each lookup")
+    parser.add_argument("--output", help="Write the result as JSON to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] = None):
+    args = parse_args(argv)
+    result = run(args)
+    print(
+        f"{result['pages']} pages, {result['lookups']} lookups: linear {result['linear_ms']} ms, "
+        f"PageIndex {result['page_index_ms']} ms ({result['speedup']}x)"
+    )
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
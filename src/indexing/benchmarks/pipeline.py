@@ -0,0 +1,291 @@
+"""
+End-to-end benchmark of the indexing activities against the in-process fakes in `benchmarks.fakes`.
+
+Runs list_blobs_chunk -> document_cracking -> chunking -> embedding -> add_documents for a synthetic corpus, with
+up to --parallel documents in flight as the orchestrator would keep them, and reports throughput, peak RSS and
+per-stage latency percentiles. Run from src/indexing:
+
+    python -m benchmarks.pipeline --documents 200 --parallel 20 --di-latency 2 --throttle-rate 0.05
+
+Chunking uses the gpt2 tokenizer by default, like the chunking activity. It is downloaded from Hugging Face, so the
+benchmark needs network access unless the tokenizer is cached; pass --tokenizer character to run fully offline.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import time
+from collections.abc import Callable
+
+# The caches and the claim check are turned off so that every run measures the services; set before any import
+os.environ.setdefault("SOURCE_STORAGE_ACCOUNT_NAME", "fake")
+os.environ.setdefault("DI_ENDPOINT", "https://fake.cognitiveservices.azure.com/")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "https://fake.openai.azure.com/")
+os.environ.setdefault("SEARCH_SERVICE_ENDPOINT", "https://fake.search.windows.net")
+os.environ["CLAIM_CHECK_ENABLED"] = "false"
+os.environ["LAYOUT_CACHE_ENABLED"] = "false"
+os.environ["EMBEDDING_CACHE_BACKEND"] = "none"
+os.environ["CRACKING_SOURCE_MODE"] = "stream"
+
+from activities import chunking as chunking_module  # noqa: E402
+from activities import cracking as cracking_module  # noqa: E402
+from activities import embedding as embedding_module  # noqa: E402
+from activities import listblob as listblob_module  # noqa: E402
+from activities import search as search_module  # noqa: E402
+from activities.layout_cache import LayoutCache  # noqa: E402
+from activities.vector_settings import get_vector_settings  # noqa: E402
+from application.limits import snapshot  # noqa: E402
+
+from benchmarks.fakes import (  # noqa: E402
+    PAGE_BREAK,
+    WORDS,
+    FakeBlob,
+    FakeBlobStore,
+    FakeDocumentClient,
+    FakeOpenAIClient,
+    FakeSearchClient,
+    MemoryContainerClient,
+    ServiceProfile,
+)
+
+CONTAINER_NAME = "source"
+
+
+def _user_function(decorated) -> Callable:
+    """The plain function behind an activity; the Functions decorators wrap it in a FunctionBuilder."""
+    if hasattr(decorated, "build"):
+        return decorated.build().get_user_function()
+    return decorated
+
+
+def _synthetic_text(random_source: random.Random, characters: int) -> str:
+    sentences, length = [], 0
+    while length < characters:
+        sentence = " ".join(random_source.choice(WORDS) for _ in range(random_source.randint(6, 18))).capitalize() + "."
+        sentences.append(sentence)
+        length += len(sentence) + 1
+    return " ".join(sentences)
+
+
+def build_corpus(store: FakeBlobStore, args, random_source: random.Random):
+    """A mix of layout documents (sent to Document Intelligence) and text documents (extracted locally)."""
+    for i in range(args.documents):
+        pages = max(1, int(random_source.expovariate(1 / args.pages)))
+        if random_source.random() < args.text_ratio:
+            text = "\n\n".join(_synthetic_text(random_source, args.page_chars) for _ in range(pages))
+            store.add(CONTAINER_NAME, FakeBlob(f"docs/{i:06d}.md", text.encode("utf-8"), "text/markdown"))
+        else:
+            text = PAGE_BREAK.join(_synthetic_text(random_source, args.page_chars) for _ in range(pages))
+            store.add(CONTAINER_NAME, FakeBlob(f"docs/{i:06d}.bin", text.encode("utf-8"), "application/octet-stream"))
+
+
+def install_fakes(args, random_source: random.Random) -> dict:
+    profiles = {
+        "storage": ServiceProfile(args.storage_latency, args.storage_latency / 2),
+        "document_intelligence": ServiceProfile(args.di_latency, args.di_latency / 2, args.throttle_rate),
+        "openai": ServiceProfile(args.openai_latency, args.openai_latency / 2, args.throttle_rate),
+        "search": ServiceProfile(args.search_latency, args.search_latency / 2, args.throttle_rate),
+    }
+    store = FakeBlobStore(profiles["storage"], random_source)
+    document_client = FakeDocumentClient(
+        store, profiles["document_intelligence"], random_source, args.di_latency_per_page
+    )
+    openai_client = FakeOpenAIClient(profiles["openai"], random_source, dimensions=args.dimensions)
+    search_client = FakeSearchClient(profiles["search"], random_source)
+    # The embedding activity checks the returned vectors against the configured size
+    os.environ["EMBEDDING_DIMENSIONS"] = str(args.dimensions)
+    get_vector_settings.cache_clear()
+
+    listblob_module.get_async_blob_service_client = lambda account_name: store
+    cracking_module.get_async_blob_service_client = lambda account_name: store
+    cracking_module.get_async_document_client = lambda endpoint: document_client
+    embedding_module.get_openai_client = lambda endpoint: openai_client
+    search_module.get_search_client = lambda endpoint, index_name: search_client
+    search_module.get_async_credential = lambda: None
+    return {"store": store, "profiles": profiles, "search_client": search_client}
+
+
+class StageTimer:
+    def __init__(self):
+        self.durations: dict[str, list[float]] = {}
+
+    async def run(self, stage: str, call, *args, attempts: int = 3):
+        """Runs one activity call, retrying failed calls like the orchestrator's RetryOptions would."""
+        for attempt in range(1, attempts + 1):
+            start = time.perf_counter()
+            try:
+                if asyncio.iscoroutinefunction(call):
+                    return await call(*args)
+                return await asyncio.to_thread(call, *args)
+            except Exception:
+                if attempt == attempts:
+                    raise
+            finally:
+                self.durations.setdefault(stage, []).append(time.perf_counter() - start)
+
+    def report(self) -> dict:
+        def percentile(values: list[float], share: float) -> float:
+            return sorted(values)[min(len(values) - 1, int(share * len(values)))]
+
+        return {
+            stage: {
+                "calls": len(values),
+                "p50_ms": round(statistics.median(values) * 1000, 1),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+            }
+            for stage, values in self.durations.items()
+        }
+
+
+async def run_pipeline(args, layout_cache: LayoutCache | None = None) -> dict:
+    random_source = random.Random(args.seed)
+    fakes = install_fakes(args, random_source)
+    build_corpus(fakes["store"], args, random_source)
+    cracking_module.get_layout_cache = lambda: layout_cache or LayoutCache(None)
+
+    list_blobs_chunk = _user_function(listblob_module.list_blobs_chunk)
+    document_cracking = _user_function(cracking_module.document_cracking)
+    chunking = _user_function(chunking_module.chunking)
+    embedding = _user_function(embedding_module.embedding)
+    add_documents = _user_function(search_module.add_documents)
+    flush_documents = _user_function(search_module.flush_documents)
+    timer = StageTimer()
+    chunk_count = 0
+    failed_documents = 0
+    upload_buffer: list[list] = []
+
+    async def flush_upload_buffer():
+        # Shared uploads of many documents, as the index orchestrator's wave mode does with SEARCH_BUFFER_MAX_CHUNKS
+        nonlocal chunk_count, failed_documents, upload_buffer
+        chunk_sets, upload_buffer = upload_buffer, []
+        try:
+            await timer.run("flush_documents", flush_documents, {"chunk_sets": chunk_sets, "index_name": "benchmark"})
+            chunk_count += sum(len(chunk_set) for chunk_set in chunk_sets)
+        except Exception as error:
+            failed_documents += len(chunk_sets)
+            print(f"Flush of {len(chunk_sets)} documents failed: {error!r}", file=sys.stderr)
+
+    async def index_document(blob_reference: dict):
+        nonlocal chunk_count, failed_documents
+        try:
+            document = await timer.run("document_cracking", document_cracking, blob_reference)
+            chunks = await timer.run(
+                "chunking", chunking, {"document": document, "settings": {"tokenizer": args.tokenizer}}
+            )
+            embedded = await timer.run("embedding", embedding, {"chunk_sets": [chunks]})
+            if args.upload_buffer_chunks:
+                upload_buffer.append(embedded["chunk_sets"][0])
+                if sum(len(chunk_set) for chunk_set in upload_buffer) >= args.upload_buffer_chunks:
+                    await flush_upload_buffer()
+                return
+            await timer.run(
+                "add_documents", add_documents, {"chunks": embedded["chunk_sets"][0], "index_name": "benchmark"}
+            )
+            chunk_count += len(chunks)
+        except Exception as error:
+            failed_documents += 1
+            print(f"{blob_reference['blob_name']} failed: {error!r}", file=sys.stderr)
+
+    start = time.perf_counter()
+    in_flight = set()
+    listing_state, done = None, False
+    while not done:
+        result = await timer.run(
+            "list_blobs_chunk",
+            list_blobs_chunk,
+            {
+                "container_name": CONTAINER_NAME,
+                "prefix_list": [""],
+                "page_size": args.page_size,
+                "listing_state": listing_state,
+            },
+        )
+        listing_state, done = result["listing_state"], result["done"]
+        for blob_reference in result["blobs"]:
+            # A sliding window of documents, as in the index orchestrator's document mode
+            if len(in_flight) >= args.parallel:
+                finished, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            in_flight.add(asyncio.ensure_future(index_document(blob_reference)))
+    if in_flight:
+        await asyncio.wait(in_flight)
+    if upload_buffer:
+        await flush_upload_buffer()
+    elapsed = time.perf_counter() - start
+
+    indexed_documents = args.documents - failed_documents
+    return {
+        "documents": args.documents,
+        "failed_documents": failed_documents,
+        "chunks": chunk_count,
+        "elapsed_seconds": round(elapsed, 2),
+        "documents_per_second": round(indexed_documents / elapsed, 2),
+        "chunks_per_second": round(chunk_count / elapsed, 2),
+        # ru_maxrss is reported in kilobytes on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "stages": timer.report(),
+        "services": {
+            name: {"calls": profile.calls, "throttled": profile.throttled}
+            for name, profile in fakes["profiles"].items()
+        },
+        "limits": snapshot(),
+    }
+
+
+def parse_args(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=100)
+    parser.add_argument("--pages", type=float, default=8, help="mean pages per document (exponentially distributed)")
+    parser.add_argument("--page-chars", type=int, default=3000)
+    parser.add_argument(
+        "--text-ratio", type=float, default=0.3, help="share of documents extracted without Document Intelligence"
+    )
+    parser.add_argument("--parallel", type=int, default=20, help="documents in flight, like BLOB_AMOUNT_PARALLEL")
+    parser.add_argument("--page-size", type=int, default=1000, help="results per listing request, like LIST_PAGE_SIZE")
+    parser.add_argument(
+        "--upload-buffer-chunks",
+        type=int,
+        default=0,
+        help="buffer documents and upload them together once this many chunks are buffered, like "
+        "SEARCH_BUFFER_MAX_CHUNKS; 0 uploads every document on its own",
+    )
+    parser.add_argument(
+        "--layout-cache",
+        action="store_true",
+        help="index the corpus twice with an in-memory layout cache; the second pass reuses the cached pages",
+    )
+    parser.add_argument("--storage-latency", type=float, default=0.01)
+    parser.add_argument("--di-latency", type=float, default=0.5)
+    parser.add_argument("--di-latency-per-page", type=float, default=0.05)
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    parser.add_argument("--search-latency", type=float, default=0.1)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of service calls answered with 429")
+    parser.add_argument("--dimensions", type=int, default=3072, help="embedding size, like EMBEDDING_DIMENSIONS")
+    parser.add_argument("--tokenizer", default="gpt2", help="gpt2 is downloaded from Hugging Face; character is local")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the report to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] = None):
+    args = parse_args(argv)
+    if args.layout_cache:
+        layout_cache = LayoutCache(MemoryContainerClient())
+        report = {
+            "first_pass": asyncio.run(run_pipeline(args, layout_cache)),
+            "second_pass": asyncio.run(run_pipeline(args, layout_cache)),
+        }
+    else:
+        report = asyncio.run(run_pipeline(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text)
+
+
+if __name__ == "__main__":
+    main()
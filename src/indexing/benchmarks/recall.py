@@ -0,0 +1,177 @@
+"""
+Recall versus vector size for the compression settings of the search index (see `activities/vector_settings.py`).
+
+Simulates what the service does for each setting: vectors are truncated to the requested dimensions and
+renormalized, quantized to int8 (scalar) or to one bit per dimension (binary), searched exhaustively on the
+compressed vectors and optionally rescored with the full-precision vectors of the `oversampling` times `k` best
+candidates. Recall@k is measured against exact search on the uncompressed vectors. HNSW itself is not simulated, so
+the numbers isolate the loss from compression. Needs numpy. Run from src/indexing:
+
+    python -m benchmarks.recall --vectors sample.npy --dimensions 3072 1024 512 --k 10
+
+Without --vectors, a synthetic corpus is generated whose variance decreases across dimensions, as it does in models
+trained for shortening. Real embeddings give far more reliable numbers: save a sample of them as an (n, d) float32
+array with numpy.save.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+from activities.vector_settings import COMPRESSION_KINDS
+
+# Set bits per byte value
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
+
+def synthetic_corpus(count: int, dimensions: int, clusters: int, random_state: np.random.Generator) -> np.ndarray:
+    scale = 1 / np.sqrt(np.arange(1, dimensions + 1))
+    centers = random_state.standard_normal((clusters, dimensions)) * scale
+    assignments = random_state.integers(0, clusters, count)
+    vectors = centers[assignments] + 0.5 * random_state.standard_normal((count, dimensions)) * scale
+    return vectors.astype(np.float32)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    candidates = np.argpartition(-scores, min(k, scores.shape[1] - 1), axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1)
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def compressed_scores(corpus: np.ndarray, queries: np.ndarray, compression: str) -> np.ndarray:
+    if compression == "none":
+        return queries @ corpus.T
+    if compression == "scalar":
+        # int8 with a range per dimension, as the service derives it from the indexed vectors
+        low, high = corpus.min(axis=0), corpus.max(axis=0)
+        step = np.where(high > low, (high - low) / 255, 1)
+        codes = np.round((corpus - low) / step).astype(np.uint8)
+        return queries @ (codes * step + low).T
+    # Binary: one bit per dimension, compared by Hamming distance
+    corpus_bits = np.packbits(corpus > 0, axis=1)
+    query_bits = np.packbits(queries > 0, axis=1)
+    distances = np.stack([POPCOUNT[query ^ corpus_bits].sum(axis=1) for query in query_bits])
+    return -distances.astype(np.float32)
+
+
+def bytes_per_vector(dimensions: int, compression: str, keep_originals: bool, stored: bool) -> dict[str, int]:
+    """Vector index size, which the service keeps in memory, and total vector storage per document."""
+    full_bytes = 4 * dimensions
+    index_bytes = {"none": full_bytes, "scalar": dimensions, "binary": (dimensions + 7) // 8}[compression]
+    originals = full_bytes if compression != "none" and keep_originals else 0
+    retrievable = full_bytes if stored else 0
+    return {"index_bytes": index_bytes, "storage_bytes": index_bytes + originals + retrievable}
+
+
+def evaluate(
+    corpus: np.ndarray,
+    queries: np.ndarray,
+    truth: np.ndarray,
+    dimensions: int,
+    compression: str,
+    rescore: bool,
+    oversampling: float,
+    keep_originals: bool,
+    k: int,
+) -> dict:
+    truncated_corpus, truncated_queries = normalize(corpus[:, :dimensions]), normalize(queries[:, :dimensions])
+    start = time.perf_counter()
+    scores = compressed_scores(truncated_corpus, truncated_queries, compression)
+    if compression != "none" and rescore:
+        candidates = top_k(scores, int(k * oversampling))
+        # Without the originals, binary candidates are rescored against the full-precision query only
+        rescore_corpus = (
+            truncated_corpus if keep_originals else np.where(truncated_corpus > 0, 1.0, -1.0).astype(np.float32)
+        )
+        exact = np.einsum("qd,qcd->qc", truncated_queries, rescore_corpus[candidates])
+        found = np.take_along_axis(candidates, top_k(exact, k), axis=1)
+    else:
+        found = top_k(scores, k)
+    elapsed = time.perf_counter() - start
+    recall = np.mean([len(set(found_row) & set(truth_row)) / k for found_row, truth_row in zip(found, truth)])
+    return {"recall_at_k": round(float(recall), 4), "search_ms_per_query": round(elapsed * 1000 / len(queries), 3)}
+
+
+def run(args) -> list[dict]:
+    random_state = np.random.default_rng(args.seed)
+    if args.vectors:
+        vectors = np.load(args.vectors).astype(np.float32)
+    else:
+        vectors = synthetic_corpus(args.count + args.queries, max(args.dimensions), args.clusters, random_state)
+    # Queries are held out from the corpus, and slightly perturbed so they are not exact duplicates
+    random_state.shuffle(vectors)
+    queries = vectors[: args.queries] + 0.05 * random_state.standard_normal(vectors[: args.queries].shape).astype(
+        np.float32
+    )
+    corpus = vectors[args.queries :]
+    truth = top_k(normalize(queries) @ normalize(corpus).T, args.k)
+
+    results = []
+    for dimensions in args.dimensions:
+        if dimensions > corpus.shape[1]:
+            continue
+        for compression in args.compression:
+            for rescore in [False, True] if compression != "none" else [False]:
+                if rescore and compression == "scalar" and not args.keep_originals:
+                    continue
+                result = {"dimensions": dimensions, "compression": compression, "rescore": rescore}
+                result.update(
+                    evaluate(
+                        corpus,
+                        queries,
+                        truth,
+                        dimensions,
+                        compression,
+                        rescore,
+                        args.oversampling,
+                        args.keep_originals,
+                        args.k,
+                    )
+                )
+                result.update(bytes_per_vector(dimensions, compression, args.keep_originals, args.stored))
+                results.append(result)
+    return results
+
+
+def parse_args(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", help="an (n, d) float32 .npy file of sample embeddings")
+    parser.add_argument("--count", type=int, default=20000, help="synthetic corpus size")
+    parser.add_argument("--clusters", type=int, default=200, help="topics in the synthetic corpus")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dimensions", type=int, nargs="+", default=[3072, 1536, 1024, 512, 256])
+    parser.add_argument("--compression", nargs="+", choices=COMPRESSION_KINDS, default=list(COMPRESSION_KINDS))
+    parser.add_argument("--oversampling", type=float, default=4.0, help="like VECTOR_OVERSAMPLING")
+    parser.add_argument(
+        "--keep-originals", action=argparse.BooleanOptionalAction, default=True, help="like VECTOR_KEEP_ORIGINALS"
+    )
+    parser.add_argument("--stored", action=argparse.BooleanOptionalAction, default=True, help="like VECTOR_STORED")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] = None):
+    args = parse_args(argv)
+    results = run(args)
+    print(
+        f"{'dims':>5} {'compression':>11} {'rescore':>7} {'recall@k':>8} {'index B':>8} {'stored B':>8} {'ms/query':>8}"
+    )
+    for result in results:
+        print(
+            f"{result['dimensions']:>5} {result['compression']:>11} {str(result['rescore']):>7} "
+            f"{result['recall_at_k']:>8.4f} {result['index_bytes']:>8} {result['storage_bytes']:>8} "
+            f"{result['search_ms_per_query']:>8.3f}"
+        )
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
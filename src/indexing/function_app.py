@@ -1,19 +1,29 @@
-import os
-import sys
+import json
 import logging
-import azure.functions as func
-import azure.durable_functions as df
-from azure.durable_functions import DurableOrchestrationClient
-
+import os
+from datetime import UTC, datetime
 
+import azure.durable_functions as df
+import azure.functions as func
 from application.app import app
-from orchestrators.index import index
+from application.limits import snapshot
+from azure.durable_functions import DurableOrchestrationClient
+from orchestrators.index import index  # noqa: F401
+from orchestrators.index_blob import BLOB_EVENT, blob_instance_id
 
 defaults = {
     "BLOB_AMOUNT_PARALLEL": int(os.environ.get("BLOB_AMOUNT_PARALLEL", "20")),
+    "LIST_PAGE_SIZE": int(os.environ.get("LIST_PAGE_SIZE", "1000")),
     "SEARCH_INDEX_NAME": os.environ.get("SEARCH_INDEX_NAME", "default-index"),
     "BLOB_CONTAINER_NAME": os.environ.get("BLOB_CONTAINER_NAME", "source"),
     "MAX_NUMBER_OF_ATTEMPTS": int(os.environ.get("MAX_NUMBER_OF_ATTEMPTS", "1")),
+    "EMBEDDING_MODE": os.environ.get("EMBEDDING_MODE", "document"),
+    "EMBEDDING_WAVE_MAX_CHUNKS": int(os.environ.get("EMBEDDING_WAVE_MAX_CHUNKS", "2048")),
+    "SEARCH_BUFFER_MAX_CHUNKS": int(os.environ.get("SEARCH_BUFFER_MAX_CHUNKS", "5000")),
+    "SEARCH_BUFFER_MAX_SECONDS": int(os.environ.get("SEARCH_BUFFER_MAX_SECONDS", "60")),
+    "CONTINUE_AS_NEW_AFTER_DOCUMENTS": int(os.environ.get("CONTINUE_AS_NEW_AFTER_DOCUMENTS", "500")),
+    "BLOB_EVENT_DEBOUNCE_SECONDS": int(os.environ.get("BLOB_EVENT_DEBOUNCE_SECONDS", "5")),
+    "DEDUP_MODE": os.environ.get("DEDUP_MODE", "off").lower(),
 }
 
 
@@ -23,35 +33,114 @@ def extract_path(event: func.EventGridEvent):
     return path_in_container
 
 
-# @app.function_name(name='index_event_grid')
-# @app.event_grid_trigger(arg_name='event')
-# async def index_event_grid(event: func.EventGridEvent):
-#     if event.get_json()["api"] != "PutBlob":
-#         logging.info("Event type is not BlobCreated. Skipping execution.")
-#         return
-    
-#     path_in_container = extract_path(event)
-#     logging.info(f'Python EventGrid trigger processed a BlobCreated event. Path: {path_in_container}')
+def extract_container(event: func.EventGridEvent):
+    subject = event.subject
+    return subject.split("/containers/", 1)[-1].split("/blobs/", 1)[0]
+
+
+async def _is_active(client: DurableOrchestrationClient, instance_id: str) -> bool:
+    status = await client.get_status(instance_id)
+    return status is not None and status.runtime_status in (
+        df.OrchestrationRuntimeStatus.Running,
+        df.OrchestrationRuntimeStatus.Pending,
+        df.OrchestrationRuntimeStatus.ContinuedAsNew,
+    )
+
+
+@app.function_name(name='index_event_grid')
+@app.event_grid_trigger(arg_name='event')
+@app.durable_client_input(client_name="client")
+async def index_event_grid(event: func.EventGridEvent, client: DurableOrchestrationClient):
+    if event.event_type not in ("Microsoft.Storage.BlobCreated", "Microsoft.Storage.BlobDeleted"):
+        logging.info(f"Event type {event.event_type} is not handled. Skipping execution.")
+        return
+    container_name = extract_container(event)
+    if container_name != defaults["BLOB_CONTAINER_NAME"]:
+        logging.info(f"Event for container {container_name} is not for the indexed container. Skipping execution.")
+        return
+
+    path_in_container = extract_path(event)
+    blob_event = {
+        "action": "created" if event.event_type == "Microsoft.Storage.BlobCreated" else "deleted",
+        "container_name": container_name,
+        "blob_name": path_in_container,
+        "event_time": (event.event_time or datetime.now(UTC)).isoformat(),
+    }
+    logging.info(f'Python EventGrid trigger processed a {blob_event["action"]} event. Path: {path_in_container}')
+
+    # Bursts of events for the same blob are coalesced by the instance that is already running for it
+    instance_id = blob_instance_id(defaults["SEARCH_INDEX_NAME"], container_name, path_in_container)
+    if await _is_active(client, instance_id):
+        try:
+            await client.raise_event(instance_id, BLOB_EVENT, blob_event)
+        except Exception as error:
+            # The instance completed after the status check
+            logging.info(f"Could not forward event to indexing instance {instance_id}: {error}")
+        else:
+            # An instance that completes without waiting for events again drops the event; start a new one then
+            if await _is_active(client, instance_id):
+                logging.info(f"Forwarded event to indexing instance {instance_id}")
+                return
+    await client.start_new(
+        orchestration_function_name="index_blob",
+        instance_id=instance_id,
+        client_input={"event": blob_event, "index_name": defaults["SEARCH_INDEX_NAME"], "defaults": defaults},
+    )
+    logging.info(f"Started indexing with id: {instance_id}")
 
-    # instance_id = await client.start_new("index", client_input={"prefix_list": [path_in_container], "defaults": defaults})
-    # logging.info(f'Started indexing with id: {instance_id}')
 
 #
-#app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
-#app = df.DFApp(http_auth_level=func.AuthLevel.ANONYMOUS)
+# app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
+# app = df.DFApp(http_auth_level=func.AuthLevel.ANONYMOUS)
+
 
-@app.function_name(name='index_http')
+@app.function_name(name="index_http")
 @app.route(route="index", methods=[func.HttpMethod.POST])
 @app.durable_client_input(client_name="client")
 async def index_http(req: func.HttpRequest, client: DurableOrchestrationClient) -> func.HttpResponse:
-    logging.info('Kick off indexing process.')
+    logging.info("Kick off indexing process.")
     input = req.get_json()
     instance_id = await client.start_new(
         orchestration_function_name="index",
-        client_input={"prefix_list": input['prefix_list'], "index_name": input['index_name'], "defaults": defaults})
+        client_input={
+            "prefix_list": input["prefix_list"],
+            "index_name": input["index_name"],
+            "force": input.get("force", False),
+            "chunking": input.get("chunking"),
+            "defaults": defaults,
+        },
+    )
     return func.HttpResponse(instance_id, status_code=200)
 
-#anonymous 
+
+@app.function_name(name="index_status_http")
+@app.route(route="index/{instance_id}", methods=[func.HttpMethod.GET])
+@app.durable_client_input(client_name="client")
+async def index_status_http(req: func.HttpRequest, client: DurableOrchestrationClient) -> func.HttpResponse:
+    # Progress, throughput and time per stage of an indexing run, from the orchestration's custom status
+    instance_id = req.route_params.get("instance_id")
+    status = await client.get_status(instance_id)
+    if status is None or status.runtime_status is None:
+        return func.HttpResponse(f"No indexing run with id {instance_id}", status_code=404)
+    body = {
+        "instance_id": instance_id,
+        "runtime_status": status.runtime_status.value,
+        "custom_status": status.custom_status,
+        "output": status.output,
+        "created_time": status.created_time.isoformat() if status.created_time else None,
+        "last_updated_time": status.last_updated_time.isoformat() if status.last_updated_time else None,
+    }
+    return func.HttpResponse(json.dumps(body), mimetype="application/json", status_code=200)
+
+
+@app.function_name(name="limits_http")
+@app.route(route="limits", methods=[func.HttpMethod.GET])
+def limits_http(req: func.HttpRequest) -> func.HttpResponse:
+    # In-flight calls and current limits per stage, as seen by the worker process that serves the request
+    return func.HttpResponse(json.dumps(snapshot()), mimetype="application/json", status_code=200)
+
+
+# anonymous
 # @app.route(route="http_trigger")
 
 # def http_trigger(req: func.HttpRequest) -> func.HttpResponse:
@@ -1,14 +1,16 @@
-from azure.durable_functions import DurableOrchestrationContext, RetryOptions
-from activities.search import ensure_index_exists,add_documents
-from activities.listblob import list_blobs_chunk
-from activities.cracking import document_cracking
-from activities.chunking import chunking
-from activities.embedding import embedding
-
-from application.app import app
-import os
 import logging
+from datetime import datetime
 
+from activities.chunking import chunking  # noqa: F401
+from activities.claim_check import item_count
+from activities.cracking import document_cracking  # noqa: F401
+from activities.dedup import claim_chunks, deduplicate_chunks  # noqa: F401
+from activities.embedding import embedding  # noqa: F401
+from activities.listblob import list_blobs_chunk  # noqa: F401
+from activities.manifest import filter_changed_blobs, write_manifest  # noqa: F401
+from activities.search import add_documents, ensure_index_exists, flush_documents, remove_documents  # noqa: F401
+from application.app import app
+from azure.durable_functions import DurableOrchestrationContext, RetryOptions
 
 
 @app.function_name(name="index")  # The name used by client.start_new("index")
@@ -17,8 +19,6 @@ def index(context: DurableOrchestrationContext):
     # Resolver resolves list of prefixes to iterable ( needs to store state of iterable e.g. marker and array position)
     logging.info("Starting orchestration 'index'")
     input = context.get_input()
-    continuation_token = None
-    array_position = 0
     container_name = input.get("defaults").get("BLOB_CONTAINER_NAME")
     if container_name is None:
         raise ValueError("BLOB_CONTAINER_NAME is not set")
@@ -31,39 +31,566 @@ def index(context: DurableOrchestrationContext):
     max_number_of_attempts = input.get("defaults").get("MAX_NUMBER_OF_ATTEMPTS")
     if max_number_of_attempts is None:
         raise ValueError("MAX_NUMBER_OF_ATTEMPTS is not set")
-    
-    
-    yield context.call_activity(name="ensure_index_exists", input_=index_name)
-    # For every item in iterable create a sub orchestrator ( should be every file in the blob storage)
+    embedding_mode = input.get("defaults").get("EMBEDDING_MODE", "document")
+    if embedding_mode not in ("document", "wave"):
+        raise ValueError(f"Unknown EMBEDDING_MODE '{embedding_mode}'")
+
+    # State carried across continue_as_new generations of this orchestration
+    state = input.get("state") or {
+        "listing_state": None,
+        "listing_done": False,
+        "pending_blobs": [],
+        "upload_buffer": [],
+        "upload_buffer_started_at": None,
+        "started_at": context.current_utc_datetime.isoformat(),
+        "index_ensured": False,
+        "stats": {
+            "documents_indexed": 0,
+            "documents_skipped": 0,
+            "embedding_cache": {"hits": 0, "misses": 0},
+            "stage_seconds": {},
+            "dedup": {"chunks": 0, "duplicates": 0, "tokens_saved": 0, "bytes_saved": 0, "ratio": 0.0},
+        },
+    }
+    if not state["index_ensured"]:
+        yield context.call_activity(name="ensure_index_exists", input_=index_name)
+        state["index_ensured"] = True
+
+    if embedding_mode == "wave":
+        finished = yield from _run_waves(
+            context, input, state, index_name, container_name, blob_amount_parallel, max_number_of_attempts
+        )
+    else:
+        finished = yield from _run_sliding_window(
+            context, input, state, index_name, container_name, blob_amount_parallel, max_number_of_attempts
+        )
+
+    _update_throughput(context, state)
+    context.set_custom_status(state["stats"])
+    if not finished:
+        # Restart with a fresh history so it does not grow without bound on very large containers
+        context.continue_as_new({**input, "state": state})
+        return
+    return state["stats"]
+
+
+def _list_blobs_task(
+    context: DurableOrchestrationContext, orchestration_input: dict, state: dict, container_name: str
+):
+    prefix_list = [""] if "prefix_list" not in orchestration_input else orchestration_input["prefix_list"]
+    return context.call_activity(
+        "list_blobs_chunk",
+        {
+            "container_name": container_name,
+            "listing_state": state["listing_state"],
+            "page_size": orchestration_input.get("defaults").get("LIST_PAGE_SIZE", 1000),
+            "prefix_list": prefix_list,
+            "scheduled_at": context.current_utc_datetime.isoformat(),
+        },
+    )
+
+
+def _filter_changed_blobs_task(
+    context: DurableOrchestrationContext,
+    orchestration_input: dict,
+    state: dict,
+    blob_list_result: dict,
+    index_name: str,
+):
+    # The listing state is opaque to the orchestrator and only handed back to list_blobs_chunk
+    state["listing_state"] = blob_list_result["listing_state"]
+    state["listing_done"] = blob_list_result["done"]
+    if len(blob_list_result["blobs"]) == 0:
+        return None
+    # Skip blobs whose ETag/MD5 matches the manifest entry from a previous run
+    return context.call_activity(
+        "filter_changed_blobs",
+        {
+            "index_name": index_name,
+            "blobs": blob_list_result["blobs"],
+            "force": orchestration_input.get("force", False),
+        },
+    )
+
+
+def _run_sliding_window(
+    context: DurableOrchestrationContext,
+    orchestration_input: dict,
+    state: dict,
+    index_name: str,
+    container_name: str,
+    blob_amount_parallel: int,
+    max_number_of_attempts: int,
+):
+    """
+    Keeps up to BLOB_AMOUNT_PARALLEL index_document sub-orchestrators running at all times, starting the next
+    document as soon as any one finishes. The next listing page is fetched while documents are processed.
+
+    Every listing call, every blob skipped as unchanged and every document started adds to the history of this
+    generation, and each counts as one unit of work. After CONTINUE_AS_NEW_AFTER_DOCUMENTS units, no new work is
+    started and the in-flight documents are drained, so a container that is mostly unchanged is not listed and
+    filtered in one ever-growing history either. Returns True when every blob has been processed, False when the
+    orchestration should continue as new.
+    """
+    continue_as_new_after = orchestration_input.get("defaults").get("CONTINUE_AS_NEW_AFTER_DOCUMENTS", 500)
+    stats = state["stats"]
+    pending_blobs = state["pending_blobs"]
+    in_flight = []
+    listing_task, filter_task = None, None
+    generation_work = 0
+
     while True:
-        prefix_list = [""] if "prefix_list" not in input else input["prefix_list"] 
-        blob_list_result = yield context.call_activity("list_blobs_chunk", {
-                    "container_name": container_name,
-                    "continuation_token": continuation_token,
-                    "chunk_size": blob_amount_parallel,
-                    "prefix_list_offset": array_position,
-                    "prefix_list": prefix_list
-            })
-        if len(blob_list_result["blobs"]) == 0:
+        draining = generation_work >= continue_as_new_after
+        while pending_blobs and len(in_flight) < blob_amount_parallel and not draining:
+            blob_reference = pending_blobs.pop(0)
+            in_flight.append(
+                context.call_sub_orchestrator_with_retry(
+                    name="index_document",
+                    retry_options=_document_retry_options(max_number_of_attempts),
+                    input_={
+                        "blob_reference": blob_reference,
+                        "index_name": index_name,
+                        "max_number_of_attempts": max_number_of_attempts,
+                        "chunking": orchestration_input.get("chunking"),
+                        "dedup_mode": orchestration_input.get("defaults").get("DEDUP_MODE", "off"),
+                    },
+                )
+            )
+            generation_work += 1
+            draining = generation_work >= continue_as_new_after
+        # Prefetch the next page while there is less than one page of work queued
+        if (
+            listing_task is None
+            and filter_task is None
+            and not state["listing_done"]
+            and not draining
+            and len(pending_blobs) < blob_amount_parallel
+        ):
+            listing_task = _list_blobs_task(context, orchestration_input, state, container_name)
+            generation_work += 1
+
+        waiting_on = in_flight + [task for task in (listing_task, filter_task) if task is not None]
+        if not waiting_on:
             break
-        continuation_token = blob_list_result["continuation_token"]
-        array_position = blob_list_result["prefix_list_offset"]
-        task_list = []
-        for blob_reference in blob_list_result["blobs"]:
-            document_retry_options = RetryOptions(first_retry_interval_in_milliseconds=60_000, max_number_of_attempts=max_number_of_attempts)
-            task_list.append(context.call_sub_orchestrator_with_retry(
-                name="index_document",
-                retry_options=document_retry_options,
-                input_={"blob_reference": blob_reference, "index_name": index_name, "max_number_of_attempts": max_number_of_attempts}))
-        yield context.task_all(task_list)
-    
+        winner = yield context.task_any(waiting_on)
+        if isinstance(winner.result, Exception):
+            raise winner.result
+        if winner is listing_task:
+            listing_task = None
+            filter_task = _filter_changed_blobs_task(context, orchestration_input, state, winner.result, index_name)
+        elif winner is filter_task:
+            filter_task = None
+            stats["documents_skipped"] += winner.result["skipped"]
+            generation_work += winner.result["skipped"]
+            pending_blobs.extend(winner.result["blobs"])
+            # Large documents start first and small ones fill the gaps around them
+            pending_blobs.sort(key=lambda blob_reference: blob_reference.get("size") or 0, reverse=True)
+        else:
+            in_flight.remove(winner)
+            stats["documents_indexed"] += 1
+            stats["embedding_cache"]["hits"] += winner.result["embedding_cache"]["hits"]
+            stats["embedding_cache"]["misses"] += winner.result["embedding_cache"]["misses"]
+            _add_stage_seconds(stats, winner.result.get("stage_seconds", {}))
+            _add_dedup_stats(stats, winner.result.get("dedup"))
+            _update_throughput(context, state)
+            context.set_custom_status(stats)
+
+    return state["listing_done"] and not pending_blobs
+
+
+def _run_waves(
+    context: DurableOrchestrationContext,
+    orchestration_input: dict,
+    state: dict,
+    index_name: str,
+    container_name: str,
+    blob_amount_parallel: int,
+    max_number_of_attempts: int,
+):
+    """
+    Processes the container in waves of BLOB_AMOUNT_PARALLEL documents that share embedding requests and uploads.
+    A listing page can hold many waves; the blobs not processed yet are kept in the state's pending_blobs. After
+    CONTINUE_AS_NEW_AFTER_DOCUMENTS units of work, counted as in _run_sliding_window, no new wave is started.
+    Returns True when every blob has been processed, False when the orchestration should continue as new.
+    """
+    continue_as_new_after = orchestration_input.get("defaults").get("CONTINUE_AS_NEW_AFTER_DOCUMENTS", 500)
+    stats = state["stats"]
+    pending_blobs = state["pending_blobs"]
+    generation_work = 0
+    while (pending_blobs or not state["listing_done"]) and generation_work < continue_as_new_after:
+        if not pending_blobs:
+            blob_list_result = yield _list_blobs_task(context, orchestration_input, state, container_name)
+            generation_work += 1
+            filter_task = _filter_changed_blobs_task(
+                context, orchestration_input, state, blob_list_result, index_name
+            )
+            if filter_task is None:
+                continue
+            changed_blobs_result = yield filter_task
+            stats["documents_skipped"] += changed_blobs_result["skipped"]
+            generation_work += changed_blobs_result["skipped"]
+            pending_blobs.extend(changed_blobs_result["blobs"])
+            if not pending_blobs:
+                continue
+        wave = pending_blobs[:blob_amount_parallel]
+        del pending_blobs[:blob_amount_parallel]
+        embedded_documents, embedding_cache = yield from _index_wave(
+            context,
+            wave,
+            index_name,
+            max_number_of_attempts,
+            orchestration_input.get("defaults"),
+            orchestration_input.get("chunking"),
+            stats,
+        )
+        generation_work += len(wave)
+        stats["embedding_cache"]["hits"] += embedding_cache["hits"]
+        stats["embedding_cache"]["misses"] += embedding_cache["misses"]
+        if embedded_documents and not state["upload_buffer"]:
+            state["upload_buffer_started_at"] = context.current_utc_datetime.isoformat()
+        state["upload_buffer"].extend(embedded_documents)
+        # Flush when the buffer holds a full upload or its oldest document has waited long enough
+        buffered_chunks = sum(item_count(document["chunks"]) for document in state["upload_buffer"])
+        if state["upload_buffer"] and (
+            buffered_chunks >= orchestration_input.get("defaults").get("SEARCH_BUFFER_MAX_CHUNKS", 5000)
+            or (
+                context.current_utc_datetime - datetime.fromisoformat(state["upload_buffer_started_at"])
+            ).total_seconds()
+            >= orchestration_input.get("defaults").get("SEARCH_BUFFER_MAX_SECONDS", 60)
+        ):
+            stats["documents_indexed"] += yield from _flush_upload_buffer(
+                context, state["upload_buffer"], index_name, max_number_of_attempts
+            )
+            state["upload_buffer"] = []
+        _update_throughput(context, state)
+        context.set_custom_status(stats)
+    finished = state["listing_done"] and not pending_blobs
+    if state["upload_buffer"] and finished:
+        stats["documents_indexed"] += yield from _flush_upload_buffer(
+            context, state["upload_buffer"], index_name, max_number_of_attempts
+        )
+        state["upload_buffer"] = []
+    return finished
+
+
+def _add_stage_seconds(stats: dict, stage_seconds: dict):
+    # Totals across documents; divided by documents_indexed they give the mean time per stage
+    totals = stats.setdefault("stage_seconds", {})
+    for stage, seconds in stage_seconds.items():
+        totals[stage] = totals.get(stage, 0.0) + seconds
+
+
+def _add_dedup_stats(stats: dict, dedup_stats: dict):
+    if not dedup_stats:
+        return
+    totals = stats.setdefault("dedup", {"chunks": 0, "duplicates": 0, "tokens_saved": 0, "bytes_saved": 0})
+    for key in ("chunks", "duplicates", "tokens_saved", "bytes_saved"):
+        totals[key] += dedup_stats[key]
+    totals["ratio"] = totals["duplicates"] / totals["chunks"] if totals["chunks"] else 0.0
+
+
+def _add_linked_tokens(dedup_stats: dict | None, embedding_results: list):
+    # In link mode, tokens only count as saved when the embedding activity reused the original's cached vector
+    if dedup_stats is not None:
+        dedup_stats["tokens_saved"] += sum(result["cache"].get("linked_tokens", 0) for result in embedding_results)
+
+
+def _update_throughput(context: DurableOrchestrationContext, state: dict):
+    stats = state["stats"]
+    elapsed_seconds = (context.current_utc_datetime - datetime.fromisoformat(state["started_at"])).total_seconds()
+    stats["elapsed_seconds"] = elapsed_seconds
+    stats["documents_per_second"] = stats["documents_indexed"] / elapsed_seconds if elapsed_seconds > 0 else 0.0
+
+
+def _document_retry_options(max_number_of_attempts: int) -> RetryOptions:
+    return RetryOptions(first_retry_interval_in_milliseconds=60_000, max_number_of_attempts=max_number_of_attempts)
+
+
+def _index_wave(
+    context: DurableOrchestrationContext,
+    blob_references: list,
+    index_name: str,
+    max_number_of_attempts: int,
+    defaults: dict,
+    chunking_settings: dict,
+    stats: dict,
+):
+    """
+    Embeds a wave of documents with shared embedding requests: every document is cracked and chunked in its own
+    sub-orchestrator and the chunks of the whole wave are embedded together. Returns each document with its embedded
+    chunks, ready for the upload buffer, and the embedding cache statistics of the wave. Stage times and
+    deduplication statistics are added to `stats`.
+    """
+    embedding_cache = {"hits": 0, "misses": 0}
+    if not blob_references:
+        return [], embedding_cache
+    service_retry_options = RetryOptions(
+        first_retry_interval_in_milliseconds=3000, max_number_of_attempts=max_number_of_attempts
+    )
+    prepared_documents = yield context.task_all(
+        [
+            context.call_sub_orchestrator_with_retry(
+                name="prepare_document",
+                retry_options=_document_retry_options(max_number_of_attempts),
+                input_={
+                    "blob_reference": blob_reference,
+                    "index_name": index_name,
+                    "max_number_of_attempts": max_number_of_attempts,
+                    "chunking": chunking_settings,
+                    "dedup_mode": defaults.get("DEDUP_MODE", "off"),
+                },
+            )
+            for blob_reference in blob_references
+        ]
+    )
+    chunk_sets = [prepared_document["chunks"] for prepared_document in prepared_documents]
+    for prepared_document in prepared_documents:
+        _add_stage_seconds(stats, prepared_document["stage_seconds"])
+        _add_dedup_stats(stats, prepared_document["dedup"])
+
+    # Pack whole documents into embedding activity calls of at most EMBEDDING_WAVE_MAX_CHUNKS chunks
+    max_chunks = defaults.get("EMBEDDING_WAVE_MAX_CHUNKS", 2048)
+    groups, current, current_chunks = [], [], 0
+    for document_position, chunks in enumerate(chunk_sets):
+        if current and current_chunks + item_count(chunks) > max_chunks:
+            groups.append(current)
+            current, current_chunks = [], 0
+        current.append(document_position)
+        current_chunks += item_count(chunks)
+    groups.append(current)
+    embedding_started_at = context.current_utc_datetime
+    embedding_results = yield context.task_all(
+        [
+            context.call_activity_with_retry(
+                "embedding",
+                service_retry_options,
+                {"chunk_sets": [chunk_sets[i] for i in group], "scheduled_at": embedding_started_at.isoformat()},
+            )
+            for group in groups
+        ]
+    )
+    _add_stage_seconds(stats, {"embedding": (context.current_utc_datetime - embedding_started_at).total_seconds()})
+    _add_linked_tokens(stats.get("dedup"), embedding_results)
+
+    embedded_documents = []
+    for group, embedding_result in zip(groups, embedding_results):
+        for document_position, chunks_with_embeddings in zip(group, embedding_result["chunk_sets"]):
+            embedded_documents.append(
+                {
+                    "blob_reference": blob_references[document_position],
+                    "chunks": chunks_with_embeddings,
+                    "dedup_claims": prepared_documents[document_position].get("dedup_claims"),
+                }
+            )
+        embedding_cache["hits"] += embedding_result["cache"]["hits"]
+        embedding_cache["misses"] += embedding_result["cache"]["misses"]
+    return embedded_documents, embedding_cache
+
+
+def _flush_upload_buffer(
+    context: DurableOrchestrationContext, upload_buffer: list, index_name: str, max_number_of_attempts: int
+):
+    """
+    Uploads the buffered documents to the search index in one flush_documents call, then removes stale chunks, claims
+    the kept chunks in the dedup index and records every document in the manifest. Returns the number of documents
+    completed.
+    """
+    service_retry_options = RetryOptions(
+        first_retry_interval_in_milliseconds=3000, max_number_of_attempts=max_number_of_attempts
+    )
+    flush_result = yield context.call_activity_with_retry(
+        "flush_documents",
+        service_retry_options,
+        {
+            "index_name": index_name,
+            "chunk_sets": [document["chunks"] for document in upload_buffer],
+            "scheduled_at": context.current_utc_datetime.isoformat(),
+        },
+    )
+    yield context.task_all(
+        [
+            task
+            for document, chunk_ids in zip(upload_buffer, flush_result["document_ids"])
+            for task in _stale_chunk_removal(
+                context, document["blob_reference"], chunk_ids, index_name, service_retry_options
+            )
+        ]
+        + [
+            _dedup_claim(
+                context, document["blob_reference"], document["dedup_claims"], index_name, service_retry_options
+            )
+            for document in upload_buffer
+            if document.get("dedup_claims") is not None
+        ]
+    )
+    yield context.task_all(
+        [
+            context.call_activity(
+                "write_manifest",
+                {"blob_reference": document["blob_reference"], "chunk_ids": chunk_ids, "index_name": index_name},
+            )
+            for document, chunk_ids in zip(upload_buffer, flush_result["document_ids"])
+        ]
+    )
+    return len(upload_buffer)
+
+
+def _stale_chunk_removal(
+    context: DurableOrchestrationContext,
+    blob_reference: dict,
+    chunk_ids: list,
+    index_name: str,
+    service_retry_options: RetryOptions,
+) -> list:
+    # Chunks from the previous version of this blob that were not overwritten are stale
+    stale_chunk_ids = sorted(set(blob_reference.get("previous_chunk_ids", [])) - set(chunk_ids))
+    if not stale_chunk_ids:
+        return []
+    return [
+        context.call_activity_with_retry(
+            "remove_documents", service_retry_options, {"document_ids": stale_chunk_ids, "index_name": index_name}
+        )
+    ]
+
+
+def _dedup_claim(
+    context: DurableOrchestrationContext,
+    blob_reference: dict,
+    dedup_claims: list | dict,
+    index_name: str,
+    service_retry_options: RetryOptions,
+):
+    # Only chunks that made it into the search index may serve as originals of later duplicates
+    return context.call_activity_with_retry(
+        "claim_chunks",
+        service_retry_options,
+        {
+            "blob_reference": blob_reference,
+            "claims": dedup_claims,
+            "index_name": index_name,
+            "scheduled_at": context.current_utc_datetime.isoformat(),
+        },
+    )
+
 
 @app.function_name(name="index_document")  # The name used by client.start_new("index")
 @app.orchestration_trigger(context_name="context")
 def index_document(context: DurableOrchestrationContext):
     input = context.get_input()
-    service_retry_options = RetryOptions(first_retry_interval_in_milliseconds=3000, max_number_of_attempts=input["max_number_of_attempts"])
-    document = yield context.call_activity_with_retry("document_cracking", service_retry_options, input["blob_reference"])
-    chunks = yield context.call_activity("chunking", document)
-    chunks_with_embeddings = yield context.call_activity_with_retry("embedding", service_retry_options, chunks)
-    yield context.call_activity_with_retry("add_documents",  service_retry_options,{"chunks": chunks_with_embeddings, "index_name": input["index_name"]})
\ No newline at end of file
+    service_retry_options = RetryOptions(
+        first_retry_interval_in_milliseconds=3000, max_number_of_attempts=input["max_number_of_attempts"]
+    )
+    # Stage times come from the replay-safe orchestration clock and include queueing and retries
+    stage_seconds = {}
+    chunks, dedup_stats, dedup_claims = yield from _prepare_document(
+        context, input, service_retry_options, stage_seconds
+    )
+    stage_started_at = context.current_utc_datetime
+    embedding_result = yield context.call_activity_with_retry(
+        "embedding", service_retry_options, {"chunk_sets": [chunks], "scheduled_at": stage_started_at.isoformat()}
+    )
+    stage_seconds["embedding"] = (context.current_utc_datetime - stage_started_at).total_seconds()
+    _add_linked_tokens(dedup_stats, [embedding_result])
+    yield from _finalize_document(
+        context, input, embedding_result["chunk_sets"][0], dedup_claims, service_retry_options, stage_seconds
+    )
+    return {"embedding_cache": embedding_result["cache"], "stage_seconds": stage_seconds, "dedup": dedup_stats}
+
+
+@app.function_name(name="prepare_document")
+@app.orchestration_trigger(context_name="context")
+def prepare_document(context: DurableOrchestrationContext):
+    document_input = context.get_input()
+    service_retry_options = RetryOptions(
+        first_retry_interval_in_milliseconds=3000, max_number_of_attempts=document_input["max_number_of_attempts"]
+    )
+    stage_seconds = {}
+    chunks, dedup_stats, dedup_claims = yield from _prepare_document(
+        context, document_input, service_retry_options, stage_seconds
+    )
+    return {"chunks": chunks, "stage_seconds": stage_seconds, "dedup": dedup_stats, "dedup_claims": dedup_claims}
+
+
+def _prepare_document(
+    context: DurableOrchestrationContext, document_input: dict, service_retry_options: RetryOptions, stage_seconds: dict
+):
+    stage_started_at = context.current_utc_datetime
+    document = yield context.call_activity_with_retry(
+        "document_cracking",
+        service_retry_options,
+        {**document_input["blob_reference"], "scheduled_at": stage_started_at.isoformat()},
+    )
+    stage_seconds["document_cracking"] = (context.current_utc_datetime - stage_started_at).total_seconds()
+    stage_started_at = context.current_utc_datetime
+    chunks = yield context.call_activity(
+        "chunking",
+        {
+            "document": document,
+            "settings": document_input.get("chunking"),
+            "scheduled_at": stage_started_at.isoformat(),
+        },
+    )
+    stage_seconds["chunking"] = (context.current_utc_datetime - stage_started_at).total_seconds()
+    dedup_mode = document_input.get("dedup_mode", "off")
+    if dedup_mode == "off":
+        return chunks, None, None
+    stage_started_at = context.current_utc_datetime
+    dedup_result = yield context.call_activity_with_retry(
+        "deduplicate_chunks",
+        service_retry_options,
+        {
+            "chunks": chunks,
+            "index_name": document_input["index_name"],
+            "blob_reference": document_input["blob_reference"],
+            "mode": dedup_mode,
+            "scheduled_at": stage_started_at.isoformat(),
+        },
+    )
+    stage_seconds["deduplication"] = (context.current_utc_datetime - stage_started_at).total_seconds()
+    return dedup_result["chunks"], dedup_result["stats"], dedup_result["claims"]
+
+
+def _finalize_document(
+    context: DurableOrchestrationContext,
+    document_input: dict,
+    chunks_with_embeddings: list,
+    dedup_claims: list | dict | None,
+    service_retry_options: RetryOptions,
+    stage_seconds: dict,
+):
+    stage_started_at = context.current_utc_datetime
+    upload_result = yield context.call_activity_with_retry(
+        "add_documents",
+        service_retry_options,
+        {
+            "chunks": chunks_with_embeddings,
+            "index_name": document_input["index_name"],
+            "ensure_index": document_input.get("ensure_index", False),
+            "scheduled_at": stage_started_at.isoformat(),
+        },
+    )
+    stage_seconds["add_documents"] = (context.current_utc_datetime - stage_started_at).total_seconds()
+    chunk_ids = upload_result["document_ids"]
+    follow_up_tasks = _stale_chunk_removal(
+        context, document_input["blob_reference"], chunk_ids, document_input["index_name"], service_retry_options
+    )
+    if dedup_claims is not None:
+        follow_up_tasks.append(
+            _dedup_claim(
+                context,
+                document_input["blob_reference"],
+                dedup_claims,
+                document_input["index_name"],
+                service_retry_options,
+            )
+        )
+    if follow_up_tasks:
+        yield context.task_all(follow_up_tasks)
+    yield context.call_activity(
+        "write_manifest",
+        {
+            "blob_reference": document_input["blob_reference"],
+            "chunk_ids": chunk_ids,
+            "index_name": document_input["index_name"],
+        },
+    )
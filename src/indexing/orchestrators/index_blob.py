@@ -0,0 +1,139 @@
+import hashlib
+import logging
+from datetime import UTC, datetime, timedelta
+
+from activities.dedup import release_chunks  # noqa: F401
+from activities.listblob import get_blob_reference  # noqa: F401
+from activities.manifest import delete_manifest, filter_changed_blobs, read_manifest  # noqa: F401
+from activities.search import remove_documents  # noqa: F401
+from application.app import app
+from azure.durable_functions import DurableOrchestrationContext, RetryOptions
+
+BLOB_EVENT = "blob_event"
+
+
+def _as_naive_utc(value: datetime) -> datetime:
+    return value.astimezone(UTC).replace(tzinfo=None) if value.tzinfo else value
+
+
+def blob_instance_id(index_name: str, container_name: str, blob_name: str) -> str:
+    """One orchestration per blob and index, so events for the same blob are routed to the same instance."""
+    # Instance IDs must not contain '/', so the blob path is hashed
+    blob_hash = hashlib.sha256(f"{container_name}/{blob_name}".encode()).hexdigest()
+    return f"index_blob-{index_name}-{blob_hash}"
+
+
+@app.function_name(name="index_blob")
+@app.orchestration_trigger(context_name="context")
+def index_blob(context: DurableOrchestrationContext):
+    """
+    Indexes or removes a single blob in response to storage events, without listing the container.
+
+    Events for the blob are debounced: the blob is processed once no further event has arrived for
+    BLOB_EVENT_DEBOUNCE_SECONDS, and only the latest event of a burst is acted on. Each burst ends with continue_as_new,
+    which carries over events that arrived while the blob was processed. The continued instance, started without an
+    event, picks them up or completes after a quiet BLOB_EVENT_DEBOUNCE_SECONDS.
+    """
+    orchestration_input = context.get_input()
+    defaults = orchestration_input["defaults"]
+    debounce = timedelta(seconds=defaults.get("BLOB_EVENT_DEBOUNCE_SECONDS", 5))
+    max_number_of_attempts = defaults["MAX_NUMBER_OF_ATTEMPTS"]
+    service_retry_options = RetryOptions(
+        first_retry_interval_in_milliseconds=3000, max_number_of_attempts=max_number_of_attempts
+    )
+    index_name = orchestration_input["index_name"]
+    event = orchestration_input.get("event")
+
+    if event is None:
+        # Continued after a burst: wait for events raised meanwhile, or complete once the blob is quiet
+        timer = context.create_timer(context.current_utc_datetime + debounce)
+        next_event = context.wait_for_external_event(BLOB_EVENT)
+        winner = yield context.task_any([timer, next_event])
+        if winner is timer:
+            return orchestration_input.get("status")
+        timer.cancel()
+        event = next_event.result
+
+    # Wait for a quiet period, restarting it with every new event
+    coalesced_events = 1
+    while True:
+        timer = context.create_timer(context.current_utc_datetime + debounce)
+        next_event = context.wait_for_external_event(BLOB_EVENT)
+        winner = yield context.task_any([timer, next_event])
+        if winner is timer:
+            break
+        timer.cancel()
+        event = next_event.result
+        coalesced_events += 1
+
+    blob_reference = None
+    if event["action"] == "created":
+        blob_reference = yield context.call_activity_with_retry("get_blob_reference", service_retry_options, event)
+    if blob_reference is None:
+        yield from _remove_blob(context, event, index_name, defaults.get("DEDUP_MODE", "off"), service_retry_options)
+        outcome = "removed"
+    else:
+        changed_blobs_result = yield context.call_activity(
+            "filter_changed_blobs", {"index_name": index_name, "blobs": [blob_reference], "force": False}
+        )
+        outcome = "unchanged"
+        if changed_blobs_result["blobs"]:
+            yield context.call_sub_orchestrator_with_retry(
+                name="index_document",
+                retry_options=RetryOptions(
+                    first_retry_interval_in_milliseconds=60_000, max_number_of_attempts=max_number_of_attempts
+                ),
+                input_={
+                    "blob_reference": changed_blobs_result["blobs"][0],
+                    "index_name": index_name,
+                    "max_number_of_attempts": max_number_of_attempts,
+                    "chunking": orchestration_input.get("chunking"),
+                    "dedup_mode": defaults.get("DEDUP_MODE", "off"),
+                    # Index existence is checked inside add_documents and cached per worker
+                    "ensure_index": True,
+                },
+            )
+            outcome = "indexed"
+
+    latency_seconds = (
+        _as_naive_utc(context.current_utc_datetime) - _as_naive_utc(datetime.fromisoformat(event["event_time"]))
+    ).total_seconds()
+    status = {
+        "blob_name": event["blob_name"],
+        "outcome": outcome,
+        "latency_seconds": latency_seconds,
+        "coalesced_events": coalesced_events,
+    }
+    context.set_custom_status(status)
+    if not context.is_replaying:
+        logging.info(
+            f"Blob event latency: {latency_seconds:.1f}s until {outcome} for {event['blob_name']}",
+            extra={"custom_dimensions": status},
+        )
+
+    # Ending the burst with continue_as_new keeps the history short and carries over events raised in the meantime
+    context.continue_as_new({**orchestration_input, "event": None, "status": status})
+    return status
+
+
+def _remove_blob(
+    context: DurableOrchestrationContext,
+    event: dict,
+    index_name: str,
+    dedup_mode: str,
+    service_retry_options: RetryOptions,
+):
+    blob_reference = {"container_name": event["container_name"], "blob_name": event["blob_name"]}
+    entry = yield context.call_activity("read_manifest", {"index_name": index_name, "blob_reference": blob_reference})
+    if entry is None:
+        return
+    if entry.get("chunk_ids"):
+        yield context.call_activity_with_retry(
+            "remove_documents", service_retry_options, {"document_ids": entry["chunk_ids"], "index_name": index_name}
+        )
+    if dedup_mode != "off":
+        # The removed chunks must no longer be found as originals of later duplicates
+        yield context.call_activity_with_retry(
+            "release_chunks", service_retry_options, {"index_name": index_name, "blob_reference": blob_reference}
+        )
+    yield context.call_activity("delete_manifest", {"index_name": index_name, "blob_reference": blob_reference})
@@ -0,0 +1,56 @@
+import pytest
+from activities.chunking import PageIndex
+from benchmarks.pages import linear_page_number
+
+# Page ends at 3, 3, 5 and 8; page 1 is empty
+PAGES = ["abc", "", "de", "fgh"]
+
+
+@pytest.mark.parametrize("position", range(0, 9))
+def test_page_number_matches_the_linear_lookup(position):
+    assert PageIndex(PAGES).page_number(position) == linear_page_number(position, PAGES)
+
+
+def test_page_number_is_the_page_of_the_character_before_the_position():
+    page_index = PageIndex(PAGES)
+    # An exclusive end on a page boundary belongs to the page that ends there
+    assert page_index.page_number(3) == 0
+    # The first character of page 2 follows the empty page 1
+    assert page_index.page_number(4) == 2
+    assert page_index.page_number(8) == 3
+
+
+def test_page_number_out_of_range():
+    with pytest.raises(ValueError):
+        PageIndex(PAGES).page_number(9)
+    with pytest.raises(ValueError):
+        PageIndex([]).page_number(1)
+
+
+def test_page_spans_skip_empty_pages():
+    assert PageIndex(PAGES).page_spans(0, 8) == [(0, 0, 3), (2, 0, 2), (3, 0, 3)]
+
+
+def test_page_spans_start_on_the_first_character_of_a_page():
+    page_index = PageIndex(PAGES)
+    assert page_index.page_spans(3, 4) == [(2, 0, 1)]
+    assert page_index.page_spans(5, 7) == [(3, 0, 2)]
+
+
+def test_page_spans_end_is_exclusive():
+    page_index = PageIndex(PAGES)
+    assert page_index.page_spans(1, 3) == [(0, 1, 3)]
+    assert page_index.page_spans(2, 2) == []
+
+
+def test_page_spans_out_of_range_are_clipped():
+    page_index = PageIndex(PAGES)
+    assert page_index.page_spans(6, 20) == [(3, 1, 3)]
+    assert page_index.page_spans(8, 10) == []
+
+
+def test_pages_appended_one_by_one_give_the_same_index():
+    page_index = PageIndex([])
+    for page in PAGES:
+        page_index.append(len(page))
+    assert page_index.page_ends == PageIndex(PAGES).page_ends
@@ -0,0 +1,124 @@
+import asyncio
+import random
+
+import pytest
+from activities import cracking
+from activities.layout_cache import LayoutCache
+from application.telemetry import span
+from azure.core.exceptions import HttpResponseError
+from benchmarks.fakes import (
+    PAGE_BREAK,
+    FakeBlob,
+    FakeBlobClient,
+    FakeBlobStore,
+    FakeDocumentClient,
+    ServiceProfile,
+    bad_request_error,
+)
+
+
+class RecordingDocumentClient(FakeDocumentClient):
+    """
+    Keeps whether each analysis got the document as a body or as a URL, and its page range. Page ranges in
+    `corrupt_ranges` are rejected like a document the service cannot read.
+    """
+
+    def __init__(self, store: FakeBlobStore):
+        super().__init__(store, ServiceProfile(), random.Random(0))
+        self.requests = []
+        self.corrupt_ranges = set()
+
+    async def begin_analyze_document(self, model_id: str, body, pages: str | None = None, **kwargs):
+        self.requests.append(("body" if hasattr(body, "read") else "url", pages))
+        if pages in self.corrupt_ranges:
+            raise bad_request_error("InvalidContent", "The file is corrupted or format is unsupported (fake).")
+        return await super().begin_analyze_document(model_id, body, pages, **kwargs)
+
+
+@pytest.fixture
+def services(monkeypatch):
+    store = FakeBlobStore(ServiceProfile(), random.Random(0))
+    document_client = RecordingDocumentClient(store)
+    downloads = []
+
+    async def download_blob(self, **kwargs):
+        downloads.append(self.blob_name)
+        return await original_download_blob(self, **kwargs)
+
+    async def read_sas(blob_client):
+        return "sig=fake"
+
+    original_download_blob = FakeBlobClient.download_blob
+    monkeypatch.setattr(FakeBlobClient, "download_blob", download_blob)
+    monkeypatch.setattr(cracking, "get_async_blob_service_client", lambda account_name: store)
+    monkeypatch.setattr(cracking, "get_async_document_client", lambda endpoint: document_client)
+    monkeypatch.setattr(cracking, "get_layout_cache", lambda: LayoutCache(None))
+    monkeypatch.setattr(cracking, "_read_sas", read_sas)
+    monkeypatch.setenv("CLAIM_CHECK_ENABLED", "false")
+    monkeypatch.setenv("CRACKING_SPLIT_MIN_BYTES", "1000")
+    monkeypatch.setenv("CRACKING_PAGE_RANGE_SIZE", "2")
+    monkeypatch.setenv("CRACKING_PAGE_RANGE_PARALLEL", "2")
+    cracking.get_claim_check_store.cache_clear()
+    yield store, document_client, downloads
+    cracking.get_claim_check_store.cache_clear()
+
+
+def crack(store: FakeBlobStore, name: str, data: bytes, content_type: str) -> dict:
+    store.add("source", FakeBlob(name, data, content_type))
+    blob_reference = {"container_name": "source", "blob_name": name, "size": len(data), "content_type": content_type}
+
+    async def run():
+        with span("document_cracking", None) as current:
+            return await cracking._crack_document(blob_reference, current)
+
+    return asyncio.run(run())
+
+
+def pdf_pages(count: int, page_bytes: int) -> bytes:
+    return PAGE_BREAK.join(f"page {number} ".ljust(page_bytes, "x") for number in range(1, count + 1)).encode()
+
+
+def test_large_pdfs_are_split_by_url_without_downloading_in_stream_mode(services, monkeypatch):
+    store, document_client, downloads = services
+    monkeypatch.setenv("CRACKING_SOURCE_MODE", "stream")
+    document = crack(store, "large.pdf", pdf_pages(5, 400), "application/pdf")
+
+    assert downloads == []
+    assert [page[:6] for page in document["pages"]] == [f"page {number}" for number in range(1, 6)]
+    assert document_client.requests == [("url", "1-2"), ("url", "3-4"), ("url", "5-6"), ("url", "7-8")]
+
+
+def test_declined_pdfs_are_analyzed_by_url_in_url_mode(services, monkeypatch):
+    store, document_client, downloads = services
+    monkeypatch.setenv("CRACKING_SOURCE_MODE", "url")
+    document = crack(store, "scan.pdf", pdf_pages(2, 10), "application/pdf")
+
+    assert len(document["pages"]) == 2
+    assert document_client.requests == [("url", None)]
+
+
+def test_declined_pdfs_are_streamed_in_stream_mode(services, monkeypatch):
+    store, document_client, downloads = services
+    monkeypatch.setenv("CRACKING_SOURCE_MODE", "stream")
+    crack(store, "scan.pdf", pdf_pages(2, 10), "application/pdf")
+
+    assert downloads == ["scan.pdf"]
+    assert document_client.requests == [("body", None)]
+
+
+def test_simple_formats_are_extracted_locally_in_url_mode(services, monkeypatch):
+    store, document_client, downloads = services
+    monkeypatch.setenv("CRACKING_SOURCE_MODE", "url")
+    document = crack(store, "notes.txt", b"plain text", "text/plain")
+
+    assert document["pages"] == ["plain text"]
+    assert document_client.requests == []
+
+
+def test_an_error_on_a_later_page_range_is_raised(services, monkeypatch):
+    store, document_client, downloads = services
+    monkeypatch.setenv("CRACKING_SOURCE_MODE", "url")
+    document_client.corrupt_ranges.add("3-4")
+
+    with pytest.raises(HttpResponseError, match="corrupted"):
+        crack(store, "large.pdf", pdf_pages(5, 400), "application/pdf")
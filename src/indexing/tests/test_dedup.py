@@ -0,0 +1,138 @@
+import json
+import random
+from array import array
+
+from activities.dedup import DedupIndex, deduplicate, minhash
+from benchmarks.fakes import MemoryContainerClient
+
+
+def texts(seed: int, count: int) -> list[str]:
+    random_source = random.Random(seed)
+    words = [f"word{i}" for i in range(500)]
+    return [" ".join(random_source.choice(words) for _ in range(60)) for _ in range(count)]
+
+
+def signature(claim: dict) -> array:
+    return array("I", bytes.fromhex(claim["signature"]))
+
+
+def chunks(chunk_texts: list[str]) -> list[dict]:
+    return [{"text": text, "token_count": 60} for text in chunk_texts]
+
+
+def test_chunks_are_originals_only_once_claimed():
+    dedup_index = DedupIndex(MemoryContainerClient(), max_workers=1)
+    _, _, claims = deduplicate(chunks(texts(1, 5)), "index", "source/a.pdf", "link", dedup_index)
+    assert len(claims) == 5
+
+    # a.pdf was not uploaded yet, so b.pdf is not linked to it
+    _, stats, _ = deduplicate(chunks(texts(1, 5)), "index", "source/b.pdf", "link", dedup_index)
+    assert stats["duplicates"] == 0
+
+    dedup_index.claim("index", "source/a.pdf", claims)
+    kept, stats, claims = deduplicate(chunks(texts(1, 5)), "index", "source/b.pdf", "link", dedup_index)
+    assert stats["duplicates"] == 5
+    assert claims == []
+    assert all(chunk["embedding_key"] for chunk in kept)
+
+
+def test_released_documents_are_no_longer_originals():
+    container = MemoryContainerClient()
+    dedup_index = DedupIndex(container, max_workers=1)
+    _, _, claims = deduplicate(chunks(texts(1, 5)), "index", "source/a.pdf", "skip", dedup_index)
+    dedup_index.claim("index", "source/a.pdf", claims)
+
+    buckets = {key[0] for claim in claims for key in dedup_index.band_keys("index", signature(claim))}
+    assert dedup_index.release("index", "source/a.pdf") == len(buckets)
+    # Only emptied buckets are left
+    assert sorted(container.blobs) == sorted(buckets)
+    assert all(json.loads(blob.data) == {} for blob in container.blobs.values())
+    _, stats, _ = deduplicate(chunks(texts(1, 5)), "index", "source/b.pdf", "skip", dedup_index)
+    assert stats["duplicates"] == 0
+
+
+def test_claiming_a_new_version_replaces_the_previous_entries():
+    container = MemoryContainerClient()
+    dedup_index = DedupIndex(container, max_workers=1)
+    unchanged, removed, added = texts(1, 4), texts(2, 2), texts(3, 1)
+    _, _, claims = deduplicate(chunks(unchanged + removed), "index", "source/a.pdf", "skip", dedup_index)
+    dedup_index.claim("index", "source/a.pdf", claims)
+
+    # In skip mode, the previous version of the same blob is not an original of the new one
+    _, stats, claims = deduplicate(chunks(unchanged + added), "index", "source/a.pdf", "skip", dedup_index)
+    assert stats["duplicates"] == 0
+    container.uploads = 0
+    # Only the buckets of the added and removed chunks and the document record are written
+    changed = {key[0] for claim in claims[len(unchanged) :] for key in dedup_index.band_keys("index", signature(claim))}
+    changed |= {key[0] for text in removed for key in dedup_index.band_keys("index", minhash(text))}
+    assert dedup_index.claim("index", "source/a.pdf", claims) == len(changed)
+    assert container.uploads == len(changed) + 1
+
+    _, stats, _ = deduplicate(chunks(removed), "index", "source/b.pdf", "skip", dedup_index)
+    assert stats["duplicates"] == 0
+    _, stats, _ = deduplicate(chunks(unchanged + added), "index", "source/b.pdf", "skip", dedup_index)
+    assert stats["duplicates"] == 5
+
+
+def test_a_band_key_shared_by_two_documents_survives_the_release_of_one():
+    dedup_index = DedupIndex(MemoryContainerClient(), max_workers=1)
+    # Neither document is claimed before both are deduplicated, as in a wave
+    claims = {
+        source: deduplicate(chunks(texts(1, 3)), "index", source, "link", dedup_index)[2]
+        for source in ("source/a.pdf", "source/b.pdf")
+    }
+    for source, source_claims in claims.items():
+        dedup_index.claim("index", source, source_claims)
+    dedup_index.release("index", "source/a.pdf")
+
+    _, stats, _ = deduplicate(chunks(texts(1, 3)), "index", "source/c.pdf", "link", dedup_index)
+    assert stats["duplicates"] == 3
+
+
+def test_a_large_document_reads_each_bucket_once():
+    container = MemoryContainerClient()
+    dedup_index = DedupIndex(container, buckets=4, max_workers=4)
+    _, _, claims = deduplicate(chunks(texts(1, 200)), "index", "source/a.pdf", "link", dedup_index)
+    assert dedup_index.claim("index", "source/a.pdf", claims) <= dedup_index.bands * 4
+
+    container.downloads = 0
+    _, stats, _ = deduplicate(chunks(texts(1, 200)), "index", "source/b.pdf", "link", dedup_index)
+    assert stats["duplicates"] == 200
+    # One read per bucket and one for the record of a.pdf, instead of one per band key
+    assert container.downloads == dedup_index.bands * 4 + 1
+
+
+def test_a_bucket_changed_by_another_worker_is_read_again():
+    container = MemoryContainerClient()
+    dedup_index = DedupIndex(container, buckets=1, max_workers=1)
+    _, _, claims = deduplicate(chunks(texts(1, 2)), "index", "source/a.pdf", "link", dedup_index)
+    dedup_index.claim("index", "source/a.pdf", claims)
+    upload_blob = container.upload_blob
+    conflicts = []
+
+    def upload_after_another_worker(name, data, overwrite=False, etag=None, **kwargs):
+        # Another worker writes the bucket between the read and the first conditional write
+        if etag is not None and not conflicts:
+            conflicts.append(name)
+            upload_blob(name, container.blobs[name].data, overwrite=True)
+        upload_blob(name, data, overwrite=overwrite, etag=etag, **kwargs)
+
+    container.upload_blob = upload_after_another_worker
+    _, _, claims = deduplicate(chunks(texts(2, 2)), "index", "source/b.pdf", "link", dedup_index)
+    dedup_index.claim("index", "source/b.pdf", claims)
+
+    assert conflicts
+    _, stats, _ = deduplicate(chunks(texts(1, 2) + texts(2, 2)), "index", "source/c.pdf", "link", dedup_index)
+    assert stats["duplicates"] == 4
+
+
+def test_tokens_are_saved_in_skip_mode_and_left_to_the_embedding_activity_in_link_mode():
+    dedup_index = DedupIndex(MemoryContainerClient(), max_workers=1)
+    # The second half repeats the first, so its originals are in the same document and not embedded yet
+    document = chunks(texts(1, 3) * 2)
+    _, link_stats, _ = deduplicate(document, "index", "source/a.pdf", "link", dedup_index)
+    _, skip_stats, _ = deduplicate(document, "index", "source/a.pdf", "skip", dedup_index)
+
+    assert link_stats["duplicates"] == skip_stats["duplicates"] == 3
+    assert link_stats["tokens_saved"] == 0
+    assert skip_stats["tokens_saved"] == 3 * 60
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+from activities import embedding_batcher
+from activities.embedding_batcher import EmbeddingBatcher
+from activities.vectors import from_base64
+from benchmarks.fakes import FakeEmbeddingServer, ServiceProfile, fake_embedding
+from openai import AsyncOpenAI, RateLimitError
+
+
+def test_batches_respect_the_token_and_item_limits():
+    batcher = EmbeddingBatcher(None, "model", max_batch_tokens=100, max_batch_items=3)
+
+    assert batcher.pack([40, 40, 40, 10, 10, 10, 10, 500, 5]) == [[0, 1], [2, 3, 4], [5, 6], [7], [8]]
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    """Records the retry delays of the batcher, and sleeps for them."""
+    recorded = []
+    sleep = asyncio.sleep
+
+    async def recording_sleep(delay, *args):
+        # This is asyncio.sleep itself, so the zero-delay yields of the HTTP stacks are left out
+        if delay:
+            recorded.append(delay)
+        await sleep(delay, *args)
+
+    monkeypatch.setattr(embedding_batcher.asyncio, "sleep", recording_sleep)
+    return recorded
+
+
+def embed(server: FakeEmbeddingServer, texts: list[str], **kwargs) -> tuple[EmbeddingBatcher, list]:
+    """Embeds the texts through an OpenAI client pointed at the fake server, ten tokens per text."""
+
+    async def run():
+        async with server:
+            client = AsyncOpenAI(base_url=server.base_url, api_key="fake", max_retries=0)
+            batcher = EmbeddingBatcher(client, "model", max_concurrency=8, **kwargs)
+            try:
+                return batcher, await batcher.embed(texts, [10] * len(texts))
+            finally:
+                await client.close()
+
+    return asyncio.run(run())
+
+
+def test_throttled_batches_wait_for_retry_after_and_keep_the_input_order(delays):
+    texts = [f"text {i}" for i in range(10)]
+    # The first two requests are answered with 429 and retry-after-ms: 100
+    server = FakeEmbeddingServer(ServiceProfile(throttle_first=2), dimensions=4)
+    batcher, vectors = embed(server, texts, max_batch_items=3)
+
+    assert [list(vector) for vector in vectors] == [list(from_base64(fake_embedding(text, 4))) for text in texts]
+    assert server.profile.throttled == 2
+    assert len(server.requests) == 4 + 2
+    assert all(request["encoding_format"] == "base64" for request in server.requests)
+    assert delays == [0.1, 0.1]
+    assert batcher.limiter.throttle_count == 2
+
+
+def test_retry_after_ms_takes_precedence_over_retry_after(delays):
+    server = FakeEmbeddingServer(ServiceProfile(throttle_first=1), dimensions=4, retry_after_ms=50, retry_after="5")
+    embed(server, ["text"])
+
+    assert delays == [0.05]
+
+
+def test_retry_after_in_seconds_is_honoured(delays):
+    server = FakeEmbeddingServer(ServiceProfile(throttle_first=1), dimensions=4, retry_after_ms=None, retry_after="0.2")
+    embed(server, ["text"])
+
+    assert delays == [0.2]
+
+
+def test_requests_are_given_up_after_max_attempts(delays):
+    server = FakeEmbeddingServer(ServiceProfile(throttle_rate=1.0), dimensions=4, retry_after_ms=1)
+    with pytest.raises(RateLimitError):
+        embed(server, ["text"], max_attempts=3)
+
+    assert len(server.requests) == 3
+    assert delays == [0.001, 0.001]
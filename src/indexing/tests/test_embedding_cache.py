@@ -0,0 +1,67 @@
+from datetime import timedelta
+from types import SimpleNamespace
+
+from activities.embedding_cache import BlobEmbeddingCache
+from activities.vectors import to_bytes
+from benchmarks.fakes import MemoryContainerClient
+
+
+def test_hits_move_entries_forward_in_size_eviction(monkeypatch):
+    container = MemoryContainerClient()
+    vector = [0.5] * 8
+    cache = BlobEmbeddingCache(container, max_bytes=2 * len(to_bytes(vector)), max_workers=1)
+    cache.put_many({"aa-old": vector})
+    container.now += timedelta(days=2)
+    cache.put_many({"bb-newer": vector, "cc-newest": vector})
+    container.now += timedelta(days=2)
+    monkeypatch.setattr("activities.embedding_cache.datetime", SimpleNamespace(now=lambda tz: container.now))
+
+    assert list(cache.get_many(["aa-old"])) == ["aa-old"]
+    assert cache.evict() == 1
+    assert sorted(cache.get_many(["aa-old", "bb-newer", "cc-newest"])) == ["aa-old", "cc-newest"]
+
+
+def test_hits_within_the_touch_interval_are_not_written(monkeypatch):
+    container = MemoryContainerClient()
+    cache = BlobEmbeddingCache(container, touch_interval_seconds=3600, max_workers=1)
+    cache.put_many({"aa-key": [1.0, 2.0]})
+    monkeypatch.setattr("activities.embedding_cache.datetime", SimpleNamespace(now=lambda tz: container.now))
+
+    cache.get_many(["aa-key"])
+    container.now += timedelta(minutes=30)
+    cache.get_many(["aa-key"])
+    assert container.metadata_writes == 0
+    container.now += timedelta(hours=1)
+    cache.get_many(["aa-key"])
+    assert container.metadata_writes == 1
+
+
+def test_age_eviction_uses_the_creation_time(monkeypatch):
+    container = MemoryContainerClient()
+    cache = BlobEmbeddingCache(container, max_age_seconds=86_400, touch_interval_seconds=0, max_workers=1)
+    cache.put_many({"aa-key": [1.0]})
+    container.now += timedelta(days=2)
+    monkeypatch.setattr("activities.embedding_cache.datetime", SimpleNamespace(now=lambda tz: container.now))
+
+    cache.get_many(["aa-key"])
+    assert cache.evict() == 1
+    assert cache.get_many(["aa-key"]) == {}
+
+
+def test_blobs_deleted_by_an_overlapping_pass_do_not_abort_eviction(monkeypatch):
+    container = MemoryContainerClient()
+    cache = BlobEmbeddingCache(container, max_age_seconds=86_400, max_workers=1)
+    cache.put_many({f"{i:03}-key": [1.0] for i in range(300)})
+    container.now += timedelta(days=2)
+    monkeypatch.setattr("activities.embedding_cache.datetime", SimpleNamespace(now=lambda tz: container.now))
+    list_blobs = container.list_blobs
+
+    def list_blobs_then_delete_one(**kwargs):
+        blobs = list_blobs(**kwargs)
+        container.delete_blob(blobs[0].name)
+        return blobs
+
+    container.list_blobs = list_blobs_then_delete_one
+    # Both batches are deleted; the missing blob is not counted
+    assert cache.evict() == 299
+    assert container.blobs == {}
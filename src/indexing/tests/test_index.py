@@ -0,0 +1,187 @@
+import json
+from datetime import datetime, timedelta
+
+from orchestrators.index import index
+
+DEFAULTS = {
+    "BLOB_CONTAINER_NAME": "source",
+    "SEARCH_INDEX_NAME": "index",
+    "BLOB_AMOUNT_PARALLEL": 2,
+    "MAX_NUMBER_OF_ATTEMPTS": 1,
+    "CONTINUE_AS_NEW_AFTER_DOCUMENTS": 25,
+}
+
+
+class Task:
+    def __init__(self, kind: str, payload=None):
+        self.kind = kind
+        self.payload = payload
+        self.result = None
+
+
+class ScriptedContext:
+    """
+    Minimal orchestration context for the index orchestrator over a container listed in `pages` of blob names. Blobs
+    whose name starts with "changed" pass the manifest filter; all others are skipped as unchanged. task_any is
+    answered by the oldest of its tasks, and every answer advances the clock by one second.
+    """
+
+    def __init__(self, orchestration_input: dict, pages: list[list[str]]):
+        # The input is serialized between generations, as the Durable Functions runtime does
+        self._input = json.loads(json.dumps(orchestration_input))
+        self._pages = pages
+        self._scheduled = 0
+        self.current_utc_datetime = datetime(2026, 1, 1)
+        self.is_replaying = False
+        self.calls = []
+        self.continued_with = None
+
+    def get_input(self):
+        return self._input
+
+    def call_activity(self, name, input_):
+        return self._schedule(name, input_)
+
+    def call_activity_with_retry(self, name, retry_options, input_):
+        return self._schedule(name, input_)
+
+    def call_sub_orchestrator_with_retry(self, name, retry_options, input_):
+        return self._schedule(name, input_)
+
+    def task_any(self, tasks):
+        return Task("any", tasks)
+
+    def task_all(self, tasks):
+        return Task("all", tasks)
+
+    def set_custom_status(self, status):
+        self.custom_status = status
+
+    def continue_as_new(self, input_):
+        self.continued_with = json.loads(json.dumps(input_))
+
+    def calls_to(self, name: str) -> list:
+        return [input_ for called, input_ in self.calls if called == name]
+
+    def _schedule(self, name, input_):
+        self.calls.append((name, input_))
+        task = Task("call", (name, input_))
+        task.order = self._scheduled
+        self._scheduled += 1
+        return task
+
+    def _complete(self, task: Task):
+        name, input_ = task.payload
+        task.result = getattr(self, "_" + name, lambda input_: None)(input_)
+        self.current_utc_datetime += timedelta(seconds=1)
+
+    def _list_blobs_chunk(self, input_):
+        page_number = input_["listing_state"] or 0
+        blobs = [{"container_name": "source", "blob_name": name, "size": 1} for name in self._pages[page_number]]
+        return {"blobs": blobs, "listing_state": page_number + 1, "done": page_number + 1 == len(self._pages)}
+
+    def _filter_changed_blobs(self, input_):
+        changed = [blob for blob in input_["blobs"] if blob["blob_name"].startswith("changed")]
+        return {"blobs": changed, "skipped": len(input_["blobs"]) - len(changed)}
+
+    def _index_document(self, input_):
+        return {"embedding_cache": {"hits": 0, "misses": 1}, "stage_seconds": {}, "dedup": None}
+
+    def _prepare_document(self, input_):
+        return {"chunks": [{"text": input_["blob_reference"]["blob_name"]}], "stage_seconds": {}, "dedup": None}
+
+    def _embedding(self, input_):
+        return {"chunk_sets": input_["chunk_sets"], "cache": {"hits": 0, "misses": 1}}
+
+    def _flush_documents(self, input_):
+        return {"document_ids": [[chunk["text"] for chunk in chunks] for chunks in input_["chunk_sets"]]}
+
+    def run(self):
+        generator = index.build().get_user_function().orchestrator_function(self)
+        value = None
+        try:
+            while True:
+                task = generator.send(value)
+                if task.kind == "any":
+                    value = min(task.payload, key=lambda waiting: waiting.order)
+                    self._complete(value)
+                elif task.kind == "all":
+                    for waiting in task.payload:
+                        self._complete(waiting)
+                    value = [waiting.result for waiting in task.payload]
+                else:
+                    self._complete(task)
+                    value = task.result
+        except StopIteration as stop:
+            return stop.value
+
+
+def run_generations(orchestration_input: dict, pages: list[list[str]]) -> tuple[dict, list[ScriptedContext]]:
+    """Runs the orchestrator, continuing as new until it completes. Returns its result and one context per run."""
+    contexts = []
+    while True:
+        context = ScriptedContext(orchestration_input, pages)
+        contexts.append(context)
+        result = context.run()
+        if context.continued_with is None:
+            return result, contexts
+        orchestration_input = context.continued_with
+
+
+def test_unchanged_blobs_count_towards_continue_as_new():
+    pages = [[f"unchanged-{page}-{i}" for i in range(10)] for page in range(10)]
+    _, contexts = run_generations({"defaults": DEFAULTS}, pages)
+
+    # Each page adds one listing call and ten skipped blobs, so a generation lists at most three pages
+    assert len(contexts) > 1
+    assert all(len(context.calls_to("list_blobs_chunk")) <= 3 for context in contexts)
+    assert sum(len(context.calls_to("list_blobs_chunk")) for context in contexts) == 10
+    assert contexts[-1].custom_status["documents_skipped"] == 100
+
+
+def test_a_generation_drains_its_documents_and_carries_the_queue():
+    pages = [[f"changed-{i}" for i in range(40)]]
+    context = ScriptedContext({"defaults": DEFAULTS}, pages)
+    context.run()
+
+    state = context.continued_with["state"]
+    started = len(context.calls_to("index_document"))
+    # One listing call and 24 documents reach the threshold; every started document finished before the restart
+    assert started == 24
+    assert state["stats"]["documents_indexed"] == started
+    assert len(state["pending_blobs"]) == 40 - started
+    assert state["listing_done"]
+    assert state["index_ensured"]
+
+
+def test_the_next_generation_resumes_from_the_carried_state():
+    pages = [
+        [f"changed-{page}-{i}" for i in range(3)] + [f"unchanged-{page}-{i}" for i in range(12)] for page in range(6)
+    ]
+    result, contexts = run_generations({"defaults": DEFAULTS}, pages)
+
+    assert len(contexts) > 1
+    assert result["documents_indexed"] == 18
+    assert result["documents_skipped"] == 72
+    assert result["embedding_cache"] == {"hits": 0, "misses": 18}
+    indexed = [
+        call["blob_reference"]["blob_name"] for context in contexts for call in context.calls_to("index_document")
+    ]
+    assert sorted(indexed) == sorted(name for page in pages for name in page if name.startswith("changed"))
+    listed_pages = [call["listing_state"] for context in contexts for call in context.calls_to("list_blobs_chunk")]
+    assert listed_pages == [None, 1, 2, 3, 4, 5]
+    # The index is only ensured by the first generation
+    assert sum(len(context.calls_to("ensure_index_exists")) for context in contexts) == 1
+
+
+def test_wave_mode_counts_unchanged_blobs_and_keeps_the_upload_buffer():
+    defaults = {**DEFAULTS, "EMBEDDING_MODE": "wave", "SEARCH_BUFFER_MAX_SECONDS": 3600}
+    pages = [[f"changed-{page}"] + [f"unchanged-{page}-{i}" for i in range(9)] for page in range(8)]
+    result, contexts = run_generations({"defaults": defaults}, pages)
+
+    assert len(contexts) > 1
+    # The upload buffer is carried into the next generations and flushed once at the end
+    assert contexts[0].continued_with["state"]["upload_buffer"]
+    assert [len(context.calls_to("flush_documents")) for context in contexts] == [0] * (len(contexts) - 1) + [1]
+    assert result["documents_indexed"] == 8
+    assert result["documents_skipped"] == 72
@@ -0,0 +1,131 @@
+from datetime import datetime, timedelta
+
+from orchestrators.index_blob import index_blob
+
+DEFAULTS = {"MAX_NUMBER_OF_ATTEMPTS": 1, "BLOB_EVENT_DEBOUNCE_SECONDS": 5}
+
+
+class Task:
+    def __init__(self, kind: str, payload=None):
+        self.kind = kind
+        self.payload = payload
+        self.result = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ScriptedContext:
+    """
+    Minimal orchestration context. Each task_any is answered from `arrivals`, a list with an event dict (the event
+    wins) or None (the timer wins); activities are answered by `activity_results`.
+    """
+
+    def __init__(self, orchestration_input: dict, arrivals: list, activity_results: dict):
+        self._input = orchestration_input
+        self._arrivals = list(arrivals)
+        self._activity_results = activity_results
+        self.current_utc_datetime = datetime(2026, 1, 1)
+        self.is_replaying = False
+        self.activities = []
+        self.continued_with = None
+
+    def get_input(self):
+        return self._input
+
+    def create_timer(self, fire_at):
+        return Task("timer", fire_at)
+
+    def wait_for_external_event(self, name):
+        return Task("event", name)
+
+    def task_any(self, tasks):
+        return Task("any", tasks)
+
+    def call_activity(self, name, input_):
+        return Task("activity", (name, input_))
+
+    def call_activity_with_retry(self, name, retry_options, input_):
+        return Task("activity", (name, input_))
+
+    def call_sub_orchestrator_with_retry(self, name, retry_options, input_):
+        return Task("activity", (name, input_))
+
+    def set_custom_status(self, status):
+        self.custom_status = status
+
+    def continue_as_new(self, input_):
+        self.continued_with = input_
+
+    def run(self):
+        generator = index_blob.build().get_user_function().orchestrator_function(self)
+        value = None
+        try:
+            while True:
+                task = generator.send(value)
+                if task.kind == "any":
+                    timer, event = task.payload
+                    arrival = self._arrivals.pop(0)
+                    if arrival is None:
+                        value = timer
+                    else:
+                        event.result = arrival
+                        value = event
+                    self.current_utc_datetime += timedelta(seconds=1)
+                else:
+                    name, input_ = task.payload
+                    self.activities.append(name)
+                    value = self._activity_results.get(name)
+        except StopIteration as stop:
+            return stop.value
+
+
+def blob_event(action: str) -> dict:
+    return {
+        "action": action,
+        "container_name": "source",
+        "blob_name": "a/report.pdf",
+        "event_time": "2026-01-01T00:00:00",
+    }
+
+
+def test_a_burst_is_processed_once_and_continued_as_new():
+    context = ScriptedContext(
+        {"event": blob_event("created"), "index_name": "index", "defaults": DEFAULTS},
+        arrivals=[blob_event("created"), blob_event("deleted"), None],
+        activity_results={"get_blob_reference": None, "read_manifest": None},
+    )
+    status = context.run()
+
+    assert status["coalesced_events"] == 3
+    assert status["outcome"] == "removed"
+    assert context.activities == ["read_manifest"]
+    # Events raised from here on are picked up by the continued instance
+    assert context.continued_with["event"] is None
+    assert context.continued_with["status"] == status
+
+
+def test_a_continued_instance_picks_up_a_buffered_event():
+    context = ScriptedContext(
+        {"event": None, "index_name": "index", "defaults": DEFAULTS, "status": {"outcome": "removed"}},
+        arrivals=[blob_event("deleted"), None],
+        activity_results={"read_manifest": None},
+    )
+    status = context.run()
+
+    assert status["coalesced_events"] == 1
+    assert context.continued_with is not None
+
+
+def test_a_continued_instance_completes_when_the_blob_is_quiet():
+    previous_status = {"outcome": "indexed"}
+    context = ScriptedContext(
+        {"event": None, "index_name": "index", "defaults": DEFAULTS, "status": previous_status},
+        arrivals=[None],
+        activity_results={},
+    )
+
+    assert context.run() == previous_status
+    assert context.activities == []
+    assert context.continued_with is None
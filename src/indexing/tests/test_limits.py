@@ -0,0 +1,123 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from application import limits
+from application.limits import AdaptiveLimiter, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(limits.time, "monotonic", clock)
+    return clock
+
+
+def test_requests_larger_than_the_burst_are_paced_to_the_rate(clock):
+    bucket = TokenBucket(100)
+    started_at = clock.now
+    for _ in range(10):
+        while wait := bucket.try_take(500):
+            clock.now += wait
+    # The first request is paid for by the full bucket, the other nine at 100 units per second
+    assert clock.now - started_at == pytest.approx(9 * 500 / 100)
+
+
+def test_small_requests_use_the_burst_and_then_the_rate(clock):
+    bucket = TokenBucket(100)
+    assert [bucket.try_take(25) for _ in range(4)] == [0.0] * 4
+    assert bucket.try_take(50) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.try_take(50) == 0.0
+
+
+def test_waiters_acquire_slots_in_arrival_order():
+    async def run():
+        limiter = AdaptiveLimiter("test", 1, max_limit=1)
+        acquired = []
+
+        async def request(name: str):
+            async with limiter.async_slot():
+                acquired.append(name)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(request(name) for name in "abcde"))
+        return acquired
+
+    assert asyncio.run(run()) == list("abcde")
+
+
+def test_a_large_request_is_not_overtaken_by_small_ones():
+    async def run():
+        limiter = AdaptiveLimiter("test", 4, units_per_second=1000)
+        acquired = []
+
+        async def request(name: str, units: int):
+            async with limiter.async_slot(units):
+                acquired.append(name)
+
+        # The first request empties the bucket; the large one waits 0.5 s for the budget and the small ones behind it
+        await request("first", 1000)
+        await asyncio.gather(request("large", 500), request("small-1", 1), request("small-2", 1))
+        return acquired
+
+    assert asyncio.run(run()) == ["first", "large", "small-1", "small-2"]
+
+
+def test_a_thread_waiting_for_a_slot_is_woken_by_the_release():
+    limiter = AdaptiveLimiter("test", 1, max_limit=1)
+    release = threading.Event()
+    waited = []
+
+    def holder():
+        with limiter.slot():
+            release.wait()
+
+    def waiter():
+        started_at = time.monotonic()
+        with limiter.slot():
+            waited.append(time.monotonic() - started_at)
+
+    threads = [threading.Thread(target=holder), threading.Thread(target=waiter)]
+    threads[0].start()
+    while limiter.in_flight == 0:
+        time.sleep(0.001)
+    threads[1].start()
+    time.sleep(0.05)
+    assert waited == []
+    release.set()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert len(waited) == 1
+    assert limiter.in_flight == 0
+
+
+def test_a_cancelled_waiter_leaves_the_queue():
+    async def run():
+        limiter = AdaptiveLimiter("test", 1, max_limit=1)
+        acquired = []
+
+        async def request(name: str):
+            async with limiter.async_slot():
+                acquired.append(name)
+                await asyncio.sleep(0.01)
+
+        holder = asyncio.create_task(request("holder"))
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(request("cancelled"))
+        later = asyncio.create_task(request("later"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.gather(holder, later)
+        return acquired, limiter.in_flight
+
+    assert asyncio.run(run()) == (["holder", "later"], 0)
@@ -0,0 +1,61 @@
+import asyncio
+import random
+
+import pytest
+from activities.listblob import BlobLister
+from benchmarks.fakes import FakeBlob, FakeBlobStore, ServiceProfile
+
+
+def nested_store() -> tuple[FakeBlobStore, set]:
+    """Blobs at the root and one to four levels deep, with directories of very different sizes."""
+    store = FakeBlobStore(ServiceProfile(), random.Random(0))
+    names = {"root.pdf", "a.txt"}
+    names |= {f"big/{i:04d}.pdf" for i in range(250)}
+    names |= {f"big/sub/{i:03d}.pdf" for i in range(40)}
+    names |= {f"deep/x/y/z/{i:02d}.md" for i in range(30)}
+    names |= {f"wide/{d:02d}/{i}.md" for d in range(20) for i in range(7)}
+    names |= {"empty-looking/only/one.pdf", "big.pdf", "big-sibling/file.pdf"}
+    for name in names:
+        store.add("source", FakeBlob(name, name.encode(), "application/pdf"))
+    return store, names
+
+
+def list_all(lister: BlobLister, page_size: int) -> tuple[list, int]:
+    async def run():
+        state, blobs, rounds = lister.initial_state(), [], 0
+        while not lister.is_done(state):
+            blobs.extend(blob.name for blob in await lister.next_chunk(state, page_size))
+            rounds += 1
+        return blobs, rounds
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("max_depth", [0, 1, 2, 4])
+@pytest.mark.parametrize("page_size", [1, 7, 1000])
+def test_nested_prefixes_are_listed_completely_and_once(max_depth, page_size):
+    store, names = nested_store()
+    lister = BlobLister(store.get_container_client("source"), [""], max_parallel=3, max_depth=max_depth)
+    listed, _ = list_all(lister, page_size)
+
+    assert len(listed) == len(set(listed))
+    assert set(listed) == names
+
+
+def test_every_prefix_list_entry_is_listed():
+    store, names = nested_store()
+    lister = BlobLister(store.get_container_client("source"), ["big/", "wide/03/", "deep/"], max_parallel=2)
+    listed, _ = list_all(lister, 50)
+
+    assert len(listed) == len(set(listed))
+    assert set(listed) == {name for name in names if name.startswith(("big/", "wide/03/", "deep/"))}
+
+
+def test_page_size_does_not_depend_on_the_number_of_cursors():
+    store, names = nested_store()
+    lister = BlobLister(store.get_container_client("source"), [""], max_parallel=8, max_depth=1)
+    listed, rounds = list_all(lister, 1000)
+
+    assert set(listed) == names
+    # One round for the root, one for its directories; small pages would take dozens
+    assert rounds <= 3
@@ -0,0 +1,82 @@
+import threading
+import time
+
+import pytest
+from activities import manifest
+from activities.manifest import ManifestStore
+from benchmarks.fakes import MemoryContainerClient
+
+
+def blob(name: str, etag: str = '"1"', content_md5: str | None = None) -> dict:
+    return {
+        "container_name": "source",
+        "blob_name": name,
+        "etag": etag,
+        "content_md5": content_md5,
+        "last_modified": "2026-01-01T00:00:00+00:00",
+    }
+
+
+@pytest.fixture
+def store(monkeypatch) -> ManifestStore:
+    store = ManifestStore(MemoryContainerClient(), max_workers=4)
+    monkeypatch.setattr(manifest, "get_manifest_store", lambda: store)
+    return store
+
+
+def filter_changed_blobs(blobs: list[dict], force: bool = False) -> dict:
+    return manifest.filter_changed_blobs.build().get_user_function()(
+        {"index_name": "index", "blobs": blobs, "force": force}
+    )
+
+
+def test_only_changed_and_new_blobs_pass_the_filter(store):
+    store.put("index", blob("unchanged.pdf"), ["u-1"])
+    store.put("index", blob("unchanged-md5.pdf", content_md5="md5"), ["m-1"])
+    store.put("index", blob("changed.pdf"), ["c-1", "c-2"])
+    blobs = [
+        blob("new.pdf"),
+        blob("unchanged.pdf"),
+        blob("changed.pdf", etag='"2"'),
+        # A new ETag with the same content is not a change
+        blob("unchanged-md5.pdf", etag='"2"', content_md5="md5"),
+    ]
+
+    result = filter_changed_blobs(blobs)
+    assert result["skipped"] == 2
+    assert [(blob["blob_name"], blob["previous_chunk_ids"]) for blob in result["blobs"]] == [
+        ("new.pdf", []),
+        ("changed.pdf", ["c-1", "c-2"]),
+    ]
+
+    assert len(filter_changed_blobs(blobs, force=True)["blobs"]) == 4
+
+
+def test_manifest_entries_are_read_concurrently_and_kept_in_order(store):
+    names = [f"{i}.pdf" for i in range(20)]
+    for name in names[::2]:
+        store.put("index", blob(name), [name])
+    get_blob_client = store.container_client.get_blob_client
+    in_flight, peak, lock = [0], [0], threading.Lock()
+
+    class SlowBlobClient:
+        def __init__(self, name: str):
+            self.blob_client = get_blob_client(name)
+
+        def download_blob(self, **kwargs):
+            with lock:
+                in_flight[0] += 1
+                peak[0] = max(peak[0], in_flight[0])
+            try:
+                time.sleep(0.01)
+                return self.blob_client.download_blob(**kwargs)
+            finally:
+                with lock:
+                    in_flight[0] -= 1
+
+    store.container_client.get_blob_client = SlowBlobClient
+    entries = store.get_many("index", [blob(name) for name in names])
+
+    expected = [[name] if i % 2 == 0 else None for i, name in enumerate(names)]
+    assert [entry and entry["chunk_ids"] for entry in entries] == expected
+    assert 1 < peak[0] <= store.max_workers
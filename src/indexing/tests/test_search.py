@@ -0,0 +1,236 @@
+import asyncio
+import random
+from types import SimpleNamespace
+
+import pytest
+from activities import claim_check, search
+from activities.search import AzureOpenAIEmbeddingConfig, SearchInfo, SearchManager, UploadOptions
+from activities.vector_settings import VectorSettings
+from azure.core.exceptions import HttpResponseError
+from benchmarks.fakes import FakeSearchClient, ServiceProfile
+
+
+class RecordingIndexClient:
+    """Stands in for the async SearchIndexClient and keeps the index that create_index sends."""
+
+    def __init__(self):
+        self.created = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def list_index_names(self):
+        for name in ():
+            yield name
+
+    async def create_index(self, index):
+        self.created = index
+        return index
+
+
+def create_index(settings: VectorSettings) -> dict:
+    """The index definition as it is sent to the service."""
+    search_info = SearchInfo("https://search.example", credential=None, index_name="test-index")
+    client = RecordingIndexClient()
+    search_info.get_search_index_client = lambda: client
+    embeddings = AzureOpenAIEmbeddingConfig("embedding", settings.model_name, settings.dimensions, "https://aoai.example")
+    asyncio.run(SearchManager(search_info, embeddings, vector_settings=settings).create_index())
+    search._existing_indexes.discard((search_info.endpoint, search_info.index_name))
+    return client.created.as_dict()
+
+
+def embedding_field(index: dict) -> dict:
+    return next(field for field in index["fields"] if field["name"] == "embedding")
+
+
+@pytest.mark.parametrize("compression", ["none", "scalar", "binary"])
+def test_create_index_with_shortened_vectors(compression):
+    settings = VectorSettings(dimensions=1024, compression=compression)
+    index = create_index(settings)
+
+    assert embedding_field(index)["dimensions"] == 1024
+    # The query vectorizer follows the field's size; 12.x has no dimensions parameter for it
+    assert "dimensions" not in index["vectorSearch"]["vectorizers"][0]["azureOpenAIParameters"]
+    compressions = [item["name"] for item in index["vectorSearch"].get("compressions") or []]
+    assert compressions == ([] if compression == "none" else [f"{compression}_compression"])
+
+
+def test_create_index_with_rescoring_options():
+    settings = VectorSettings(compression="binary", oversampling=8, keep_originals=False)
+    index = create_index(settings)
+
+    rescoring = index["vectorSearch"]["compressions"][0]["rescoringOptions"]
+    assert rescoring == {"enableRescoring": True, "defaultOversampling": 8, "rescoreStorageMethod": "discardOriginals"}
+    assert index["vectorSearch"]["profiles"][0]["compression"] == "binary_compression"
+
+
+def test_create_index_without_stored_vectors():
+    index = create_index(VectorSettings(stored=False))
+
+    field = embedding_field(index)
+    assert field["stored"] is False
+    assert field["retrievable"] is False
+
+
+class ScriptedSearchClient(FakeSearchClient):
+    """
+    FakeSearchClient that answers the uploads of a key with the statuses scripted for it, one per attempt, and then
+    accepts it. A status in `request_errors` fails the whole request instead, once per entry.
+    """
+
+    def __init__(self, statuses: dict[str, list[int]] | None = None, request_errors: list[int] | None = None):
+        super().__init__(ServiceProfile(), random.Random(0))
+        self.statuses = {key: list(key_statuses) for key, key_statuses in (statuses or {}).items()}
+        self.request_errors = list(request_errors or [])
+        self.requests = []
+
+    async def upload_documents(self, documents: list[dict]):
+        self.requests.append([document["id"] for document in documents])
+        if self.request_errors:
+            error = HttpResponseError(message="Service unavailable (fake)")
+            error.status_code = self.request_errors.pop(0)
+            raise error
+        results = []
+        for document in documents:
+            key_statuses = self.statuses.get(document["id"])
+            if key_statuses:
+                status_code = key_statuses.pop(0)
+                results.append(
+                    SimpleNamespace(key=document["id"], succeeded=False, status_code=status_code, error_message="fake")
+                )
+            else:
+                self.documents[document["id"]] = document
+                results.append(SimpleNamespace(key=document["id"], succeeded=True, status_code=201, error_message=None))
+        return results
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    delays = []
+
+    async def sleep(seconds):
+        delays.append(seconds)
+
+    monkeypatch.setattr(search.asyncio, "sleep", sleep)
+    return delays
+
+
+def search_manager(client: FakeSearchClient, upload_options: UploadOptions | None = None) -> SearchManager:
+    search_info = SearchInfo("https://search.example", credential=None, index_name="test-index")
+    search_info.get_search_client = lambda: client
+    embeddings = AzureOpenAIEmbeddingConfig("embedding", "text-embedding-3-large", 3072, "https://aoai.example")
+    return SearchManager(search_info, embeddings, upload_options)
+
+
+def upload(chunk_sets: list) -> tuple:
+    client = FakeSearchClient(ServiceProfile(), random.Random(0))
+    result = asyncio.run(search_manager(client).update_contents(chunk_sets))
+    return result["document_ids"], client.documents
+
+
+def chunk(url: str, text: str = "text") -> dict:
+    filename = url.split("?")[0].rsplit("/", 1)[-1]
+    return {"text": text, "filename": filename, "url": url, "page_spans": [[0, 0, 4]], "embedding": [0.1]}
+
+
+def test_chunk_ids_are_distinct_for_the_same_file_name_in_different_folders():
+    first = "https://account.blob.core.windows.net/source/a/report.pdf?sv=token"
+    second = "https://account.blob.core.windows.net/source/b/report.pdf"
+    document_ids, documents = upload([[chunk(first), chunk(first)], [chunk(second)]])
+
+    assert len(set(document_ids[0]) | set(document_ids[1])) == 3
+    assert documents[document_ids[1][0]]["storageUrl"] == second
+    # The SAS token is not part of the blob's identity
+    assert upload([[chunk(first.split("?")[0])]])[0][0][0] == document_ids[0][0]
+
+
+def documents(count: int, text_chars: int = 100) -> list[dict]:
+    return [
+        {"id": f"doc-{i}", "content": "x" * text_chars, "sourcepages": "a.pdf#pages=1", "embedding": [0.1] * 8}
+        for i in range(count)
+    ]
+
+
+def test_batches_are_bounded_by_bytes_and_size():
+    document_bytes = SearchManager._document_bytes(documents(1)[0])
+    by_bytes = search_manager(None, UploadOptions(max_batch_bytes=int(2.5 * document_bytes), max_batch_size=3))
+    by_size = search_manager(None, UploadOptions(max_batch_bytes=100 * document_bytes, max_batch_size=3))
+
+    assert [len(batch) for batch in by_bytes._batch_by_size(documents(5))] == [2, 2, 1]
+    assert [len(batch) for batch in by_size._batch_by_size(documents(7))] == [3, 3, 1]
+    batches = by_bytes._batch_by_size(documents(5))
+    assert [document["id"] for batch in batches for document in batch] == [f"doc-{i}" for i in range(5)]
+
+
+def test_a_document_over_the_byte_limit_is_sent_alone():
+    manager = search_manager(None, UploadOptions(max_batch_bytes=1000))
+    batches = manager._batch_by_size(documents(1) + documents(1, text_chars=2000) + documents(1))
+
+    assert [len(batch) for batch in batches] == [1, 1, 1]
+
+
+@pytest.mark.parametrize("status_code", [409, 422, 429, 503])
+def test_transient_failures_are_retried_per_key(no_backoff, status_code):
+    chunks = [chunk(f"https://account.blob.core.windows.net/source/{i}.pdf") for i in range(4)]
+    client = ScriptedSearchClient()
+    manager = search_manager(client)
+    document_ids = asyncio.run(manager.update_contents([chunks]))["document_ids"][0]
+    client = ScriptedSearchClient({document_ids[1]: [status_code], document_ids[3]: [status_code, status_code]})
+    result = asyncio.run(search_manager(client).update_contents([chunks]))
+
+    # Only the failed keys are sent again
+    assert client.requests == [document_ids, [document_ids[1], document_ids[3]], [document_ids[3]]]
+    assert result["succeeded"] == 4
+    assert result["failed"] == 0
+    assert len(no_backoff) == 2
+
+
+def test_throttled_requests_are_retried_and_slow_down_the_limiter(no_backoff):
+    client = FakeSearchClient(ServiceProfile(throttle_first=1), random.Random(0))
+    manager = search_manager(client)
+    result = asyncio.run(manager.update_contents([[chunk("https://account.blob.core.windows.net/source/a.pdf")]]))
+
+    assert result["succeeded"] == 1
+    assert manager.upload_options.limiter.throttle_count == 1
+
+
+def test_a_failed_request_is_retried_as_a_whole(no_backoff):
+    client = ScriptedSearchClient(request_errors=[503])
+    chunks = [chunk(f"https://account.blob.core.windows.net/source/{i}.pdf") for i in range(3)]
+    result = asyncio.run(search_manager(client).update_contents([chunks]))
+
+    assert len(client.requests) == 2
+    assert client.requests[0] == client.requests[1]
+    assert result["succeeded"] == 3
+
+
+def test_rejected_and_exhausted_keys_are_reported_as_failed(no_backoff):
+    chunks = [chunk(f"https://account.blob.core.windows.net/source/{i}.pdf") for i in range(3)]
+    document_ids = asyncio.run(search_manager(ScriptedSearchClient()).update_contents([chunks]))["document_ids"][0]
+    client = ScriptedSearchClient({document_ids[0]: [400], document_ids[2]: [503] * 5})
+    result = asyncio.run(search_manager(client, UploadOptions(max_attempts=3)).update_contents([chunks]))
+
+    assert result["succeeded"] == 1
+    assert result["failed"] == 2
+    assert sorted(result["failed_keys"]) == sorted([document_ids[0], document_ids[2]])
+    # A rejected key is not retried, a transient failure is retried until max_attempts
+    assert [len(request) for request in client.requests] == [3, 1, 1]
+
+
+def test_flush_documents_fails_when_keys_failed(no_backoff, monkeypatch):
+    chunks = [chunk(f"https://account.blob.core.windows.net/source/{i}.pdf") for i in range(2)]
+    document_ids = asyncio.run(search_manager(ScriptedSearchClient()).update_contents([chunks]))["document_ids"][0]
+    client = ScriptedSearchClient({document_ids[1]: [400]})
+    monkeypatch.setattr(search, "create_search_manager", lambda index_name: search_manager(client))
+    monkeypatch.setenv("CLAIM_CHECK_ENABLED", "false")
+    claim_check.get_claim_check_store.cache_clear()
+    try:
+        with pytest.raises(RuntimeError, match="1 of 2 documents failed"):
+            flush_documents = search.flush_documents.build().get_user_function()
+            asyncio.run(flush_documents({"index_name": "test-index", "chunk_sets": [chunks]}))
+    finally:
+        claim_check.get_claim_check_store.cache_clear()
+    assert list(client.documents) == [document_ids[0]]
@@ -2,13 +2,18 @@ import json
 import logging
 
 import azure.functions as func
+from snippet_store import get_snippet_store
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
 
-# Constants for the Azure Blob Storage container, file, and blob path
+# Names of the tool arguments; snippets are stored as snippets/<name>.json blobs (see snippet_store.py)
 _SNIPPET_NAME_PROPERTY_NAME = "snippetname"
 _SNIPPET_PROPERTY_NAME = "snippet"
-_BLOB_PATH = "snippets/{mcptoolargs." + _SNIPPET_NAME_PROPERTY_NAME + "}.json"
+_SNIPPET_NAMES_PROPERTY_NAME = "snippetnames"
+_SNIPPETS_PROPERTY_NAME = "snippets"
+_PREFIX_PROPERTY_NAME = "prefix"
+# Upper bound on the snippets read, written or listed by one batch tool call
+_MAX_BATCH_SIZE = 1000
 
 
 class ToolProperty:
@@ -33,9 +38,43 @@ tool_properties_save_snippets_object = [
 
 tool_properties_get_snippets_object = [ToolProperty(_SNIPPET_NAME_PROPERTY_NAME, "string", "The name of the snippet.")]
 
+tool_properties_get_snippets_batch_object = [
+    ToolProperty(
+        _SNIPPET_NAMES_PROPERTY_NAME, "string", "The names of the snippets, as a JSON array or comma-separated."
+    ),
+]
+
+tool_properties_save_snippets_batch_object = [
+    ToolProperty(_SNIPPETS_PROPERTY_NAME, "string", "A JSON object that maps each snippet name to its content."),
+]
+
+tool_properties_list_snippets_object = [
+    ToolProperty(_PREFIX_PROPERTY_NAME, "string", "Only list snippets whose name starts with this prefix (optional)."),
+]
+
 # Convert the tool properties to JSON
 tool_properties_save_snippets_json = json.dumps([prop.to_dict() for prop in tool_properties_save_snippets_object])
 tool_properties_get_snippets_json = json.dumps([prop.to_dict() for prop in tool_properties_get_snippets_object])
+tool_properties_get_snippets_batch_json = json.dumps(
+    [prop.to_dict() for prop in tool_properties_get_snippets_batch_object]
+)
+tool_properties_save_snippets_batch_json = json.dumps(
+    [prop.to_dict() for prop in tool_properties_save_snippets_batch_object]
+)
+tool_properties_list_snippets_json = json.dumps([prop.to_dict() for prop in tool_properties_list_snippets_object])
+
+
+def _tool_arguments(context) -> dict:
+    return json.loads(context).get("arguments") or {}
+
+
+def _parse_names(value) -> list:
+    if isinstance(value, list):
+        return [str(name) for name in value if name]
+    value = (value or "").strip()
+    if value.startswith("["):
+        return [str(name) for name in json.loads(value) if name]
+    return [name.strip() for name in value.split(",") if name.strip()]
 
 
 @app.generic_trigger(
@@ -65,20 +104,24 @@ def hello_mcp(context) -> None:
     description="Retrieve a snippet by name.",
     toolProperties=tool_properties_get_snippets_json,
 )
-@app.generic_input_binding(arg_name="file", type="blob", connection="AzureWebJobsStorage", path=_BLOB_PATH)
-def get_snippet(file: func.InputStream, context) -> str:
+def get_snippet(context) -> str:
     """
-    Retrieves a snippet by name from Azure Blob Storage.
+    Retrieves a snippet by name from Azure Blob Storage, through the in-process snippet cache.
 
     Args:
-        file (func.InputStream): The input binding to read the snippet from Azure Blob Storage.
         context: The trigger context containing the input arguments.
 
     Returns:
         str: The content of the snippet or an error message.
     """
-    snippet_content = file.read().decode("utf-8")
-    logging.info(f"Retrieved snippet: {snippet_content}")
+    snippet_name = _tool_arguments(context).get(_SNIPPET_NAME_PROPERTY_NAME)
+    if not snippet_name:
+        return "No snippet name provided"
+
+    snippet_content = get_snippet_store().get(snippet_name)
+    if snippet_content is None:
+        return f"Snippet '{snippet_name}' not found"
+    logging.info(f"Retrieved snippet: {snippet_name}")
     return snippet_content
 
 
@@ -89,11 +132,10 @@ def get_snippet(file: func.InputStream, context) -> str:
     description="Save a snippet with a name.",
     toolProperties=tool_properties_save_snippets_json,
 )
-@app.generic_output_binding(arg_name="file", type="blob", connection="AzureWebJobsStorage", path=_BLOB_PATH)
-def save_snippet(file: func.Out[str], context) -> str:
-    content = json.loads(context)
-    snippet_name_from_args = content["arguments"][_SNIPPET_NAME_PROPERTY_NAME]
-    snippet_content_from_args = content["arguments"][_SNIPPET_PROPERTY_NAME]
+def save_snippet(context) -> str:
+    arguments = _tool_arguments(context)
+    snippet_name_from_args = arguments.get(_SNIPPET_NAME_PROPERTY_NAME)
+    snippet_content_from_args = arguments.get(_SNIPPET_PROPERTY_NAME)
 
     if not snippet_name_from_args:
         return "No snippet name provided"
@@ -101,6 +143,73 @@ def save_snippet(file: func.Out[str], context) -> str:
     if not snippet_content_from_args:
         return "No snippet content provided"
 
-    file.set(snippet_content_from_args)
-    logging.info(f"Saved snippet: {snippet_content_from_args}")
-    return f"Snippet '{snippet_content_from_args}' saved successfully"
+    # Written through the snippet cache, so reads on this instance see the new content immediately
+    get_snippet_store().put(snippet_name_from_args, snippet_content_from_args)
+    logging.info(f"Saved snippet: {snippet_name_from_args}")
+    return f"Snippet '{snippet_name_from_args}' saved successfully"
+
+
+@app.generic_trigger(
+    arg_name="context",
+    type="mcpToolTrigger",
+    toolName="get_snippets",
+    description=(
+        "Retrieve several snippets by name in one call. "
+        "Returns a JSON object of name to content, null for missing snippets."
+    ),
+    toolProperties=tool_properties_get_snippets_batch_json,
+)
+def get_snippets(context) -> str:
+    try:
+        snippet_names = _parse_names(_tool_arguments(context).get(_SNIPPET_NAMES_PROPERTY_NAME))
+    except ValueError:
+        return "Snippet names must be a JSON array or a comma-separated list"
+    if not snippet_names:
+        return "No snippet names provided"
+    if len(snippet_names) > _MAX_BATCH_SIZE:
+        return f"At most {_MAX_BATCH_SIZE} snippets can be retrieved in one call"
+
+    snippets = get_snippet_store().get_many(snippet_names)
+    logging.info(
+        f"Retrieved {sum(content is not None for content in snippets.values())} of {len(snippet_names)} snippets"
+    )
+    return json.dumps(snippets)
+
+
+@app.generic_trigger(
+    arg_name="context",
+    type="mcpToolTrigger",
+    toolName="save_snippets",
+    description="Save several snippets in one call.",
+    toolProperties=tool_properties_save_snippets_batch_json,
+)
+def save_snippets(context) -> str:
+    snippets = _tool_arguments(context).get(_SNIPPETS_PROPERTY_NAME)
+    try:
+        if isinstance(snippets, str):
+            snippets = json.loads(snippets)
+    except ValueError:
+        return "Snippets must be a JSON object of snippet name to content"
+    if not isinstance(snippets, dict) or not snippets:
+        return "No snippets provided"
+    if len(snippets) > _MAX_BATCH_SIZE:
+        return f"At most {_MAX_BATCH_SIZE} snippets can be saved in one call"
+    empty = sorted(name for name, content in snippets.items() if not name or not content)
+    if empty:
+        return f"No snippet content provided for: {', '.join(empty)}"
+
+    get_snippet_store().put_many({name: str(content) for name, content in snippets.items()})
+    logging.info(f"Saved {len(snippets)} snippets")
+    return f"{len(snippets)} snippets saved successfully"
+
+
+@app.generic_trigger(
+    arg_name="context",
+    type="mcpToolTrigger",
+    toolName="list_snippets",
+    description="List the names of saved snippets, optionally only those starting with a prefix.",
+    toolProperties=tool_properties_list_snippets_json,
+)
+def list_snippets(context) -> str:
+    prefix = _tool_arguments(context).get(_PREFIX_PROPERTY_NAME) or ""
+    return json.dumps(get_snippet_store().list(prefix, limit=_MAX_BATCH_SIZE))
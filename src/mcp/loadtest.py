@@ -0,0 +1,113 @@
+"""
+Load test for the snippet tools, with and without the snippet cache.
+
+Calls the tool functions in-process, the way the MCP extension invokes them, against the storage account in
+AzureWebJobsStorage: Azurite (UseDevelopmentStorage=true) or a real account for realistic latency. The test seeds
+--snippets snippets, then makes --calls get_snippet calls from --concurrency threads, skewed towards a few popular
+snippets the way agents re-read the same context. The same reads are then made through get_snippets in batches of
+--batch-size. Run from src/mcp:
+
+    AzureWebJobsStorage=UseDevelopmentStorage=true python loadtest.py --snippets 200 --calls 2000 --concurrency 16
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+import function_app
+from snippet_store import get_snippet_store
+
+
+def _user_function(decorated) -> Callable:
+    """The plain function behind a tool; the Functions decorators wrap it in a FunctionBuilder."""
+    if hasattr(decorated, "build"):
+        return decorated.build().get_user_function()
+    return decorated
+
+
+def _context(**arguments) -> str:
+    return json.dumps({"arguments": arguments})
+
+
+def _percentiles(durations: list[float]) -> dict[str, float]:
+    ordered = sorted(durations)
+    return {
+        "calls": len(ordered),
+        "p50_ms": round(statistics.median(ordered) * 1000, 2),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))] * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2),
+    }
+
+
+def _timed_calls(call: Callable, arguments: list[str], concurrency: int) -> dict:
+    def timed(argument):
+        start = time.perf_counter()
+        call(argument)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        durations = list(executor.map(timed, arguments))
+    elapsed = time.perf_counter() - start
+    return {**_percentiles(durations), "calls_per_second": round(len(durations) / elapsed, 1)}
+
+
+def run_scenario(args, ttl_seconds: float, reads: list[str]) -> dict:
+    os.environ["SNIPPET_CACHE_TTL_SECONDS"] = str(ttl_seconds)
+    get_snippet_store.cache_clear()
+    get_snippet = _user_function(function_app.get_snippet)
+    get_snippets = _user_function(function_app.get_snippets)
+
+    single = _timed_calls(lambda name: get_snippet(_context(snippetname=name)), reads, args.concurrency)
+    batches = [reads[i : i + args.batch_size] for i in range(0, len(reads), args.batch_size)]
+    batched = _timed_calls(
+        lambda batch: get_snippets(_context(snippetnames=json.dumps(batch))), batches, args.concurrency
+    )
+    return {
+        "cache_ttl_seconds": ttl_seconds,
+        "get_snippet": single,
+        "get_snippets": batched,
+        "cache": get_snippet_store().cache.stats(),
+    }
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--snippets", type=int, default=200)
+    parser.add_argument("--snippet-bytes", type=int, default=2048)
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument(
+        "--ttl", type=float, default=30, help="cache TTL of the cached run, like SNIPPET_CACHE_TTL_SECONDS"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the report to this JSON file")
+    args = parser.parse_args(argv)
+
+    random_source = random.Random(args.seed)
+    names = [f"loadtest/snippet-{i:05d}" for i in range(args.snippets)]
+    save_snippets = _user_function(function_app.save_snippets)
+    for i in range(0, len(names), 100):
+        save_snippets(_context(snippets=json.dumps({name: "x" * args.snippet_bytes for name in names[i : i + 100]})))
+    # Zipf-like popularity: a few snippets take most of the reads
+    weights = [1 / (rank + 1) for rank in range(len(names))]
+    reads = random_source.choices(names, weights=weights, k=args.calls)
+
+    report = {
+        "without_cache": run_scenario(args, 0, reads),
+        "with_cache": run_scenario(args, args.ttl, reads),
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text)
+
+
+if __name__ == "__main__":
+    main()
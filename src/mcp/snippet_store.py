@@ -0,0 +1,240 @@
+"""
+Snippet storage for the MCP tools, with an in-process read-through cache.
+
+Snippets are stored as `snippets/<name>.json` blobs in the function app's storage account (AzureWebJobsStorage),
+where the blob bindings used to read and write them. Reads go through an LRU cache. An entry is served without a
+request for SNIPPET_CACHE_TTL_SECONDS; after that it is revalidated with a conditional request on its ETag, which
+costs a round trip but no download when the snippet is unchanged. Writes through this module update the cache of the
+instance that made them. Other instances see the change after at most one TTL.
+
+Every cache entry keeps the version at which the read or write that produced it was started. A read that started
+before a write finished never replaces the entry of that write, so a slow download cannot re-cache a stale snippet.
+"""
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError, ResourceNotModifiedError
+from azure.identity import DefaultAzureCredential
+from azure.storage.blob import BlobServiceClient, ContainerClient
+
+SNIPPET_CONTAINER_NAME = "snippets"
+
+
+class SnippetCache:
+    """
+    Thread-safe LRU cache of snippet contents and ETags, bounded by entry count and total bytes. Entries are stored
+    with a version from `version()`, and an entry is never replaced by one with an older version.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 32 * 1024 * 1024, ttl_seconds: float = 30.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[str, tuple[str, str, float, int]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._versions = itertools.count(1)
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0 and self.max_entries > 0
+
+    def version(self) -> int:
+        """A version greater than that of every entry stored so far, taken when a read starts or a write is done."""
+        with self._lock:
+            return next(self._versions)
+
+    def get(self, name: str) -> tuple[str, str, bool] | None:
+        """Returns (content, etag, fresh) for a cached snippet, or None."""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            self._entries.move_to_end(name)
+            content, etag, stored_at, _ = entry
+            return content, etag, time.monotonic() - stored_at < self.ttl_seconds
+
+    def put(self, name: str, content: str, etag: str, version: int) -> bool:
+        """Stores a snippet unless the cache already holds a newer version of it. Returns whether it was stored."""
+        if not self.enabled:
+            return False
+        size = len(content.encode("utf-8"))
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry[3] > version:
+                return False
+            self._remove(name)
+            if size > self.max_bytes:
+                return False
+            self._entries[name] = (content, etag, time.monotonic(), version)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+            return name in self._entries
+
+    def touch(self, name: str, etag: str):
+        """Marks an entry as fresh again after its ETag was confirmed, unless it was replaced in the meantime."""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry[1] == etag:
+                self._entries[name] = (entry[0], entry[1], time.monotonic(), entry[3])
+
+    def invalidate(self, name: str, version: int | None = None):
+        """Drops a snippet, or only an entry not newer than `version` if one is given."""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and (version is None or entry[3] <= version):
+                self._remove(name)
+
+    def _remove(self, name: str):
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            self._bytes -= len(entry[0].encode("utf-8"))
+
+    def record(self, outcome: str):
+        """Counts a read as one of hits, revalidations or misses."""
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "revalidations": self.revalidations,
+                "misses": self.misses,
+            }
+
+
+class SnippetStore:
+    """Reads and writes snippet blobs, single or in batches of concurrent requests."""
+
+    def __init__(self, container_client: ContainerClient, cache: SnippetCache, max_workers: int = 16):
+        self.container_client = container_client
+        self.cache = cache
+        self.max_workers = max_workers
+        self._container_checked = False
+
+    @staticmethod
+    def blob_name(name: str) -> str:
+        return f"{name}.json"
+
+    def get(self, name: str) -> str | None:
+        version = self.cache.version()
+        cached = self.cache.get(name) if self.cache.enabled else None
+        blob_client = self.container_client.get_blob_client(self.blob_name(name))
+        if cached is not None:
+            content, etag, fresh = cached
+            if fresh:
+                self.cache.record("hits")
+                return content
+            try:
+                # Only downloads the snippet if it changed since it was cached
+                downloader = blob_client.download_blob(etag=etag, match_condition=MatchConditions.IfModified)
+            except ResourceNotModifiedError:
+                self.cache.record("revalidations")
+                self.cache.touch(name, etag)
+                return content
+            except ResourceNotFoundError:
+                self.cache.invalidate(name, version)
+                return None
+        else:
+            try:
+                downloader = blob_client.download_blob()
+            except ResourceNotFoundError:
+                return None
+        self.cache.record("misses")
+        content = downloader.readall().decode("utf-8")
+        self.cache.put(name, content, downloader.properties.etag, version)
+        return content
+
+    def put(self, name: str, content: str):
+        self._ensure_container()
+        try:
+            result = self.container_client.upload_blob(self.blob_name(name), content.encode("utf-8"), overwrite=True)
+        except Exception:
+            self.cache.invalidate(name)
+            raise
+        # Taken once the upload is done, so reads that started before it cannot replace this entry
+        self.cache.put(name, content, result["etag"], self.cache.version())
+
+    def get_many(self, names: Iterable[str]) -> dict[str, str | None]:
+        names = list(dict.fromkeys(names))
+        if not names:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(names))) as executor:
+            return dict(zip(names, executor.map(self.get, names)))
+
+    def put_many(self, snippets: dict[str, str]):
+        if not snippets:
+            return
+        self._ensure_container()
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(snippets))) as executor:
+            list(executor.map(lambda item: self.put(*item), snippets.items()))
+
+    def list(self, prefix: str = "", limit: int = 1000) -> list[dict]:
+        snippets = []
+        for blob in self.container_client.list_blobs(name_starts_with=prefix or None):
+            if not blob.name.endswith(".json"):
+                continue
+            snippets.append(
+                {
+                    "name": blob.name[: -len(".json")],
+                    "size": blob.size,
+                    "last_modified": blob.last_modified.isoformat() if blob.last_modified else None,
+                }
+            )
+            if len(snippets) >= limit:
+                break
+        return snippets
+
+    def _ensure_container(self):
+        if self._container_checked:
+            return
+        try:
+            self.container_client.create_container()
+        except ResourceExistsError:
+            pass
+        self._container_checked = True
+
+
+def _get_blob_service_client() -> BlobServiceClient:
+    """Uses the same storage account and identity settings as the AzureWebJobsStorage connection of the bindings."""
+    connection_string = os.getenv("AzureWebJobsStorage")
+    if connection_string:
+        return BlobServiceClient.from_connection_string(connection_string)
+    account_url = os.getenv("AzureWebJobsStorage__blobServiceUri")
+    if not account_url:
+        account_name = os.getenv("AzureWebJobsStorage__accountName")
+        if not account_name:
+            raise ValueError("AzureWebJobsStorage is not configured")
+        account_url = f"https://{account_name}.blob.core.windows.net"
+    credential = DefaultAzureCredential(managed_identity_client_id=os.getenv("AzureWebJobsStorage__clientId"))
+    return BlobServiceClient(account_url, credential=credential)
+
+
+@lru_cache(maxsize=1)
+def get_snippet_store() -> SnippetStore:
+    cache = SnippetCache(
+        max_entries=int(os.getenv("SNIPPET_CACHE_MAX_ENTRIES", "1024")),
+        max_bytes=int(os.getenv("SNIPPET_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+        ttl_seconds=float(os.getenv("SNIPPET_CACHE_TTL_SECONDS", "30")),
+    )
+    logging.info(f"Snippet cache {'enabled' if cache.enabled else 'disabled'} with a TTL of {cache.ttl_seconds}s")
+    return SnippetStore(
+        _get_blob_service_client().get_container_client(SNIPPET_CONTAINER_NAME),
+        cache,
+        max_workers=int(os.getenv("SNIPPET_MAX_CONCURRENCY", "16")),
+    )
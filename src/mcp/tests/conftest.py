@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The function app imports its modules relative to src/mcp, as the Functions host does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
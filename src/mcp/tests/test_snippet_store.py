@@ -0,0 +1,154 @@
+from types import SimpleNamespace
+
+import pytest
+import snippet_store
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError, ResourceNotModifiedError
+from snippet_store import SnippetCache, SnippetStore
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(snippet_store.time, "monotonic", clock)
+    return clock
+
+
+class SnippetContainerClient:
+    """
+    ContainerClient stand-in for the snippet store, with ETags and downloads conditional on them. `on_download` is
+    called after a download has read the blob and before it returns, to interleave a write with a slow read.
+    """
+
+    def __init__(self):
+        self.blobs: dict[str, tuple[bytes, str]] = {}
+        self.downloads = 0
+        self.not_modified = 0
+        self.on_download = None
+        self._versions = 0
+
+    def create_container(self):
+        pass
+
+    def upload_blob(self, name: str, data: bytes, overwrite: bool = False, **kwargs) -> dict:
+        self._versions += 1
+        self.blobs[name] = (data, f'"{self._versions}"')
+        return {"etag": self.blobs[name][1]}
+
+    def get_blob_client(self, name: str):
+        def download_blob(etag: str | None = None, match_condition: MatchConditions | None = None):
+            if name not in self.blobs:
+                raise ResourceNotFoundError(name)
+            data, current_etag = self.blobs[name]
+            if match_condition == MatchConditions.IfModified and etag == current_etag:
+                self.not_modified += 1
+                raise ResourceNotModifiedError(name)
+            self.downloads += 1
+            if self.on_download is not None:
+                self.on_download(name)
+            return SimpleNamespace(readall=lambda: data, properties=SimpleNamespace(etag=current_etag))
+
+        return SimpleNamespace(download_blob=download_blob)
+
+
+def test_the_least_recently_used_entries_are_evicted_first():
+    cache = SnippetCache(max_entries=2, max_bytes=10)
+    cache.put("a", "aaa", '"1"', cache.version())
+    cache.put("b", "bbb", '"1"', cache.version())
+    cache.get("a")
+    cache.put("c", "ccc", '"1"', cache.version())
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+
+    # Over the byte budget, the least recently used entries go until the new one fits
+    cache.put("d", "dddddddd", '"1"', cache.version())
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["bytes"] == 8
+    assert not cache.put("e", "e" * 11, '"1"', cache.version())
+
+
+def test_entries_are_served_until_the_ttl_and_then_revalidated(clock):
+    container = SnippetContainerClient()
+    container.upload_blob("a.json", b"first")
+    store = SnippetStore(container, SnippetCache(ttl_seconds=30))
+
+    assert store.get("a") == "first"
+    clock.now += 29
+    assert store.get("a") == "first"
+    assert (container.downloads, container.not_modified) == (1, 0)
+
+    # After the TTL, an unchanged snippet costs a 304 and is fresh again for another TTL
+    clock.now += 2
+    assert store.get("a") == "first"
+    assert (container.downloads, container.not_modified) == (1, 1)
+    clock.now += 29
+    assert store.get("a") == "first"
+    assert container.not_modified == 1
+
+    # A snippet changed by another instance is downloaded again once the TTL is over
+    container.upload_blob("a.json", b"second", overwrite=True)
+    clock.now += 31
+    assert store.get("a") == "second"
+    assert container.downloads == 2
+    stats = store.cache.stats()
+    assert (stats["hits"], stats["revalidations"], stats["misses"]) == (2, 1, 2)
+
+
+def test_a_deleted_snippet_is_dropped_on_revalidation(clock):
+    container = SnippetContainerClient()
+    container.upload_blob("a.json", b"first")
+    store = SnippetStore(container, SnippetCache(ttl_seconds=30))
+    store.get("a")
+
+    del container.blobs["a.json"]
+    clock.now += 31
+    assert store.get("a") is None
+    assert store.cache.get("a") is None
+
+
+def test_a_write_replaces_the_cached_snippet(clock):
+    container = SnippetContainerClient()
+    store = SnippetStore(container, SnippetCache(ttl_seconds=30))
+    store.put("a", "first")
+    assert store.get("a") == "first"
+
+    store.put("a", "second")
+    assert store.get("a") == "second"
+    assert container.downloads == 0
+
+
+def test_a_failed_write_invalidates_the_cached_snippet():
+    container = SnippetContainerClient()
+    store = SnippetStore(container, SnippetCache(ttl_seconds=30))
+    store.put("a", "first")
+
+    def fail(*args, **kwargs):
+        raise ResourceNotFoundError("container deleted")
+
+    container.upload_blob = fail
+    with pytest.raises(ResourceNotFoundError):
+        store.put("a", "second")
+    assert store.cache.get("a") is None
+
+
+def test_a_read_that_started_before_a_write_does_not_cache_the_old_snippet():
+    container = SnippetContainerClient()
+    container.upload_blob("a.json", b"first")
+    store = SnippetStore(container, SnippetCache(ttl_seconds=30))
+
+    # The write finishes while the download of the first version is still in flight
+    container.on_download = lambda name: store.put("a", "second")
+    assert store.get("a") == "first"
+    container.on_download = None
+
+    content, etag, fresh = store.cache.get("a")
+    assert (content, etag, fresh) == ("second", container.blobs["a.json"][1], True)
+    assert store.get("a") == "second"